@@ -0,0 +1,119 @@
+"""書き込みが集中したときの受付制御 (admission.py) の有無による比較
+
+使い方 (fastapi ディレクトリで実行、httpx が必要):
+    python bench/admission_overload.py --writers 200 --readers 10 --seconds 10
+
+受付制御なし (ADMISSION_MAX_WRITES=0) と、あり (--max-writes, --queue-size,
+--queue-timeout) のそれぞれで子プロセスを起動し、一時ディレクトリの使い捨て DB に
+対してアプリをプロセス内で動かす (DB_MODE=async)。
+--writers 本の並行クライアントが POST /bookings を送り続け、その間に --readers 本が
+GET /bookings を送り続ける。エンドポイントごとのステータス別件数と、成功した
+リクエストの p50/p99、断られたリクエストが返るまでの p99 を JSON で出力する。
+"""
+import argparse
+import asyncio
+import datetime
+import itertools
+import json
+import time
+
+import harness
+
+ROOMS = 8
+
+
+def percentile_ms(values, p):
+    value = harness.percentile(values, p)
+    return None if value is None else round(value * 1000, 2)
+
+
+def summarize(samples):
+    ok = [elapsed for status, elapsed in samples if status < 400]
+    rejected = [elapsed for status, elapsed in samples if status in (429, 503)]
+    status_counts = {}
+    for status, _ in samples:
+        status_counts[str(status)] = status_counts.get(str(status), 0) + 1
+    return {
+        'status_counts': status_counts,
+        'ok_p50_ms': percentile_ms(ok, 50),
+        'ok_p99_ms': percentile_ms(ok, 99),
+        'ok_max_ms': percentile_ms(ok, 100),
+        'rejected_p99_ms': percentile_ms(rejected, 99),
+    }
+
+
+async def run_workload(writers, readers, seconds):
+    import httpx
+    import bootstrap, main
+
+    bootstrap.run(seed=False)
+    transport = httpx.ASGITransport(app=main.app)
+    samples = {'POST /bookings': [], 'GET /bookings': []}
+    slots = itertools.count()
+    base = datetime.datetime(2030, 1, 1, 9, 0)
+
+    async with httpx.AsyncClient(transport=transport, base_url='http://bench', timeout=None) as client:
+        await client.post('/users', json={'username': 'bench'})
+        for i in range(ROOMS):
+            await client.post('/rooms', json={'room_name': f'bench{i}', 'capacity': 10})
+        deadline = time.perf_counter() + seconds
+
+        async def writer():
+            while time.perf_counter() < deadline:
+                i = next(slots)
+                start = base + datetime.timedelta(minutes=30 * (i // ROOMS))
+                t0 = time.perf_counter()
+                res = await client.post('/bookings', json={
+                    'user_id': 1, 'room_id': i % ROOMS + 1, 'booked_num': 1,
+                    'start_datetime': start.isoformat(),
+                    'end_datetime': (start + datetime.timedelta(minutes=30)).isoformat(),
+                })
+                samples['POST /bookings'].append((res.status_code, time.perf_counter() - t0))
+                if res.status_code in (429, 503):
+                    # 断られたクライアントは Retry-After 秒待って送り直す
+                    await asyncio.sleep(float(res.headers.get('Retry-After', '1')))
+
+        async def reader(k):
+            while time.perf_counter() < deadline:
+                t0 = time.perf_counter()
+                res = await client.get(f'/bookings?room_id={k % ROOMS + 1}&limit=50')
+                samples['GET /bookings'].append((res.status_code, time.perf_counter() - t0))
+
+        await asyncio.gather(*(writer() for _ in range(writers)), *(reader(k) for k in range(readers)))
+
+    return {name: summarize(values) for name, values in samples.items()}
+
+
+def child(args):
+    harness.run_child(run_workload, args.writers, args.readers, args.seconds)
+
+
+def parent(args):
+    configs = {
+        'off': {'ADMISSION_MAX_WRITES': '0'},
+        'on': {
+            'ADMISSION_MAX_WRITES': str(args.max_writes),
+            'ADMISSION_QUEUE_SIZE': str(args.queue_size),
+            'ADMISSION_QUEUE_TIMEOUT_SECONDS': str(args.queue_timeout),
+        },
+    }
+    child_args = ['--writers', str(args.writers), '--readers', str(args.readers), '--seconds', str(args.seconds)]
+    results = {
+        name: harness.run_in_child(__file__, child_args,
+                                   dict(DB_MODE='async', BOOKING_CONFLICT_INDEX='db', METRICS_ENABLED='0', **overrides))
+        for name, overrides in configs.items()
+    }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--writers', type=int, default=200)
+    parser.add_argument('--readers', type=int, default=10)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--max-writes', type=int, default=8)
+    parser.add_argument('--queue-size', type=int, default=32)
+    parser.add_argument('--queue-timeout', type=float, default=1.0)
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    child(args) if args.child else parent(args)
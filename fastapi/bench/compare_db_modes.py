@@ -0,0 +1,85 @@
+"""DB_MODE=sync と DB_MODE=async のレイテンシ比較
+
+使い方 (fastapi ディレクトリで実行、httpx が必要):
+    python bench/compare_db_modes.py --requests 2000 --concurrency 50
+
+モードごとに子プロセスを起動し、一時ディレクトリの使い捨て DB に対して
+アプリをプロセス内で動かす。GET /rooms の読み込みと POST /bookings の
+書き込みを混ぜて同時に投げ、エンドポイントごとの p50/p95/p99 と
+スループットを JSON で出力する。
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import time
+
+import harness
+from harness import percentile
+
+
+def summarize(latencies, elapsed):
+    return {
+        'count': len(latencies),
+        'throughput_rps': round(len(latencies) / elapsed, 1) if elapsed else None,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+    }
+
+
+async def run_workload(n_requests, concurrency, write_ratio):
+    import httpx
+    import bootstrap, main
+
+    bootstrap.run(seed=False)
+    transport = httpx.ASGITransport(app=main.app)
+    latencies = {'GET /rooms': [], 'POST /bookings': []}
+    counter = iter(range(n_requests))
+    base = datetime.datetime(2030, 1, 1, 9, 0)
+
+    async with httpx.AsyncClient(transport=transport, base_url='http://bench') as client:
+        await client.post('/users', json={'username': 'bench'})
+        await client.post('/rooms', json={'room_name': 'bench', 'capacity': 10})
+
+        async def worker():
+            for i in counter:
+                t0 = time.perf_counter()
+                if i % 100 < write_ratio * 100:
+                    start = base + datetime.timedelta(minutes=30 * i)
+                    await client.post('/bookings', json={
+                        'user_id': 1, 'room_id': 1, 'booked_num': 1,
+                        'start_datetime': start.isoformat(),
+                        'end_datetime': (start + datetime.timedelta(minutes=30)).isoformat(),
+                    })
+                    latencies['POST /bookings'].append(time.perf_counter() - t0)
+                else:
+                    await client.get('/rooms')
+                    latencies['GET /rooms'].append(time.perf_counter() - t0)
+
+        t0 = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - t0
+
+    return {name: summarize(values, elapsed) for name, values in latencies.items() if values}
+
+
+def child(args):
+    harness.run_child(run_workload, args.requests, args.concurrency, args.write_ratio)
+
+
+def parent(args):
+    child_args = ['--requests', str(args.requests), '--concurrency', str(args.concurrency),
+                  '--write-ratio', str(args.write_ratio)]
+    results = {mode: harness.run_in_child(__file__, child_args, {'DB_MODE': mode}) for mode in ('sync', 'async')}
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--write-ratio', type=float, default=0.2)
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    child(args) if args.child else parent(args)
@@ -0,0 +1,42 @@
+"""ベンチマークの共通処理
+
+設定 (環境変数) ごとに子プロセスを起動し、一時ディレクトリの使い捨て DB に対してアプリを
+プロセス内で動かして計測する。スクリプトは --child で子プロセス側の処理を行い、
+結果を 1 行の JSON で出力する。
+"""
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+SRC_DIR = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+
+# p パーセンタイル (最も近い順位の値、値がなければ None)
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    k = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[k]
+
+
+# 子プロセス側: workload(*args) を実行して結果を JSON で出力する
+# 使い捨て DB を作るため、main を import する前に一時ディレクトリへ移動する
+def run_child(workload, *args):
+    sys.path.insert(0, SRC_DIR)
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        result = asyncio.run(workload(*args))
+    print(json.dumps(result))
+
+
+# 親プロセス側: script を --child 付きで、環境変数に env を加えて実行し、出力した JSON を返す
+def run_in_child(script: str, args, env: dict):
+    out = subprocess.run(
+        [sys.executable, os.path.abspath(script), '--child', *args],
+        env=dict(os.environ, **env), check=True, capture_output=True, text=True,
+    )
+    return json.loads(out.stdout.strip().splitlines()[-1])
@@ -0,0 +1,14 @@
+"""予約 API の負荷試験・ベンチマーク
+
+使い方 (fastapi ディレクトリで実行、httpx が必要):
+    python -m bench.loadtest --rooms 1000 --users 100000 --bookings 5000000 \\
+        --requests 20000 --concurrency 100 --output result.json
+    python -m bench.loadtest --baseline baseline.json --tolerance 0.2   # 悪化していれば終了コード 1
+
+一時ディレクトリの使い捨て DB に合成データを投入し、アプリをプロセス内で動かして
+(httpx の ASGITransport) 空き会議室検索・一覧のページ取得・重複しない予約登録・
+重複する予約登録を混ぜたリクエストを指定の同時実行数で投げる。
+エンドポイントごとのスループットと p50/p95/p99 を JSON で出力する。
+DB_MODE や FAST_RESPONSES などの環境変数はそのままアプリに渡る。
+SQLALCHEMY_DATABASE_URL を指定した場合はその DB に投入するので、空の DB を指定すること。
+"""
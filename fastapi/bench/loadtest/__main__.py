@@ -0,0 +1,78 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+
+from . import __doc__ as DESCRIPTION, report, workload
+from .seed import seed
+
+SRC_DIR = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'src'))
+
+
+def run(args):
+    # database は import 時に接続先を読むので、その前に使い捨て DB を指定する
+    os.environ.setdefault('SQLALCHEMY_DATABASE_URL', 'sqlite:///./sql_app.db')
+    sys.path.insert(0, SRC_DIR)
+    import bootstrap, database, main
+    bootstrap.run(seed=False)
+
+    t0 = time.perf_counter()
+    per_room = seed(database.engine, args.rooms, args.users, args.bookings, args.batch_size)
+    seed_s = time.perf_counter() - t0
+
+    result = asyncio.run(workload.run(
+        main.app, workload.Workload(args.rooms, args.users, per_room, args.seed),
+        workload.parse_mix(args.mix), args.requests, args.concurrency,
+    ))
+    config = {name: getattr(args, name) for name in ('rooms', 'users', 'bookings', 'requests', 'concurrency', 'mix', 'seed')}
+    config.update({name: os.environ.get(name) for name in ('DB_MODE', 'FAST_RESPONSES', 'BOOKING_CONFLICT_INDEX')
+                   if os.environ.get(name) is not None})
+    return dict(config=config, seed_s=round(seed_s, 3), **result)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m bench.loadtest', description=DESCRIPTION,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rooms', type=int, default=100)
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--bookings', type=int, default=100000)
+    parser.add_argument('--batch-size', type=int, default=50000, help='シード時に 1 回で INSERT する行数')
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--mix', default='',
+                        help='操作の割合 (例: availability=0.5,create_booking=0.5)。'
+                             f'既定: {",".join(f"{k}={v}" for k, v in workload.DEFAULT_MIX.items())}')
+    parser.add_argument('--seed', type=int, default=0, help='リクエストの乱数のシード')
+    parser.add_argument('--output', help='結果の JSON を書き出すファイル')
+    parser.add_argument('--baseline', help='比較する基準の結果 JSON')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='基準からの許容する悪化の割合')
+    args = parser.parse_args(argv)
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            result = run(args)
+        finally:
+            os.chdir(cwd)
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = report.compare(result, json.load(f), args.tolerance)
+        result['regressions'] = regressions
+
+    text = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    print(text)
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
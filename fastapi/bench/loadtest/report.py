@@ -0,0 +1,31 @@
+from ..harness import percentile
+
+
+def summarize(latencies, errors, elapsed):
+    return {
+        'count': len(latencies),
+        'errors': errors,
+        'throughput_rps': round(len(latencies) / elapsed, 1) if elapsed else None,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+    }
+
+
+# 基準の結果と比べて、p95 が tolerance を超えて遅くなった・スループットが下がったエンドポイントを返す
+def compare(result, baseline, tolerance):
+    regressions = []
+    for name, current in result['endpoints'].items():
+        base = baseline.get('endpoints', {}).get(name)
+        if base is None:
+            continue
+        if current['p95_ms'] > base['p95_ms'] * (1 + tolerance):
+            regressions.append({'endpoint': name, 'metric': 'p95_ms',
+                                'baseline': base['p95_ms'], 'current': current['p95_ms']})
+        if current['throughput_rps'] < base['throughput_rps'] * (1 - tolerance):
+            regressions.append({'endpoint': name, 'metric': 'throughput_rps',
+                                'baseline': base['throughput_rps'], 'current': current['throughput_rps']})
+        if current['errors'] > base['errors']:
+            regressions.append({'endpoint': name, 'metric': 'errors',
+                                'baseline': base['errors'], 'current': current['errors']})
+    return regressions
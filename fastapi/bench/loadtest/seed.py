@@ -0,0 +1,56 @@
+import datetime
+
+from sqlalchemy import insert
+
+# 合成データの予約は BASE の日から 1 日 SLOTS_PER_DAY 枠 (9:00〜20:00 の毎時 00〜30 分) に並べる
+BASE = datetime.datetime(2030, 1, 1)
+OPEN_HOUR = 9
+SLOTS_PER_DAY = 11
+BOOKING_MINUTES = 30
+
+
+# 会議室ごとの k 番目の予約の開始時刻
+def slot_start(k: int) -> datetime.datetime:
+    day, slot = divmod(k, SLOTS_PER_DAY)
+    return BASE + datetime.timedelta(days=day, hours=OPEN_HOUR + slot)
+
+
+def _batches(rows, batch_size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+# ユーザー・会議室・予約をまとめて INSERT する
+# 予約は会議室ごとに重ならないよう slot_start の順に割り当てる
+def seed(engine, rooms: int, users: int, bookings: int, batch_size: int = 50000):
+    import models
+
+    per_room, extra = divmod(bookings, rooms)
+    with engine.begin() as conn:
+        for batch in _batches(({'username': f'user{i}'} for i in range(1, users + 1)), batch_size):
+            conn.execute(insert(models.User), batch)
+        for batch in _batches(({'room_name': f'room{i}', 'capacity': 2 + i % 19} for i in range(1, rooms + 1)),
+                              batch_size):
+            conn.execute(insert(models.Room), batch)
+
+        def booking_rows():
+            for room_id in range(1, rooms + 1):
+                for k in range(per_room + (1 if room_id <= extra else 0)):
+                    start = slot_start(k)
+                    yield {
+                        'user_id': 1 + (room_id * 7919 + k) % users,
+                        'room_id': room_id,
+                        'booked_num': 1,
+                        'start_datetime': start,
+                        'end_datetime': start + datetime.timedelta(minutes=BOOKING_MINUTES),
+                    }
+
+        for batch in _batches(booking_rows(), batch_size):
+            conn.execute(insert(models.Booking), batch)
+    return per_room
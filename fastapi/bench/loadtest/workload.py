@@ -0,0 +1,136 @@
+import asyncio
+import datetime
+import itertools
+import random
+import time
+
+from . import report
+from .seed import BOOKING_MINUTES, OPEN_HOUR, slot_start
+
+# 操作ごとの既定の割合
+DEFAULT_MIX = {
+    'availability': 0.2,
+    'list_bookings': 0.25,
+    'list_users': 0.15,
+    'list_rooms': 0.1,
+    'create_booking': 0.15,
+    'create_conflicting_booking': 0.15,
+    # --mix auto_booking=0.1 のように指定した場合だけ実行する
+    'auto_booking': 0,
+}
+
+
+def parse_mix(text: str) -> dict:
+    mix = dict(DEFAULT_MIX)
+    for item in filter(None, text.split(',')):
+        name, _, weight = item.partition('=')
+        if name not in DEFAULT_MIX:
+            raise ValueError(f'unknown operation {name!r}, expected one of {sorted(DEFAULT_MIX)}')
+        mix[name] = float(weight)
+    return {name: weight for name, weight in mix.items() if weight > 0}
+
+
+class Workload:
+    """シードしたデータの配置に合わせてリクエストを組み立てる
+
+    各操作は (エンドポイント名, メソッド, パス, JSON, 正常なステータス) を返す。
+    """
+
+    def __init__(self, rooms: int, users: int, per_room: int, seed: int = 0):
+        import pagination
+
+        self.pagination = pagination
+        self.rooms = rooms
+        self.users = users
+        self.days = max(1, per_room // 11)
+        self.per_room = max(1, per_room)
+        self.rnd = random.Random(seed)
+        # 重複しない予約は各枠の 30〜60 分に 1 件ずつ入れる
+        self.free_slots = itertools.count()
+
+    def availability(self):
+        day = slot_start(0) + datetime.timedelta(days=self.rnd.randrange(self.days))
+        path = f'/rooms/availability?start={day.date()}T00:00:00&end={day.date()}T23:59:59' \
+               f'&min_capacity={self.rnd.randint(1, 20)}'
+        return 'GET /rooms/availability', 'GET', path, None, (200,)
+
+    def list_bookings(self):
+        start = slot_start(0) + datetime.timedelta(days=self.rnd.randrange(self.days))
+        end = start + datetime.timedelta(days=7)
+        path = f'/bookings?room_id={self.rnd.randint(1, self.rooms)}' \
+               f'&from={start.isoformat()}&to={end.isoformat()}&limit=100'
+        return 'GET /bookings', 'GET', path, None, (200,)
+
+    def list_users(self):
+        cursor = self.pagination.id_cursor(self.rnd.randrange(self.users))
+        return 'GET /users', 'GET', f'/users?limit=100&cursor={cursor}', None, (200,)
+
+    def list_rooms(self):
+        cursor = self.pagination.id_cursor(self.rnd.randrange(self.rooms))
+        return 'GET /rooms', 'GET', f'/rooms?limit=100&cursor={cursor}', None, (200,)
+
+    def _booking(self, room_id, start):
+        return {
+            'user_id': self.rnd.randint(1, self.users), 'room_id': room_id, 'booked_num': 1,
+            'start_datetime': start.isoformat(),
+            'end_datetime': (start + datetime.timedelta(minutes=BOOKING_MINUTES)).isoformat(),
+        }
+
+    def create_booking(self):
+        i = next(self.free_slots)
+        room_id, k = i % self.rooms + 1, i // self.rooms
+        start = slot_start(k) + datetime.timedelta(minutes=BOOKING_MINUTES)
+        return 'POST /bookings', 'POST', '/bookings', self._booking(room_id, start), (200,)
+
+    def create_conflicting_booking(self):
+        # シード済みの予約と同じ枠 (重複として 409 が返るのが正常)
+        start = slot_start(self.rnd.randrange(self.per_room))
+        return 'POST /bookings (conflict)', 'POST', '/bookings', \
+            self._booking(self.rnd.randint(1, self.rooms), start), (409,)
+
+    def auto_booking(self):
+        # シード済みの枠 (埋まっていれば次の候補) と、開始前の 8:00〜 の枠を候補にして会議室を選ばせる
+        # (create_booking が使う枠とは重ならない。候補のどの会議室も埋まっていれば 409)
+        k = self.rnd.randrange(self.per_room)
+        early = slot_start(k).replace(hour=OPEN_HOUR - 1)
+        windows = [(slot_start(k), slot_start(k) + datetime.timedelta(minutes=BOOKING_MINUTES)),
+                   (early, early + datetime.timedelta(minutes=BOOKING_MINUTES))]
+        body = {
+            'user_id': self.rnd.randint(1, self.users), 'booked_num': self.rnd.randint(1, 10),
+            'windows': [{'start_datetime': start.isoformat(), 'end_datetime': end.isoformat()} for start, end in windows],
+        }
+        return 'POST /bookings/auto', 'POST', '/bookings/auto', body, (200, 409)
+
+
+async def run(app, workload: Workload, mix: dict, n_requests: int, concurrency: int):
+    import httpx
+
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    # 操作の並びは先に決めておき、実行ごとに同じ順序にする
+    plan = iter(workload.rnd.choices(names, weights=weights, k=n_requests))
+    latencies, errors = {}, {}
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url='http://loadtest', timeout=None) as client:
+        async def worker():
+            for op in plan:
+                endpoint, method, path, body, expected = getattr(workload, op)()
+                t0 = time.perf_counter()
+                res = await client.request(method, path, json=body)
+                latencies.setdefault(endpoint, []).append(time.perf_counter() - t0)
+                errors.setdefault(endpoint, 0)
+                if res.status_code not in expected:
+                    errors[endpoint] += 1
+
+        t0 = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - t0
+
+    all_latencies = [value for values in latencies.values() for value in values]
+    return {
+        'elapsed_s': round(elapsed, 3),
+        'endpoints': {name: report.summarize(values, errors[name], elapsed)
+                      for name, values in sorted(latencies.items())},
+        'total': report.summarize(all_latencies, sum(errors.values()), elapsed),
+    }
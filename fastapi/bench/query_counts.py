@@ -0,0 +1,155 @@
+"""crud の書き込み関数ごとの SQL 文の数と 1 回あたりの時間
+
+使い方 (fastapi ディレクトリで実行):
+    python bench/query_counts.py --repeat 200
+    python bench/query_counts.py --check   # 上限を超えたら終了コード 1
+
+一時ディレクトリの使い捨て DB に対して crud の関数を直接呼び、
+before_cursor_execute で数えた 1 回あたりの SQL 文の数 (COMMIT を含む、中央値と最大) と
+時間の中央値を JSON で出力する。--check では MAX_STATEMENTS と比べる。
+"""
+import argparse
+import datetime
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+
+# 関数ごとの SQL 文の上限 (COMMIT を含む)
+# 予約の書き込みの読み込みは、会議室の定員・バージョン・重複の有無 (update_booking は変更前の値も) を
+# まとめて読む 1 文だけにする (繰り返し予約は期間の予約と候補のシリーズの読み込みが加わる)
+# おまかせ予約は空き会議室とそのバージョンを読む 1 文だけ
+# 予約の登録・更新・削除は利用実績の集計の UPSERT 1 文と会議室のバージョン更新を含む
+# 書き込みはすべて変更イベントの INSERT 1 文を含む
+# ユーザー・会議室の削除は予約・繰り返し予約の DELETE を含む
+# 一括更新・削除は対象の件数によらず同じ数になる (10 件ずつで計測する)
+MAX_STATEMENTS = {
+    'initialize_data': 7,
+    'create_user': 3,
+    'create_room': 3,
+    'update_user': 3,
+    'update_room': 3,
+    'delete_user': 5,
+    'delete_room': 5,
+    'create_booking': 6,
+    'update_booking': 6,
+    'create_booking_auto': 6,
+    'delete_booking': 5,
+    'create_recurring_booking': 8,
+    'delete_recurring_booking': 5,
+    'update_bookings': 8,
+    'delete_bookings': 6,
+}
+
+
+def measure(repeat):
+    from sqlalchemy import event
+
+    import crud, schemas
+    import bootstrap, database
+    from database import SessionLocal
+    bootstrap.run(seed=False)
+    engine = database.engine
+
+    statements = [0]
+
+    def count(*args):
+        statements[0] += 1
+
+    event.listen(engine, 'before_cursor_execute', count)
+    event.listen(engine, 'commit', count)
+
+    results = {}
+
+    def run(name, calls):
+        counts, timings = [], []
+        for call in calls:
+            db = SessionLocal()
+            try:
+                statements[0] = 0
+                t0 = time.perf_counter()
+                call(db)
+                timings.append(time.perf_counter() - t0)
+                counts.append(statements[0])
+            finally:
+                db.close()
+        # 会議室バージョンの初回作成などを除いた通常の 1 回分の数
+        results[name] = {
+            'statements': int(statistics.median(counts)),
+            'max_statements': max(counts),
+            'median_us': round(statistics.median(timings) * 1e6, 1),
+        }
+
+    base = datetime.datetime(2030, 1, 1, 9, 0)
+
+    def booking(i, room_id=1, minutes=30):
+        start = base + datetime.timedelta(hours=i)
+        return schemas.BookingCreate(user_id=1, room_id=room_id, booked_num=1, start_datetime=start,
+                                     end_datetime=start + datetime.timedelta(minutes=minutes))
+
+    def series(i):
+        start = base + datetime.timedelta(days=3650 + i * 30)
+        return schemas.RecurringBookingCreate(user_id=1, room_id=1, booked_num=1, start_datetime=start,
+                                              end_datetime=start + datetime.timedelta(hours=1),
+                                              interval_days=7, until=(start + datetime.timedelta(days=28)).date())
+
+    run('initialize_data', [crud.initialize_data])
+    ids = list(range(2, repeat + 2))
+    run('create_user', [lambda db, i=i: crud.create_user(db, schemas.UserCreate(username=f'user{i}')) for i in ids])
+    run('create_room', [lambda db, i=i: crud.create_room(db, schemas.RoomCreate(room_name=f'room{i}', capacity=10))
+                        for i in ids])
+    run('update_user', [lambda db, i=i: crud.update_user(db, i, schemas.UserUpdate(username=f'renamed{i}'))
+                        for i in ids])
+    run('update_room', [lambda db, i=i: crud.update_room(db, i, schemas.RoomUpdate(room_name=f'renamed{i}', capacity=5))
+                        for i in ids])
+    run('create_booking', [lambda db, i=i: crud.create_booking(db, booking(i)) for i in range(repeat)])
+    run('create_booking_auto', [lambda db, i=i: crud.create_booking_auto(db, schemas.BookingAutoCreate(
+        user_id=1, booked_num=1, start_datetime=booking(i + repeat).start_datetime,
+        end_datetime=booking(i + repeat).end_datetime)) for i in range(repeat)])
+    booking_ids = [row[0] for row in SessionLocal().query(crud.models.Booking.booking_id).
+                   filter(crud.models.Booking.start_datetime >= base).order_by(crud.models.Booking.booking_id)]
+    run('update_booking', [lambda db, i=i, booking_id=booking_id: crud.update_booking(db, booking_id, booking(i, minutes=45))
+                           for i, booking_id in enumerate(booking_ids)])
+    run('delete_booking', [lambda db, booking_id=booking_id: crud.delete_booking(db, booking_id)
+                           for booking_id in booking_ids])
+    db = SessionLocal()
+    crud.create_bookings_batch(db, [booking(i, room_id=2) for i in range(repeat * 10)])
+    db.close()
+    window = lambda i: (base + datetime.timedelta(hours=10 * i), base + datetime.timedelta(hours=10 * (i + 1)))
+    run('update_bookings', [lambda db, i=i: crud.update_bookings(db, schemas.BookingBulkUpdate(booked_num=i % 4 + 2),
+                                                                 room_id=2, from_=window(i)[0], to=window(i)[1])
+                            for i in range(repeat)])
+    run('delete_bookings', [lambda db, i=i: crud.delete_bookings(db, room_id=2, from_=window(i)[0], to=window(i)[1])
+                            for i in range(repeat)])
+    run('create_recurring_booking', [lambda db, i=i: crud.create_recurring_booking(db, series(i))
+                                     for i in range(repeat)])
+    run('delete_recurring_booking', [lambda db, i=i: crud.delete_recurring_booking(db, i) for i in range(1, repeat + 1)])
+    run('delete_user', [lambda db, i=i: crud.delete_user(db, i) for i in ids])
+    run('delete_room', [lambda db, i=i: crud.delete_room(db, i) for i in ids])
+    return results
+
+
+def main(args):
+    # 使い捨て DB を作るため、main を import する前に一時ディレクトリへ移動する
+    sys.path.insert(0, os.path.abspath(SRC_DIR))
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        results = measure(args.repeat)
+    print(json.dumps(results, indent=2))
+    if args.check:
+        over = {name: result['statements'] for name, result in results.items()
+                if result['statements'] > MAX_STATEMENTS[name]}
+        if over:
+            print(f'statement count over limit: {over}', file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--check', action='store_true')
+    main(parser.parse_args())
@@ -0,0 +1,97 @@
+"""FAST_RESPONSES=0 と FAST_RESPONSES=1 の一覧レスポンス生成コストの比較
+
+使い方 (fastapi ディレクトリで実行、httpx が必要):
+    python bench/serialization.py --rows 10000 --repeat 20
+
+モードごとに子プロセスを起動し、一時ディレクトリの使い捨て DB に予約を --rows 件
+入れてから GET /bookings?limit=<rows> と GET /bookings/export を繰り返し取得する。
+1 リクエストあたりの時間 (中央値) と 1 行あたりの時間を JSON で出力し、
+両モードのレスポンス本文が同じ内容かも確認する。
+"""
+import argparse
+import datetime
+import hashlib
+import json
+import statistics
+import time
+
+import harness
+
+
+def seed(n_rows):
+    import models
+    from database import SessionLocal
+    from sqlalchemy import insert
+
+    base = datetime.datetime(2030, 1, 1, 9, 0)
+    db = SessionLocal()
+    try:
+        db.add(models.User(username='bench'))
+        db.add(models.Room(room_name='bench', capacity=10))
+        db.flush()
+        db.execute(insert(models.Booking), [{
+            'user_id': 1, 'room_id': 1, 'booked_num': 1,
+            'start_datetime': base + datetime.timedelta(minutes=30 * i),
+            'end_datetime': base + datetime.timedelta(minutes=30 * i + 30),
+        } for i in range(n_rows)])
+        db.commit()
+    finally:
+        db.close()
+
+
+async def run_workload(n_rows, repeat):
+    import httpx
+    import bootstrap, main
+
+    # 起動時の初期データは入れず、計測用の予約だけにする
+    bootstrap.run(seed=False)
+    seed(n_rows)
+    transport = httpx.ASGITransport(app=main.app)
+    paths = {'GET /bookings': f'/bookings?limit={n_rows}', 'GET /bookings/export': '/bookings/export'}
+    results = {}
+    async with httpx.AsyncClient(transport=transport, base_url='http://bench') as client:
+        for name, path in paths.items():
+            body = (await client.get(path)).content
+            timings = []
+            for _ in range(repeat):
+                t0 = time.perf_counter()
+                await client.get(path)
+                timings.append(time.perf_counter() - t0)
+            # export の NDJSON は区切りの空白が違うことがあるので、パースした内容で比べる
+            if name == 'GET /bookings':
+                parsed = json.loads(body)
+            else:
+                parsed = [json.loads(line) for line in body.splitlines()]
+            results[name] = {
+                'rows': n_rows,
+                'median_ms': round(statistics.median(timings) * 1000, 2),
+                'per_row_us': round(statistics.median(timings) / n_rows * 1e6, 2),
+                'bytes': len(body),
+                'digest': hashlib.sha256(json.dumps(parsed, sort_keys=True).encode()).hexdigest()[:16],
+            }
+    return results
+
+
+def child(args):
+    harness.run_child(run_workload, args.rows, args.repeat)
+
+
+def parent(args):
+    child_args = ['--rows', str(args.rows), '--repeat', str(args.repeat)]
+    results = {
+        f'FAST_RESPONSES={fast}': harness.run_in_child(__file__, child_args, {'FAST_RESPONSES': fast})
+        for fast in ('0', '1')
+    }
+    slow, fast = results['FAST_RESPONSES=0'], results['FAST_RESPONSES=1']
+    results['speedup'] = {name: round(slow[name]['median_ms'] / fast[name]['median_ms'], 2) for name in slow}
+    results['same_body'] = {name: slow[name]['digest'] == fast[name]['digest'] for name in slow}
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    child(args) if args.child else parent(args)
@@ -0,0 +1,145 @@
+"""同じ会議室・時間帯への予約を大量に同時投入し、二重予約が起きないことを確認する
+
+使い方 (fastapi ディレクトリで実行、httpx が必要):
+    python bench/stress_room_writes.py --requests 5000 --processes 4 --concurrency 50 --rooms 4
+
+一時ディレクトリの使い捨て DB を複数のワーカープロセスで共有し、各プロセスでアプリを
+プロセス内で動かして POST /bookings を同時に投げる。時間帯は少数の候補から選ぶので
+ほとんどのリクエストが競合する。終了後に bookings を自己結合して重複件数を数え、
+受付・拒否件数、スループットとともに JSON で出力する。
+重複が 1 件でもあるか、受け付けた件数が --min-accepted 未満か、200 / 409 以外の応答があれば終了コード 1。
+競合の判定を確かめるため、受付制御は切って実行する (混雑時の 503 は bench/admission_overload.py で測る)。
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+SRC_DIR = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+BASE = datetime.datetime(2030, 1, 1, 9, 0)
+
+
+async def fire(n_requests, concurrency, rooms, slots, seed):
+    import httpx
+    import database, main
+
+    database.init()
+    rnd = random.Random(seed)
+    status = {}
+    counter = iter(range(n_requests))
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url='http://stress', timeout=None) as client:
+        async def worker():
+            for _ in counter:
+                # 30 分単位の開始時刻と 30〜90 分の長さで、候補同士が部分的に重なるようにする
+                start = BASE + datetime.timedelta(minutes=30 * rnd.randrange(slots))
+                end = start + datetime.timedelta(minutes=30 * rnd.randint(1, 3))
+                res = await client.post('/bookings', json={
+                    'user_id': 1, 'room_id': rnd.randint(1, rooms), 'booked_num': 1,
+                    'start_datetime': start.isoformat(), 'end_datetime': end.isoformat(),
+                })
+                status[res.status_code] = status.get(res.status_code, 0) + 1
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return status
+
+
+def setup(rooms):
+    sys.path.insert(0, SRC_DIR)
+    import bootstrap, crud, database, schemas
+    bootstrap.run(seed=False)
+    db = database.SessionLocal()
+    try:
+        crud.create_user(db, schemas.UserCreate(username='stress'))
+        for i in range(rooms):
+            crud.create_room(db, schemas.RoomCreate(room_name=f'stress{i}', capacity=10))
+    finally:
+        db.close()
+
+
+def count_overlaps(path):
+    with sqlite3.connect(path) as conn:
+        return conn.execute(
+            'SELECT COUNT(*) FROM bookings a JOIN bookings b '
+            'ON a.room_id = b.room_id AND a.booking_id < b.booking_id '
+            'AND a.start_datetime < b.end_datetime AND b.start_datetime < a.end_datetime'
+        ).fetchone()[0]
+
+
+def worker_main(args):
+    sys.path.insert(0, SRC_DIR)
+    status = asyncio.run(fire(args.requests, args.concurrency, args.rooms, args.slots, args.seed))
+    print(json.dumps(status))
+
+
+def parent(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ, DB_MODE='async', BOOKING_CONFLICT_INDEX='db', ADMISSION_MAX_WRITES='0')
+        per_process = args.requests // args.processes
+        common = ['--requests', str(per_process), '--concurrency', str(args.concurrency),
+                  '--rooms', str(args.rooms), '--slots', str(args.slots)]
+        subprocess.run([sys.executable, os.path.abspath(__file__), '--setup'] + common,
+                       cwd=tmp, env=env, check=True)
+
+        t0 = time.perf_counter()
+        procs = [
+            subprocess.Popen([sys.executable, os.path.abspath(__file__), '--worker', '--seed', str(i)] + common,
+                             cwd=tmp, env=env, stdout=subprocess.PIPE, text=True)
+            for i in range(args.processes)
+        ]
+        status = {}
+        for proc in procs:
+            out, _ = proc.communicate()
+            if proc.returncode != 0:
+                raise SystemExit(proc.returncode)
+            for code, n in json.loads(out.strip().splitlines()[-1]).items():
+                status[code] = status.get(code, 0) + n
+        elapsed = time.perf_counter() - t0
+
+        overlaps = count_overlaps(os.path.join(tmp, 'sql_app.db'))
+
+    total = sum(status.values())
+    result = {
+        'requests': total,
+        'accepted': status.get('200', 0),
+        'rejected_conflict': status.get('409', 0),
+        'busy': status.get('503', 0),
+        'status_counts': status,
+        'elapsed_s': round(elapsed, 3),
+        'throughput_rps': round(total / elapsed, 1),
+        'overlaps': overlaps,
+    }
+    print(json.dumps(result, indent=2))
+    unexpected = total - result['accepted'] - result['rejected_conflict']
+    if overlaps or unexpected or result['accepted'] < args.min_accepted:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--rooms', type=int, default=4)
+    parser.add_argument('--slots', type=int, default=22, help='候補となる 30 分枠の数 (9:00〜20:00 なら 22)')
+    parser.add_argument('--min-accepted', type=int, default=None,
+                        help='受け付けるべき最小件数 (既定は会議室数。どの会議室も最初の 1 件は競合しない)')
+    parser.add_argument('--seed', type=int, default=0, help=argparse.SUPPRESS)
+    parser.add_argument('--setup', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.min_accepted is None:
+        args.min_accepted = args.rooms
+    if args.setup:
+        setup(args.rooms)
+    elif args.worker:
+        worker_main(args)
+    else:
+        parent(args)
@@ -0,0 +1,108 @@
+"""room_usage を追加する前の DB を起動したときに、既存の予約から利用実績の集計が作られることを確認する
+
+使い方 (fastapi ディレクトリで実行):
+    python bench/usage_backfill.py --bookings 200
+
+一時ディレクトリに room_usage がない頃のスキーマ (users, rooms, bookings だけ) の DB を作って予約を入れ、
+bootstrap.run で移行してから既存の予約を crud.delete_booking で全件削除する。
+移行直後の集計が予約の合計と一致しない場合、削除後に負の値や 0 でない集計が残った場合、
+利用実績 API が負の値を返した場合は終了コード 1。
+"""
+import argparse
+import datetime
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+BASE = datetime.datetime(2024, 6, 17, 9, 0)
+
+# room_usage などを追加する前のスキーマ
+OLD_SCHEMA = '''
+CREATE TABLE users (user_id INTEGER NOT NULL, username VARCHAR, PRIMARY KEY (user_id));
+CREATE TABLE rooms (room_id INTEGER NOT NULL, room_name VARCHAR, capacity INTEGER, PRIMARY KEY (room_id));
+CREATE TABLE bookings (
+    booking_id INTEGER NOT NULL, user_id INTEGER NOT NULL, room_id INTEGER NOT NULL, booked_num INTEGER,
+    start_datetime DATETIME NOT NULL, end_datetime DATETIME NOT NULL, PRIMARY KEY (booking_id),
+    FOREIGN KEY(user_id) REFERENCES users (user_id) ON DELETE SET NULL,
+    FOREIGN KEY(room_id) REFERENCES rooms (room_id) ON DELETE SET NULL
+);
+'''
+
+
+def create_old_db(path, n_bookings, rooms, seed):
+    rnd = random.Random(seed)
+    with sqlite3.connect(path) as conn:
+        conn.executescript(OLD_SCHEMA)
+        conn.execute("INSERT INTO users (user_id, username) VALUES (1, 'old')")
+        conn.executemany('INSERT INTO rooms (room_id, room_name, capacity) VALUES (?, ?, 10)',
+                         [(i, f'old{i}') for i in range(1, rooms + 1)])
+        rows = []
+        for booking_id in range(1, n_bookings + 1):
+            # 日・時間帯をまたぐ予約も含める (重複チェックは移行の確認には関係しない)
+            start = BASE + datetime.timedelta(minutes=30 * rnd.randrange(24 * 2 * 14))
+            end = start + datetime.timedelta(minutes=30 * rnd.randint(1, 8))
+            rows.append((booking_id, 1, rnd.randint(1, rooms), rnd.randint(1, 10),
+                         start.isoformat(' '), end.isoformat(' ')))
+        conn.executemany('INSERT INTO bookings VALUES (?, ?, ?, ?, ?, ?)', rows)
+    return rows
+
+
+def main(args):
+    sys.path.insert(0, os.path.abspath(SRC_DIR))
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        rows = create_old_db(os.path.join(tmp, 'sql_app.db'), args.bookings, args.rooms, args.seed)
+        expected = sum(
+            (datetime.datetime.fromisoformat(end) - datetime.datetime.fromisoformat(start)).total_seconds()
+            for _, _, _, _, start, end in rows
+        )
+
+        import bootstrap, crud, database
+        bootstrap.run(seed=False)
+
+        def usage():
+            with sqlite3.connect(os.path.join(tmp, 'sql_app.db')) as conn:
+                return conn.execute(
+                    "SELECT COALESCE(SUM(booked_seconds), 0), COALESCE(MIN(booked_seconds), 0), "
+                    "COALESCE(MIN(seat_seconds), 0), COUNT(*) FROM room_usage WHERE granularity = 'day'"
+                ).fetchone()
+
+        backfilled = usage()[0]
+        db = database.SessionLocal()
+        negative_api = 0
+        try:
+            for booking_id, *_ in rows:
+                crud.delete_booking(db, booking_id)
+            for room_id in range(1, args.rooms + 1):
+                for bucket in crud.get_utilization(db, BASE - datetime.timedelta(days=1),
+                                                   BASE + datetime.timedelta(days=16), 'day', room_id):
+                    if bucket.booked_minutes < 0 or bucket.utilization < 0:
+                        negative_api += 1
+        finally:
+            db.close()
+        remaining, min_booked, min_seats, _ = usage()
+
+    result = {
+        'bookings': len(rows),
+        'expected_booked_seconds': expected,
+        'backfilled_booked_seconds': backfilled,
+        'remaining_booked_seconds_after_delete': remaining,
+        'min_booked_seconds_after_delete': min_booked,
+        'min_seat_seconds_after_delete': min_seats,
+        'negative_utilization_buckets': negative_api,
+    }
+    print(json.dumps(result, indent=2))
+    if backfilled != expected or remaining != 0 or min_booked < 0 or min_seats < 0 or negative_api:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--bookings', type=int, default=200)
+    parser.add_argument('--rooms', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=0)
+    main(parser.parse_args())
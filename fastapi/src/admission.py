@@ -0,0 +1,170 @@
+import asyncio
+import math
+import os
+import time
+from collections import OrderedDict, deque
+
+from fastapi import Request
+from fastapi.responses import JSONResponse
+
+import metrics
+
+# 書き込み (POST / PUT / PATCH / DELETE) を同時に実行する件数 (0 なら制限しない。既定は制限しない)
+# SQLite の書き込みは 1 つずつなので、超えた分は DB のロック待ちではなくここで順番に待たせる
+# 待ち行列と待つ秒数は、実際の書き込みのスループットで捌ける量に合わせて指定する
+# (小さすぎると、DB がまだ処理できる書き込みまで 503 で断る)
+ADMISSION_MAX_WRITES = int(os.environ.get('ADMISSION_MAX_WRITES', '0'))
+# 読み込みも含めて同時に実行する件数 (0 なら制限しない)
+# 書き込みはこのうち ADMISSION_MAX_WRITES 件までしか使わないので、残りは読み込み用に空く
+ADMISSION_MAX_REQUESTS = int(os.environ.get('ADMISSION_MAX_REQUESTS', '0'))
+# 空きを待たせる件数の上限 (超えたら待たせずに 503 を返す)
+ADMISSION_QUEUE_SIZE = int(os.environ.get('ADMISSION_QUEUE_SIZE', '32'))
+# 空きを待つ最大秒数 (超えたら 503 を返す)。混雑時もレイテンシがこの時間を大きく超えないようにする
+# 既定は SQLITE_BUSY_TIMEOUT_MS の既定と同じ 5 秒 (DB のロック待ちより先に断らない)
+ADMISSION_QUEUE_TIMEOUT_SECONDS = float(os.environ.get('ADMISSION_QUEUE_TIMEOUT_SECONDS', '5'))
+# 503 の Retry-After (秒)
+ADMISSION_RETRY_AFTER_SECONDS = int(os.environ.get('ADMISSION_RETRY_AFTER_SECONDS', '1'))
+# クライアントごとの書き込みの上限 (1 秒あたりの件数、0 なら制限しない) と、まとめて受け付ける件数
+# 超えたら 429 を返す
+ADMISSION_RATE_PER_SECOND = float(os.environ.get('ADMISSION_RATE_PER_SECOND', '0'))
+ADMISSION_RATE_BURST = int(os.environ.get('ADMISSION_RATE_BURST', '20'))
+# クライアントを区別するヘッダー (指定がなければ接続元の IP アドレス)
+ADMISSION_CLIENT_HEADER = os.environ.get('ADMISSION_CLIENT_HEADER', '')
+# 記録するクライアントの数の上限 (超えたら最も古いものから捨てる)
+ADMISSION_MAX_CLIENTS = 10000
+
+WRITE_METHODS = ('POST', 'PUT', 'PATCH', 'DELETE')
+# 制限しないパス (長時間つながる /events と、混雑時にも見たい /metrics)
+EXEMPT_PATHS = ('/events', '/metrics')
+
+
+class Limiter:
+    """同時に実行する件数を limit 件までにし、超えた分は queue_size 件まで到着順に待たせる
+
+    空いた枠は release で待っている先頭のリクエストにそのまま渡す。
+    ワーカープロセスごとに持つ。
+    """
+
+    def __init__(self, kind: str, limit: int, queue_size: int):
+        self.kind = kind
+        self.limit = limit
+        self.queue_size = queue_size
+        self.active = 0
+        self._waiters = deque()
+
+    def _report(self):
+        metrics.ADMISSION_IN_FLIGHT.set(self.active, self.kind)
+        metrics.ADMISSION_QUEUE_DEPTH.set(len(self._waiters), self.kind)
+
+    # 枠を取る。待ち行列が一杯なら "queue_full"、timeout 秒待っても空かなければ "queue_timeout" を返す
+    async def acquire(self, timeout: float):
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            self._report()
+            return None
+        if len(self._waiters) >= self.queue_size:
+            return 'queue_full'
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        self._report()
+        t0 = time.perf_counter()
+        try:
+            # wait_for と違い、タイムアウトと枠の受け渡しが重なっても枠を失わない
+            await asyncio.wait({waiter}, timeout=timeout)
+        except BaseException:
+            # クライアントの切断などで待つのをやめた (受け取った枠は返す)
+            if waiter.done():
+                self.release()
+            else:
+                self._waiters.remove(waiter)
+                self._report()
+            raise
+        metrics.ADMISSION_WAIT.observe(time.perf_counter() - t0, self.kind)
+        if waiter.done():
+            return None
+        self._waiters.remove(waiter)
+        self._report()
+        return 'queue_timeout'
+
+    def release(self):
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                # active は減らさずに枠を渡す
+                waiter.set_result(None)
+                self._report()
+                return
+        self.active -= 1
+        self._report()
+
+
+class TokenBuckets:
+    """クライアントごとのトークンバケット (1 秒に rate 個増え、burst 個までためられる)"""
+
+    def __init__(self, rate: float, burst: int, max_clients: int = ADMISSION_MAX_CLIENTS):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self._buckets = OrderedDict()
+
+    # 1 個取れれば 0、取れなければ次の 1 個がたまるまでの秒数を返す
+    def take(self, client: str) -> float:
+        now = time.monotonic()
+        tokens, updated = self._buckets.pop(client, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        wait = 0.0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            wait = (1 - tokens) / self.rate
+        self._buckets[client] = (tokens, now)
+        while len(self._buckets) > self.max_clients:
+            self._buckets.popitem(last=False)
+        return wait
+
+
+writes = Limiter('write', ADMISSION_MAX_WRITES, ADMISSION_QUEUE_SIZE) if ADMISSION_MAX_WRITES > 0 else None
+all_requests = Limiter('all', ADMISSION_MAX_REQUESTS, ADMISSION_QUEUE_SIZE) if ADMISSION_MAX_REQUESTS > 0 else None
+buckets = TokenBuckets(ADMISSION_RATE_PER_SECOND, ADMISSION_RATE_BURST) if ADMISSION_RATE_PER_SECOND > 0 else None
+
+
+def _client(request: Request) -> str:
+    if ADMISSION_CLIENT_HEADER:
+        value = request.headers.get(ADMISSION_CLIENT_HEADER)
+        if value:
+            return value
+    return request.client.host if request.client else ''
+
+
+def _reject(status_code: int, kind: str, reason: str, retry_after: float) -> JSONResponse:
+    metrics.ADMISSION_REJECTIONS.inc(kind, reason)
+    detail = 'Too many requests' if status_code == 429 else 'Server is busy'
+    return JSONResponse(status_code=status_code, content={'detail': detail},
+                        headers={'Retry-After': str(max(1, math.ceil(retry_after)))})
+
+
+# HTTP ミドルウェアの本体
+# 書き込みはクライアントごとの上限 (429) を確かめてから書き込みの枠を取り、全体の枠を取る
+# 枠が取れなければ待たせずに (または待たせた後で) 503 を返すので、混雑時もすぐに返る
+# 枠はレスポンスのヘッダーを返すまで持つ (トランザクションはそれまでに終わっている)
+async def handle(request: Request, call_next):
+    if request.url.path in EXEMPT_PATHS:
+        return await call_next(request)
+    write = request.method in WRITE_METHODS
+    held = []
+    try:
+        if write and buckets is not None:
+            wait = buckets.take(_client(request))
+            if wait:
+                return _reject(429, 'write', 'rate_limited', wait)
+        for limiter in ((writes, all_requests) if write else (all_requests,)):
+            if limiter is None:
+                continue
+            reason = await limiter.acquire(ADMISSION_QUEUE_TIMEOUT_SECONDS)
+            if reason is not None:
+                return _reject(503, limiter.kind, reason, ADMISSION_RETRY_AFTER_SECONDS)
+            held.append(limiter)
+        return await call_next(request)
+    finally:
+        for limiter in reversed(held):
+            limiter.release()
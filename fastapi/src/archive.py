@@ -0,0 +1,109 @@
+import argparse
+import asyncio
+import datetime
+import logging
+import os
+
+from sqlalchemy import delete, insert, select
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.orm import Session
+
+import conflicts, events, models
+
+logger = logging.getLogger('uvicorn.error')
+
+# 終了からこの日数たった予約を bookings_archive に移す
+ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS', '90'))
+# 1 トランザクションで移す件数
+ARCHIVE_BATCH_SIZE = int(os.environ.get('ARCHIVE_BATCH_SIZE', '1000'))
+# アプリ内で定期的に移す間隔 (秒)。0 なら実行しない (CLI で実行する)
+ARCHIVE_INTERVAL_SECONDS = int(os.environ.get('ARCHIVE_INTERVAL_SECONDS', '0'))
+
+COLUMNS = ('booking_id', 'user_id', 'room_id', 'booked_num', 'start_datetime', 'end_datetime')
+
+
+def cutoff(days: int = ARCHIVE_AFTER_DAYS) -> datetime.datetime:
+    return datetime.datetime.now() - datetime.timedelta(days=days)
+
+
+# before より前に終わった予約を最大 batch_size 件移し、移した件数を返す
+# 開始時刻のインデックスで古いものから選ぶ (before より前に終わる予約は before より前に始まる)
+def archive_batch(db: Session, before: datetime.datetime, batch_size: int = ARCHIVE_BATCH_SIZE) -> int:
+    rows = db.execute(
+        select(*(getattr(models.Booking, name) for name in COLUMNS)).
+        where(models.Booking.start_datetime < before).
+        where(models.Booking.end_datetime < before).
+        order_by(models.Booking.start_datetime).
+        limit(batch_size)
+    ).all()
+    if not rows:
+        return 0
+    booking_ids = [row.booking_id for row in rows]
+    db.execute(insert(models.BookingArchive), [row._asdict() for row in rows])
+    db.execute(delete(models.Booking).where(models.Booking.booking_id.in_(booking_ids)))
+    # 一覧 (include_archived なし) から消えるので、変更イベントを送る
+    events.record(db, *(('booking', 'archive', row) for row in rows))
+    db.commit()
+    # 保管した予約は重複チェックで bookings_archive も見るので、メモリのインデックスからは外す
+    for booking_id in booking_ids:
+        conflicts.booking_deleted(booking_id)
+    return len(booking_ids)
+
+
+# 移す対象がなくなるまでバッチを繰り返す
+# 別のプロセスと同時に実行して同じ予約を移そうとした場合は、そのバッチだけやり直す
+def archive_old_bookings(db: Session, days: int = ARCHIVE_AFTER_DAYS, batch_size: int = ARCHIVE_BATCH_SIZE) -> int:
+    before = cutoff(days)
+    total = 0
+    failures = 0
+    while True:
+        try:
+            moved = archive_batch(db, before, batch_size)
+        except (IntegrityError, OperationalError) as exc:
+            db.rollback()
+            failures += 1
+            if failures >= conflicts.ROOM_WRITE_RETRIES or \
+                    (isinstance(exc, OperationalError) and not conflicts.is_retryable(exc)):
+                raise
+            continue
+        failures = 0
+        if moved == 0:
+            return total
+        total += moved
+
+
+# アプリ内で ARCHIVE_INTERVAL_SECONDS ごとに実行する (DB の処理はスレッドで行う)
+async def run_periodically(session_factory):
+    def run_once():
+        db = session_factory()
+        try:
+            return archive_old_bookings(db)
+        finally:
+            db.close()
+
+    while True:
+        await asyncio.sleep(ARCHIVE_INTERVAL_SECONDS)
+        try:
+            moved = await asyncio.to_thread(run_once)
+        except Exception:
+            logger.exception('booking archive failed')
+            continue
+        if moved:
+            logger.info('archived %d bookings ended before %s', moved, cutoff())
+
+
+if __name__ == '__main__':
+    # 使い方 (src ディレクトリで実行): python archive.py --days 90
+    parser = argparse.ArgumentParser(description='終了から一定期間たった予約を bookings_archive に移す')
+    parser.add_argument('--days', type=int, default=ARCHIVE_AFTER_DAYS)
+    parser.add_argument('--batch-size', type=int, default=ARCHIVE_BATCH_SIZE)
+    args = parser.parse_args()
+
+    import bootstrap
+    from database import SessionLocal
+    bootstrap.run(seed=False)
+    session = SessionLocal()
+    try:
+        print(f'archived {archive_old_bookings(session, args.days, args.batch_size)} bookings')
+    finally:
+        session.close()
@@ -0,0 +1,39 @@
+import datetime
+
+# 会議室の利用可能時間
+OPEN_TIME = datetime.time(hour=9, minute=0)
+CLOSE_TIME = datetime.time(hour=20, minute=0)
+
+
+# [start, end) を日ごとの利用可能時間 (9:00〜20:00) に切り分ける
+def operating_windows(start, end):
+    windows = []
+    day = start.date()
+    while day <= end.date():
+        window_start = max(start, datetime.datetime.combine(day, OPEN_TIME))
+        window_end = min(end, datetime.datetime.combine(day, CLOSE_TIME))
+        if window_start < window_end:
+            windows.append((window_start, window_end))
+        day += datetime.timedelta(days=1)
+    return windows
+
+
+# 開始時刻順に並んだ予約済み区間 busy を利用可能時間 windows から除き、
+# min_length 以上の空き区間だけを返す (スイープライン)
+def free_intervals(busy, windows, min_length):
+    free = []
+    i = 0
+    for window_start, window_end in windows:
+        cursor = window_start
+        # この利用可能時間より前に終わる予約は読み飛ばす
+        while i < len(busy) and busy[i][1] <= window_start:
+            i += 1
+        j = i
+        while j < len(busy) and busy[j][0] < window_end:
+            if busy[j][0] - cursor >= min_length:
+                free.append((cursor, busy[j][0]))
+            cursor = max(cursor, busy[j][1])
+            j += 1
+        if window_end - cursor >= min_length:
+            free.append((cursor, window_end))
+    return free
@@ -0,0 +1,130 @@
+import contextlib
+import logging
+import os
+import tempfile
+
+from sqlalchemy import exists, select
+
+import crud, database, models, rollups
+
+logger = logging.getLogger('uvicorn.error')
+
+# "1" の場合はアプリの起動時 (各ワーカーの lifespan) にも実行する
+# 起動前に python bootstrap.py を 1 回実行する場合は "0" にして起動を速くする
+BOOTSTRAP_ON_STARTUP = os.environ.get('BOOTSTRAP_ON_STARTUP', '1') == '1'
+# プロセス間で排他するロックファイル (PostgreSQL は DB のアドバイザリーロックを使う)
+# 指定がなければ SQLite のファイルの隣 (作れなければ一時ディレクトリ) に作る
+BOOTSTRAP_LOCK_FILE = os.environ.get('BOOTSTRAP_LOCK_FILE')
+# PostgreSQL の pg_advisory_lock のキー
+ADVISORY_LOCK_KEY = 7243100
+
+
+def _lock_file_path(engine) -> str:
+    if BOOTSTRAP_LOCK_FILE:
+        return BOOTSTRAP_LOCK_FILE
+    url = engine.url
+    if url.get_backend_name() == 'sqlite' and url.database and url.database != ':memory:':
+        return url.database + '.bootstrap.lock'
+    return os.path.join(tempfile.gettempdir(), 'fastapi-bootstrap.lock')
+
+
+# 複数のワーカー・コンテナが同時に起動しても、テーブル作成と初期データの登録は 1 つずつ実行する
+@contextlib.contextmanager
+def _exclusive(engine):
+    if engine.dialect.name == 'postgresql':
+        with engine.connect() as conn:
+            conn.exec_driver_sql(f'SELECT pg_advisory_lock({ADVISORY_LOCK_KEY})')
+            try:
+                yield
+            finally:
+                conn.exec_driver_sql(f'SELECT pg_advisory_unlock({ADVISORY_LOCK_KEY})')
+        return
+    try:
+        import fcntl
+    except ImportError:  # fcntl がない (Windows) 場合は排他しない
+        yield
+        return
+    try:
+        lock_file = open(_lock_file_path(engine), 'a')
+    except OSError:
+        lock_file = open(os.path.join(tempfile.gettempdir(), 'fastapi-bootstrap.lock'), 'a')
+    with lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+# 以前の版で作った SQLite の bookings は AUTOINCREMENT なしなので、最大の booking_id の予約を
+# 削除・保管するとその ID が再利用される。テーブルを作り直して AUTOINCREMENT にし、
+# 採番は bookings_archive も含めた最大の ID の次から始める
+def _migrate_booking_autoincrement(engine):
+    if engine.dialect.name != 'sqlite':
+        return
+    table = models.Booking.__table__
+    with engine.begin() as conn:
+        sql = conn.exec_driver_sql(
+            "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'bookings'"
+        ).scalar()
+        if sql is None or 'AUTOINCREMENT' in sql.upper():
+            return
+        logger.info('rebuilding bookings with AUTOINCREMENT')
+        conn.exec_driver_sql('ALTER TABLE bookings RENAME TO bookings_old')
+        # インデックスは名前を変えずに bookings_old に残るので、作り直す前に消す
+        for index in table.indexes:
+            conn.exec_driver_sql(f'DROP INDEX IF EXISTS {index.name}')
+        table.create(conn)
+        columns = ', '.join(column.name for column in table.columns)
+        conn.exec_driver_sql(f'INSERT INTO bookings ({columns}) SELECT {columns} FROM bookings_old')
+        conn.exec_driver_sql('DROP TABLE bookings_old')
+        max_id = conn.exec_driver_sql(
+            'SELECT MAX(booking_id) FROM (SELECT booking_id FROM bookings UNION ALL SELECT booking_id FROM bookings_archive)'
+        ).scalar()
+        if max_id is not None:
+            conn.exec_driver_sql("DELETE FROM sqlite_sequence WHERE name = 'bookings'")
+            conn.exec_driver_sql("INSERT INTO sqlite_sequence (name, seq) VALUES ('bookings', ?)", (max_id,))
+
+
+# テーブルと、既存の DB に後から追加したインデックスを作成する
+def create_schema(engine):
+    models.Base.metadata.create_all(bind=engine)
+    _migrate_booking_autoincrement(engine)
+    for table in models.Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
+
+
+# room_usage を追加する前の DB には予約があっても集計がないので、既存の予約から作る
+# (集計がないまま予約を削除すると、利用実績が負の値になる)
+def backfill_room_usage(db):
+    if db.scalar(select(
+        ~exists(select(models.RoomUsage.room_id)) & (
+            exists(select(models.Booking.booking_id)) |
+            exists(select(models.BookingArchive.booking_id)) |
+            exists(select(models.RecurringBooking.recurring_id))
+        )
+    )):
+        logger.info('backfilled room usage from %d bookings', rollups.backfill(db))
+
+
+# このプロセスのエンジンを用意し、テーブル作成と初期データの登録を行う (済んでいれば何もしない)
+# seed=False の場合は初期データを登録しない (ベンチマークや CLI 用)
+def run(seed: bool = True):
+    engine = database.init()
+    with _exclusive(engine):
+        create_schema(engine)
+        db = database.SessionLocal()
+        try:
+            backfill_room_usage(db)
+            if seed:
+                crud.initialize_data(db)
+        finally:
+            db.close()
+
+
+if __name__ == '__main__':
+    # 使い方 (src ディレクトリで実行): python bootstrap.py
+    logging.basicConfig(level=logging.INFO)
+    run()
+    logger.info('bootstrap finished')
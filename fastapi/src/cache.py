@@ -0,0 +1,134 @@
+import base64
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+
+# 一覧レスポンスのキャッシュ
+# "memory": プロセス内 (LRU + TTL) / "redis://...": 複数ワーカーで共有する
+CACHE_URL = os.environ.get('CACHE_URL', 'memory')
+CACHE_TTL_SECONDS = int(os.environ.get('CACHE_TTL_SECONDS', '300'))
+CACHE_MAX_ENTRIES = int(os.environ.get('CACHE_MAX_ENTRIES', '1024'))
+
+# キャッシュするパスとその名前空間
+# 名前空間ごとに世代番号を持ち、書き込み時に世代を進めて古いエントリーをまとめて無効にする
+CACHED_PATHS = {
+    '/users': 'users',
+    '/rooms': 'rooms',
+}
+
+
+class MemoryBackend:
+    """プロセス内のキャッシュ (件数上限を超えたら最も使われていないものから捨てる)"""
+
+    def __init__(self, max_entries: int, ttl: int):
+        self._entries = OrderedDict()
+        self._generations = {}
+        self._max_entries = max_entries
+        self._ttl = ttl
+
+    async def generation(self, namespace: str) -> int:
+        return self._generations.get(namespace, 0)
+
+    async def bump(self, namespace: str):
+        self._generations[namespace] = self._generations.get(namespace, 0) + 1
+
+    async def get(self, key: str):
+        found = self._entries.get(key)
+        if found is None:
+            return None
+        expires, value = found
+        if expires < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    async def set(self, key: str, value: dict, ttl: int = None):
+        self._entries[key] = (time.monotonic() + (ttl or self._ttl), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+
+    # まだなければ保存して True を返す
+    async def add(self, key: str, value: dict, ttl: int = None) -> bool:
+        if await self.get(key) is not None:
+            return False
+        await self.set(key, value, ttl)
+        return True
+
+    async def delete(self, key: str):
+        self._entries.pop(key, None)
+
+
+class RedisBackend:
+    """Redis を使う共有キャッシュ (redis パッケージが必要)"""
+
+    def __init__(self, url: str, ttl: int):
+        import redis.asyncio
+        self._redis = redis.asyncio.from_url(url)
+        self._ttl = ttl
+
+    async def generation(self, namespace: str) -> int:
+        return int(await self._redis.get(f'cache:gen:{namespace}') or 0)
+
+    async def bump(self, namespace: str):
+        await self._redis.incr(f'cache:gen:{namespace}')
+
+    async def get(self, key: str):
+        raw = await self._redis.get(f'cache:entry:{key}')
+        if raw is None:
+            return None
+        value = json.loads(raw)
+        value['body'] = base64.b64decode(value['body'])
+        return value
+
+    @staticmethod
+    def _dumps(value: dict) -> str:
+        return json.dumps(dict(value, body=base64.b64encode(value['body']).decode()))
+
+    async def set(self, key: str, value: dict, ttl: int = None):
+        await self._redis.set(f'cache:entry:{key}', self._dumps(value), ex=ttl or self._ttl)
+
+    async def add(self, key: str, value: dict, ttl: int = None) -> bool:
+        return bool(await self._redis.set(f'cache:entry:{key}', self._dumps(value), ex=ttl or self._ttl, nx=True))
+
+    async def delete(self, key: str):
+        await self._redis.delete(f'cache:entry:{key}')
+
+
+def make_backend(url: str = CACHE_URL, max_entries: int = CACHE_MAX_ENTRIES, ttl: int = CACHE_TTL_SECONDS):
+    if url == 'memory':
+        return MemoryBackend(max_entries, ttl)
+    if url.startswith(('redis://', 'rediss://')):
+        return RedisBackend(url, ttl)
+    raise ValueError(f'unsupported backend URL: {url!r}')
+
+
+_backend = None
+
+
+# このプロセスのバックエンド (lifespan の開始時に作る。それより前に使われた場合はその時に作る)
+def get_backend():
+    global _backend
+    if _backend is None:
+        _backend = make_backend()
+    return _backend
+
+
+def make_etag(body: bytes) -> str:
+    return '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+
+# If-None-Match が ETag と一致するか
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in candidates or etag in candidates or f'W/{etag}' in candidates
+
+
+# 書き込み後に呼び、その名前空間のキャッシュを無効にする
+async def invalidate(namespace: str):
+    await get_backend().bump(namespace)
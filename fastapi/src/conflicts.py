@@ -0,0 +1,344 @@
+import datetime
+import os
+import threading
+from bisect import bisect_left, insort
+from collections import namedtuple
+
+from sqlalchemy import exists, insert, select
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.orm import Session, aliased
+
+import models, recurrence
+
+# "db": 複合インデックスに対する LIMIT 1 の検索のみ
+# "memory": 会議室ごとの区間インデックスをメモリに保持して検索する (単一プロセス運用向け)
+CONFLICT_INDEX = os.environ.get('BOOKING_CONFLICT_INDEX', 'db')
+# 会議室のバージョンが競合したときの再試行回数
+ROOM_WRITE_RETRIES = int(os.environ.get('ROOM_WRITE_RETRIES', '10'))
+
+
+# 再試行すればよい PostgreSQL の SQLSTATE (直列化の失敗・デッドロック・ロックを取れなかった)
+RETRYABLE_SQLSTATES = ('40001', '40P01', '55P03')
+# 再試行すればよい SQLite のエラーコード (SQLITE_BUSY / SQLITE_LOCKED)
+RETRYABLE_SQLITE_CODES = (5, 6)
+
+
+class StaleRoomVersion(Exception):
+    """重複チェックの後に同じ会議室へ別の書き込みがコミットされた"""
+
+
+# OperationalError がロック待ちによるもので、やり直せば成功し得るか
+# SQL やスキーマの誤りなどはやり直しても失敗するので False
+def is_retryable(exc: OperationalError) -> bool:
+    orig = exc.orig
+    # psycopg2 は pgcode、asyncpg は sqlstate
+    sqlstate = getattr(orig, 'pgcode', None) or getattr(orig, 'sqlstate', None)
+    if sqlstate is not None:
+        return sqlstate in RETRYABLE_SQLSTATES
+    # sqlite3 (Python 3.11 以降) は拡張エラーコード、それより前はメッセージで判定する
+    code = getattr(orig, 'sqlite_errorcode', None)
+    if code is not None:
+        return code & 0xff in RETRYABLE_SQLITE_CODES
+    message = str(orig)
+    return 'database is locked' in message or 'database table is locked' in message
+
+
+class RoomIntervalIndex:
+    """会議室ごとの予約区間を開始時刻順に保持するインデックス
+
+    同じ会議室の予約は重ならないため、新しい区間 [start, end) と重なり得るのは
+    end より前に始まる予約のうち最も開始が遅いものだけになる。
+    そのため二分探索 1 回 (O(log n)) で重複を判定できる。
+    会議室ごとの区間は最初に参照されたときに DB から読み込む。
+    読み込みの途中でその会議室の予約が追加・削除された場合は、読んだ区間が古い可能性があるので
+    その回の判定にだけ使い、保持せずに次の参照で読み直す。
+    """
+
+    def __init__(self):
+        self._rooms = {}
+        self._bookings = {}
+        # 読み込み中の会議室ごとの [読み込み中の件数, 読み込み中に変更があったか]
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    def _entries(self, db: Session, room_id: int):
+        with self._lock:
+            entries = self._rooms.get(room_id)
+            if entries is not None:
+                return entries
+            loading = self._loading.setdefault(room_id, [0, False])
+            loading[0] += 1
+        # DB の読み込み中はロックを持たない (AsyncSession.run_sync ではクエリ中に他の処理へ切り替わるため)
+        try:
+            rows = db.query(models.Booking.start_datetime, models.Booking.end_datetime, models.Booking.booking_id).\
+                filter(models.Booking.room_id == room_id).\
+                order_by(models.Booking.start_datetime).\
+                all()
+        finally:
+            with self._lock:
+                loading[0] -= 1
+                if loading[0] == 0:
+                    del self._loading[room_id]
+        with self._lock:
+            entries = self._rooms.get(room_id)
+            if entries is not None:
+                return entries
+            entries = [tuple(row) for row in rows]
+            if not loading[1]:
+                self._rooms[room_id] = entries
+                for entry in entries:
+                    self._bookings[entry[2]] = (room_id, entry)
+            return entries
+
+    # 読み込み中の会議室に変更があったことを記録する (room_id が None なら読み込み中のすべての会議室)
+    def _mark_loading(self, room_id=None):
+        for loading_room_id, loading in self._loading.items():
+            if room_id is None or loading_room_id == room_id:
+                loading[1] = True
+
+    def has_overlap(self, db: Session, room_id: int, start, end, exclude_booking_id: int = None):
+        entries = self._entries(db, room_id)
+        with self._lock:
+            # end より前に始まる予約の中で最も開始が遅いもの
+            i = bisect_left(entries, (end,)) - 1
+            while i >= 0 and entries[i][2] == exclude_booking_id:
+                i -= 1
+            return i >= 0 and entries[i][1] > start
+
+    def add(self, booking: models.Booking):
+        with self._lock:
+            if not self._discard(booking.booking_id):
+                # 読み込んでいない会議室から移した予約かもしれない
+                self._mark_loading()
+            entries = self._rooms.get(booking.room_id)
+            if entries is None:
+                # まだ読み込んでいない会議室は次回参照時に DB から読み込む
+                self._mark_loading(booking.room_id)
+                return
+            entry = (booking.start_datetime, booking.end_datetime, booking.booking_id)
+            insort(entries, entry)
+            self._bookings[booking.booking_id] = (booking.room_id, entry)
+
+    def remove(self, booking_id: int):
+        with self._lock:
+            if not self._discard(booking_id):
+                # 読み込んでいない会議室の予約は、どの会議室のものかわからない
+                self._mark_loading()
+
+    def clear(self):
+        with self._lock:
+            self._rooms.clear()
+            self._bookings.clear()
+            self._mark_loading()
+
+    # 保持している予約を取り除く (保持していなければ False)
+    def _discard(self, booking_id: int) -> bool:
+        found = self._bookings.pop(booking_id, None)
+        if found is None:
+            return False
+        room_id, entry = found
+        entries = self._rooms.get(room_id)
+        if entries is not None:
+            i = bisect_left(entries, entry)
+            if i < len(entries) and entries[i] == entry:
+                del entries[i]
+        return True
+
+
+interval_index = RoomIntervalIndex()
+
+
+# room_id の会議室で end より前に始まる予約のうち開始が最も遅いものの終了時刻 (スカラーサブクエリ)
+# 同じ会議室の予約は重ならないので、これが start より後なら [start, end) と重なる予約がある
+# (room_id, start_datetime, end_datetime) の複合インデックスを逆順に 1 件だけ引く
+# room_id に Room.room_id を渡すと、会議室ごとの相関サブクエリになる
+def latest_end(model, room_id, end, exclude_booking_id: int = None):
+    query = select(model.end_datetime).\
+        where(model.room_id == room_id).\
+        where(model.start_datetime < end)
+    if exclude_booking_id is not None:
+        query = query.where(model.booking_id != exclude_booking_id)
+    return query.order_by(model.start_datetime.desc()).limit(1).scalar_subquery()
+
+
+# 期間 [start, end) と重なり得る繰り返し予約のシリーズの条件
+def _series_window(start, end):
+    return (models.RecurringBooking.start_datetime < end,
+            models.RecurringBooking.until >= start.date())
+
+
+# room_id の会議室に期間 [start, end) と重なり得るシリーズがあるか (EXISTS)
+def series_exist(room_id, start, end):
+    return exists(select(models.RecurringBooking.recurring_id).
+                  where(models.RecurringBooking.room_id == room_id).
+                  where(*_series_window(start, end)))
+
+
+# 指定の会議室 (None なら全会議室)・期間と重なり得る繰り返し予約のシリーズ
+def recurring_candidates(db: Session, room_ids, start, end, exclude_recurring_id: int = None):
+    query = db.query(models.RecurringBooking).filter(*_series_window(start, end))
+    if room_ids is not None:
+        query = query.filter(models.RecurringBooking.room_id.in_(room_ids))
+    if exclude_recurring_id is not None:
+        query = query.filter(models.RecurringBooking.recurring_id != exclude_recurring_id)
+    return query.all()
+
+
+# シリーズのいずれかの回が [start, end) と重なるか (その期間内の回だけを展開する)
+def series_overlaps(series_list, start, end) -> bool:
+    return any(next(recurrence.occurrences(series, start, end), None) is not None for series in series_list)
+
+
+# 指定の会議室の [start, end) と重なる単発の予約の区間を、開始時刻順に 1 回の範囲検索で読む
+# 過去に始まる期間のときは保管済みの予約も読む
+def booking_intervals(db: Session, room_id: int, start, end):
+    models_to_read = [models.Booking]
+    if start < datetime.datetime.now():
+        models_to_read.append(models.BookingArchive)
+    intervals = []
+    for model in models_to_read:
+        intervals.extend(tuple(row) for row in db.query(model.start_datetime, model.end_datetime).
+                         filter(model.room_id == room_id).
+                         filter(model.start_datetime < end).
+                         filter(model.end_datetime > start))
+    return sorted(intervals)
+
+
+# 開始時刻順に並んだ重ならない区間 intervals のいずれかが、開始時刻順の区間 busy のいずれかと重なるか
+# busy を 1 回だけ走査し、各区間の終了時刻より前に始まる busy の終了時刻の最大値と比べる
+def intervals_overlap(intervals, busy) -> bool:
+    j = 0
+    latest_end = None
+    for start, end in intervals:
+        while j < len(busy) and busy[j][0] < end:
+            if latest_end is None or busy[j][1] > latest_end:
+                latest_end = busy[j][1]
+            j += 1
+        if latest_end is not None and latest_end > start:
+            return True
+    return False
+
+
+# 繰り返し予約のいずれかの回が既存の予約と重複するか
+# シリーズの期間の単発の予約と他のシリーズの回をまとめて読み、メモリ上で 1 回の走査で判定する
+def series_has_conflict(db: Session, series, exclude_recurring_id: int = None) -> bool:
+    start, end = series.start_datetime, recurrence.last_end(series)
+    busy = booking_intervals(db, series.room_id, start, end)
+    for other in recurring_candidates(db, [series.room_id], start, end, exclude_recurring_id):
+        busy.extend(recurrence.occurrences(other, start, end))
+    busy.sort()
+    return intervals_overlap(recurrence.occurrences(series, start, end), busy)
+
+
+# 予約の登録・更新をコミットした後に呼ぶ
+def booking_saved(booking: models.Booking):
+    if CONFLICT_INDEX == 'memory':
+        interval_index.add(booking)
+
+
+# 予約の削除をコミットした後に呼ぶ
+def booking_deleted(booking_id: int):
+    if CONFLICT_INDEX == 'memory':
+        interval_index.remove(booking_id)
+
+
+# 予約を書き込む前に読む会議室の状態 (read_room_state が 1 回のクエリで読む)
+# capacity: 定員 / version: 書き込みバージョン (行がまだなければ None)
+# conflict: [start, end) に重複する予約 (単発・繰り返しの回) があるか (期間を指定しなければ None)
+# before: exclude_booking_id の予約の変更前の値 (room_id, start_datetime, end_datetime, booked_num)
+RoomState = namedtuple('RoomState', ['capacity', 'version', 'conflict', 'before'])
+BookingBefore = namedtuple('BookingBefore', ['room_id', 'start_datetime', 'end_datetime', 'booked_num'])
+
+
+# 会議室の定員とバージョン、[start, end) の重複の有無、更新する予約の変更前の値を 1 回のクエリで読む
+# (会議室がなければ None)。重複の判定とバージョンを同じ文で読むので、この後に同じ会議室へ
+# コミットされた書き込みは bump_room_version の失敗で検出できる
+# 繰り返し予約は期間と重なり得るシリーズがある場合だけ読み込んで展開する
+def read_room_state(db: Session, room_id: int, start=None, end=None, exclude_booking_id: int = None):
+    columns = [models.Room.capacity, models.RoomVersion.version]
+    if start is not None:
+        if CONFLICT_INDEX != 'memory':
+            columns.append((latest_end(models.Booking, room_id, end, exclude_booking_id) > start).label('booked'))
+        # 保管済みの予約は終了済みなので、過去に始まる予約のときだけ bookings_archive も見る
+        if start < datetime.datetime.now():
+            columns.append((latest_end(models.BookingArchive, room_id, end) > start).label('archived'))
+        columns.append(series_exist(room_id, start, end).label('has_series'))
+    query = select(*columns).\
+        select_from(models.Room).\
+        outerjoin(models.RoomVersion, models.RoomVersion.room_id == models.Room.room_id)
+    if exclude_booking_id is not None:
+        before = aliased(models.Booking)
+        query = query.\
+            add_columns(*(getattr(before, name).label(f'before_{name}') for name in BookingBefore._fields)).\
+            outerjoin(before, before.booking_id == exclude_booking_id)
+    row = db.execute(query.where(models.Room.room_id == room_id)).first()
+    if row is None:
+        return None
+    mapping = row._mapping
+
+    conflict = None
+    if start is not None:
+        if CONFLICT_INDEX == 'memory':
+            conflict = interval_index.has_overlap(db, room_id, start, end, exclude_booking_id)
+        else:
+            conflict = bool(mapping['booked'])
+        conflict = conflict or bool(mapping.get('archived')) or (
+            mapping['has_series'] and
+            series_overlaps(recurring_candidates(db, [room_id], start, end), start, end))
+    before = None
+    if exclude_booking_id is not None and mapping['before_room_id'] is not None:
+        before = BookingBefore(*(mapping[f'before_{name}'] for name in BookingBefore._fields))
+    return RoomState(row.capacity, row.version, conflict, before)
+
+
+# 読んだときのバージョンのままであれば進める (version が None なら行を作成する)
+# 別の書き込みが先にコミットしていれば StaleRoomVersion を送出する
+def bump_room_version(db: Session, room_id: int, version):
+    if version is None:
+        db.add(models.RoomVersion(room_id=room_id, version=1))
+        try:
+            db.flush()
+        except IntegrityError:
+            # 別のトランザクションが先に作成した
+            raise StaleRoomVersion(room_id)
+        return
+    updated = db.query(models.RoomVersion).\
+        filter(models.RoomVersion.room_id == room_id).\
+        filter(models.RoomVersion.version == version).\
+        update({models.RoomVersion.version: version + 1}, synchronize_session=False)
+    if updated != 1:
+        raise StaleRoomVersion(room_id)
+
+
+# 重複チェックを伴わない書き込み (予約の削除など) でも会議室のバージョンを進める
+# バージョンは会議室ごとのキャッシュ (timeline) のキーにも使うので、予約が変わったら必ず進める
+def touch_room(db: Session, room_id: int):
+    updated = db.query(models.RoomVersion).\
+        filter(models.RoomVersion.room_id == room_id).\
+        update({models.RoomVersion.version: models.RoomVersion.version + 1}, synchronize_session=False)
+    if updated == 0:
+        db.add(models.RoomVersion(room_id=room_id, version=1))
+        try:
+            db.flush()
+        except IntegrityError:
+            # 別のトランザクションが先に作成した
+            raise StaleRoomVersion(room_id)
+
+
+# 複数の会議室のバージョンをまとめて進めて書き込み権を取る (一括登録用)
+# 先に進めておくことで、以降の重複チェックから書き込みまでの間に同じ会議室へ
+# 書き込もうとする他のトランザクションは待つか、バージョン不一致でやり直しになる
+def lock_rooms(db: Session, room_ids):
+    room_ids = sorted(set(room_ids))
+    existing = {row[0] for row in db.query(models.RoomVersion.room_id).
+                filter(models.RoomVersion.room_id.in_(room_ids))}
+    missing = [room_id for room_id in room_ids if room_id not in existing]
+    if missing:
+        try:
+            db.execute(insert(models.RoomVersion), [{'room_id': room_id, 'version': 0} for room_id in missing])
+        except IntegrityError:
+            # 別のトランザクションが先に作成した
+            raise StaleRoomVersion(missing)
+    db.query(models.RoomVersion).\
+        filter(models.RoomVersion.room_id.in_(room_ids)).\
+        update({models.RoomVersion.version: models.RoomVersion.version + 1}, synchronize_session=False)
@@ -1,146 +1,886 @@
 from fastapi import HTTPException
-from sqlalchemy.orm import Session
-import models, schemas
+from sqlalchemy import and_, delete, exists, func, insert, null, or_, select, union_all, update
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session, aliased, contains_eager, joinedload
+import archive, availability, conflicts, events, models, recurrence, rollups, schemas, timeline
 import datetime
+from collections import namedtuple
+from typing import List
 
-def initialize_data(db: Session):
-    # Check if initial data already exists
-    if db.query(models.User).first() or db.query(models.Room).first() or db.query(models.Booking).first():
-        return
+# INSERT / UPDATE / DELETE ... RETURNING で書き込んだ行をそのまま受け取り、
+# 書き込み後に読み直す SELECT を省く (RETURNING に対応していない DB では ORM で書き込む)
+def _insert(db: Session, model, **values):
+    if db.get_bind().dialect.insert_returning:
+        return db.scalars(insert(model).values(**values).returning(model)).one()
+    db_obj = model(**values)
+    db.add(db_obj)
+    db.flush()
+    return db_obj
 
-    # Add users
-    user = models.User(username="あおい")
-    db.add(user)
-    db.commit()
-    db.refresh(user)
+def _update(db: Session, model, criterion, **values):
+    if db.get_bind().dialect.update_returning:
+        return db.scalars(update(model).where(criterion).values(**values).returning(model)).one_or_none()
+    db_obj = db.query(model).filter(criterion).first()
+    if db_obj is not None:
+        for name, value in values.items():
+            setattr(db_obj, name, value)
+        db.flush()
+    return db_obj
 
-    # Add rooms
-    room = models.Room(room_name="会議室A", capacity=10)
-    db.add(room)
-    db.commit()
-    db.refresh(room)
+def _delete(db: Session, model, criterion):
+    if db.get_bind().dialect.delete_returning:
+        return db.scalars(delete(model).where(criterion).returning(model)).one_or_none()
+    db_obj = db.query(model).filter(criterion).first()
+    if db_obj is not None:
+        db.delete(db_obj)
+        db.flush()
+    return db_obj
+
+# 条件に合う行をまとめて書き換え・削除し、書き込んだ行のリストを返す (一括更新・削除用)
+# 1 文の UPDATE / DELETE ... WHERE ... RETURNING で済ませ、行ごとに読み書きしない
+def _update_all(db: Session, model, criteria, **values):
+    if db.get_bind().dialect.update_returning:
+        return db.scalars(update(model).where(*criteria).values(**values).returning(model)).all()
+    db_objs = db.query(model).filter(*criteria).all()
+    for db_obj in db_objs:
+        for name, value in values.items():
+            setattr(db_obj, name, value)
+    db.flush()
+    return db_objs
+
+def _delete_all(db: Session, model, criteria):
+    if db.get_bind().dialect.delete_returning:
+        return db.scalars(delete(model).where(*criteria).returning(model)).all()
+    db_objs = db.query(model).filter(*criteria).all()
+    db.execute(delete(model).where(*criteria), execution_options={'synchronize_session': False})
+    return db_objs
 
-    # Add bookings
-    booking = models.Booking(
+# 予約を利用実績の集計に渡す形にする (sign は追加なら 1、取り消しなら -1)
+def _usage(booking, sign: int):
+    return booking.room_id, booking.start_datetime, booking.end_datetime, booking.booked_num, sign
+
+def initialize_data(db: Session):
+    # Check if initial data already exists (1 回のクエリで確認する)
+    if db.scalar(select(
+        exists(select(models.User.user_id)) | exists(select(models.Room.room_id)) |
+        exists(select(models.Booking.booking_id))
+    )):
+        return
+
+    # 初期データは 1 トランザクションで登録する
+    user = _insert(db, models.User, username="あおい")
+    room = _insert(db, models.Room, room_name="会議室A", capacity=10)
+    booking = _insert(
+        db, models.Booking,
         user_id=user.user_id,
         room_id=room.room_id,
         booked_num=5,
         start_datetime=datetime.datetime.now(),
         end_datetime=datetime.datetime.now() + datetime.timedelta(hours=1)
     )
-    db.add(booking)
+    rollups.apply(db, [_usage(booking, 1)])
+    events.record(db, ('user', 'create', user), ('room', 'create', room), ('booking', 'create', booking))
     db.commit()
-    db.refresh(booking)
+
+# 一覧を ORM オブジェクトではなく列のタプルで返す場合の列 (レスポンスのフィールド順)
+USER_ROW_COLUMNS = (models.User.username, models.User.user_id)
+ROOM_ROW_COLUMNS = (models.Room.room_name, models.Room.capacity, models.Room.room_id)
+def _booking_row_columns(source):
+    return (
+        source.user_id, source.room_id, source.booked_num,
+        source.start_datetime, source.end_datetime, source.booking_id,
+        null().label('recurring_id')
+    )
+BOOKING_ROW_COLUMNS = _booking_row_columns(models.Booking)
+# 繰り返し予約の回を BOOKING_ROW_COLUMNS と同じ形で表す
+BookingRow = namedtuple('BookingRow', [column.key for column in BOOKING_ROW_COLUMNS])
+
+# 予約を読むテーブル
+# 保管済みの予約も含める場合は bookings と bookings_archive を UNION ALL したものを Booking として扱う
+def _booking_source(include_archived: bool = False):
+    if not include_archived:
+        return models.Booking
+    hot = select(*(getattr(models.Booking, name) for name in archive.COLUMNS))
+    cold = select(*(getattr(models.BookingArchive, name) for name in archive.COLUMNS))
+    return aliased(models.Booking, union_all(hot, cold).subquery('bookings_all'))
+
+# 期間 [from_, to) と重なる予約に絞り込む条件 (片方だけ指定した場合はその側だけで絞り込む)
+def _window_criteria(source, from_: datetime.datetime = None, to: datetime.datetime = None):
+    criteria = []
+    if from_ is not None:
+        criteria.append(source.end_datetime > from_)
+    if to is not None:
+        criteria.append(source.start_datetime < to)
+    return criteria
 
 # ユーザー一覧取得
-def get_users(db: Session, skip: int = 0, limit: int = 100):
-    return db.query(models.User).offset(skip).limit(limit).all()
+# after_id を指定した場合はその ID より後をキーセットで取得する (skip は使わない)
+# rows=True の場合は必要な列だけをタプル (属性でも参照できる Row) で返す
+def get_users(db: Session, skip: int = 0, limit: int = 100, after_id: int = None, rows: bool = False):
+    query = db.query(*USER_ROW_COLUMNS) if rows else db.query(models.User)
+    query = query.order_by(models.User.user_id)
+    if after_id is not None:
+        return query.filter(models.User.user_id > after_id).limit(limit).all()
+    return query.offset(skip).limit(limit).all()
 
 # 会議室一覧取得
-def get_rooms(db: Session, skip: int = 0, limit: int = 100):
-    return db.query(models.Room).offset(skip).limit(limit).all()
+def get_rooms(db: Session, skip: int = 0, limit: int = 100, after_id: int = None, rows: bool = False):
+    query = db.query(*ROOM_ROW_COLUMNS) if rows else db.query(models.Room)
+    query = query.order_by(models.Room.room_id)
+    if after_id is not None:
+        return query.filter(models.Room.room_id > after_id).limit(limit).all()
+    return query.offset(skip).limit(limit).all()
 
 # 予約一覧取得
-def get_bookings(db: Session, skip: int = 0, limit: int = 100):
-    return db.query(models.Booking).offset(skip).limit(limit).all()
+# 期間 [from_, to) の両端を指定しない場合は booking_id 順 (after に booking_id を指定するとキーセット)
+# (片方だけ指定した場合もその側で絞り込む)
+# 両端を指定した場合は、その期間と重なる予約に繰り返し予約の回も展開して加え、
+# (start_datetime, room_id) 順で返す (after に (start_datetime, room_id) を指定するとキーセット)
+def get_bookings(db: Session, skip: int = 0, limit: int = 100,
+                 from_: datetime.datetime = None, to: datetime.datetime = None,
+                 room_id: int = None, user_id: int = None, after=None, rows: bool = False,
+                 include_archived: bool = False):
+    source = _booking_source(include_archived)
+    query = db.query(*_booking_row_columns(source)) if rows else db.query(source)
+    if room_id is not None:
+        query = query.filter(source.room_id == room_id)
+    if user_id is not None:
+        query = query.filter(source.user_id == user_id)
+    query = query.filter(*_window_criteria(source, from_, to))
+
+    if from_ is None or to is None:
+        query = query.order_by(source.booking_id)
+        if after is not None:
+            return query.filter(source.booking_id > after).limit(limit).all()
+        return query.offset(skip).limit(limit).all()
+
+    query = query.order_by(source.start_datetime, source.room_id)
+    if after is not None:
+        after_start, after_room_id = after
+        query = query.filter(or_(
+            source.start_datetime > after_start,
+            and_(source.start_datetime == after_start, source.room_id > after_room_id)
+        ))
+    else:
+        # skip 指定時はその分も含めて取得し、繰り返し予約の回と合わせてから切り出す
+        limit += skip
+    bookings = query.limit(limit).all()
+
+    occurrence_class = BookingRow if rows else schemas.Booking
+    series_query = conflicts.recurring_candidates(db, None if room_id is None else [room_id], from_, to)
+    for series in series_query:
+        if user_id is not None and series.user_id != user_id:
+            continue
+        window_start = from_ if after is None else max(from_, after[0])
+        taken = 0
+        for start, end in recurrence.occurrences(series, window_start, to):
+            if after is not None and (start, series.room_id) <= tuple(after):
+                continue
+            bookings.append(occurrence_class(
+                booking_id=None,
+                recurring_id=series.recurring_id,
+                user_id=series.user_id,
+                room_id=series.room_id,
+                booked_num=series.booked_num,
+                start_datetime=start,
+                end_datetime=end
+            ))
+            # 1 ページ分を超える回は展開しない
+            taken += 1
+            if taken >= limit:
+                break
+    bookings.sort(key=lambda booking: (booking.start_datetime, booking.room_id))
+    if after is None:
+        return bookings[skip:limit]
+    return bookings[:limit]
+
+# 表示用の時刻の形式
+DISPLAY_DATETIME_FORMAT = '%Y/%m/%d %H:%M'
+
+def _expanded(booking, user, room, booking_id=None, recurring_id=None, start=None, end=None):
+    start = start or booking.start_datetime
+    end = end or booking.end_datetime
+    return schemas.BookingExpanded(
+        booking_id=booking_id,
+        recurring_id=recurring_id,
+        user_id=booking.user_id,
+        room_id=booking.room_id,
+        booked_num=booking.booked_num,
+        start_datetime=start,
+        end_datetime=end,
+        username=user.username if user is not None else None,
+        room_name=room.room_name if room is not None else None,
+        capacity=room.capacity if room is not None else None,
+        start_text=start.strftime(DISPLAY_DATETIME_FORMAT),
+        end_text=end.strftime(DISPLAY_DATETIME_FORMAT)
+    )
+
+# 予約者名・会議室名付きの予約一覧取得
+# users, rooms を 1 回の JOIN で一緒に読み込む (削除済みのユーザー・会議室の予約も返す)
+def get_bookings_expanded(db: Session, skip: int = 0, limit: int = 100,
+                          from_: datetime.datetime = None, to: datetime.datetime = None,
+                          room_id: int = None, user_id: int = None, include_archived: bool = False):
+    source = _booking_source(include_archived)
+    query = db.query(source).\
+        outerjoin(source.user).\
+        outerjoin(source.room).\
+        options(contains_eager(source.user), contains_eager(source.room))
+    if room_id is not None:
+        query = query.filter(source.room_id == room_id)
+    if user_id is not None:
+        query = query.filter(source.user_id == user_id)
+    query = query.filter(*_window_criteria(source, from_, to))
+
+    if from_ is None or to is None:
+        query = query.order_by(source.booking_id).offset(skip).limit(limit)
+        return [_expanded(b, b.user, b.room, booking_id=b.booking_id) for b in query]
+
+    query = query.\
+        order_by(source.start_datetime, source.room_id).\
+        limit(skip + limit)
+    bookings = [_expanded(b, b.user, b.room, booking_id=b.booking_id) for b in query]
+    series_query = db.query(models.RecurringBooking).\
+        options(joinedload(models.RecurringBooking.user), joinedload(models.RecurringBooking.room)).\
+        filter(models.RecurringBooking.start_datetime < to).\
+        filter(models.RecurringBooking.until >= from_.date())
+    if room_id is not None:
+        series_query = series_query.filter(models.RecurringBooking.room_id == room_id)
+    if user_id is not None:
+        series_query = series_query.filter(models.RecurringBooking.user_id == user_id)
+    for series in series_query:
+        for i, (start, end) in enumerate(recurrence.occurrences(series, from_, to)):
+            if i >= skip + limit:
+                break
+            bookings.append(_expanded(series, series.user, series.room,
+                                      recurring_id=series.recurring_id, start=start, end=end))
+    bookings.sort(key=lambda booking: (booking.start_datetime, booking.room_id))
+    return bookings[skip:skip + limit]
+
+# エクスポートする予約の列 (繰り返し予約の回は booking_id が None、recurring_id にシリーズの ID)
+EXPORT_COLUMNS = ('booking_id', 'recurring_id', 'user_id', 'room_id', 'booked_num', 'start_datetime', 'end_datetime')
+
+# 予約エクスポート用のクエリ (一覧取得と同じ絞り込み、booking_id 順)
+def bookings_export_statement(from_: datetime.datetime = None, to: datetime.datetime = None,
+                              room_id: int = None, user_id: int = None, include_archived: bool = False):
+    source = _booking_source(include_archived)
+    stmt = select(
+        source.booking_id, null(), source.user_id, source.room_id,
+        source.booked_num, source.start_datetime, source.end_datetime
+    ).order_by(source.booking_id)
+    if room_id is not None:
+        stmt = stmt.where(source.room_id == room_id)
+    if user_id is not None:
+        stmt = stmt.where(source.user_id == user_id)
+    return stmt.where(*_window_criteria(source, from_, to))
+
+# 期間内の繰り返し予約の回を EXPORT_COLUMNS の順のタプルで順に返す
+def occurrence_rows(series_list, from_: datetime.datetime, to: datetime.datetime, user_id: int = None):
+    for series in series_list:
+        if user_id is not None and series.user_id != user_id:
+            continue
+        for start, end in recurrence.occurrences(series, from_, to):
+            yield (None, series.recurring_id, series.user_id, series.room_id, series.booked_num, start, end)
+
+# 予約を EXPORT_COLUMNS の順のタプルで順に返す
+# サーバーサイドカーソルから batch_size 行ずつ取得するので、全件をメモリに載せない
+def iter_booking_rows(db: Session, from_: datetime.datetime = None, to: datetime.datetime = None,
+                      room_id: int = None, user_id: int = None, include_archived: bool = False,
+                      batch_size: int = 1000):
+    stmt = bookings_export_statement(from_=from_, to=to, room_id=room_id, user_id=user_id,
+                                     include_archived=include_archived)
+    result = db.execute(stmt.execution_options(yield_per=batch_size))
+    for row in result:
+        yield tuple(row)
+    if from_ is not None and to is not None:
+        series_list = conflicts.recurring_candidates(db, None if room_id is None else [room_id], from_, to)
+        yield from occurrence_rows(series_list, from_, to, user_id=user_id)
+
+# 空き会議室検索
+# 対象期間の予約を 1 回の範囲検索で取得し、会議室ごとに利用可能時間から予約済み区間を除いた
+# slot_minutes 分以上の空き区間を返す (空きのない会議室は返さない)
+def get_room_availability(db: Session, start: datetime.datetime, end: datetime.datetime,
+                          min_capacity: int = 1, slot_minutes: int = 30):
+    rooms = db.query(models.Room).\
+        filter(models.Room.capacity >= min_capacity).\
+        order_by(models.Room.room_id).\
+        all()
+    room_ids = [room.room_id for room in rooms]
+
+    busy = {room_id: [] for room_id in room_ids}
+    rows = db.query(models.Booking.room_id, models.Booking.start_datetime, models.Booking.end_datetime).\
+        filter(models.Booking.room_id.in_(room_ids)).\
+        filter(models.Booking.start_datetime < end).\
+        filter(models.Booking.end_datetime > start)
+    for room_id, booking_start, booking_end in rows:
+        busy[room_id].append((booking_start, booking_end))
+    for series in conflicts.recurring_candidates(db, room_ids, start, end):
+        busy[series.room_id].extend(recurrence.occurrences(series, start, end))
+
+    windows = availability.operating_windows(start, end)
+    min_length = datetime.timedelta(minutes=slot_minutes)
+    result = []
+    for room in rooms:
+        free = availability.free_intervals(sorted(busy[room.room_id]), windows, min_length)
+        if free:
+            result.append(schemas.RoomAvailability(
+                room_id=room.room_id,
+                room_name=room.room_name,
+                capacity=room.capacity,
+                free_slots=[schemas.TimeSlot(start_datetime=s, end_datetime=e) for s, e in free]
+            ))
+    return result
+
+# 会議室ごとの予約状況 (start_date から days 日分の枠のビット列)
+# 会議室・日ごとにキャッシュし、キャッシュにない分だけ 1 回の範囲検索で予約を読む
+# キャッシュのキーに会議室のバージョンを含めるので、予約を書き込んだ会議室は読み直す
+def get_timeline(db: Session, start_date: datetime.date, days: int = 7, room_id: int = None):
+    rooms = db.query(models.Room.room_id, models.Room.room_name).order_by(models.Room.room_id)
+    versions = db.query(models.RoomVersion.room_id, models.RoomVersion.version)
+    if room_id is not None:
+        rooms = rooms.filter(models.Room.room_id == room_id)
+        versions = versions.filter(models.RoomVersion.room_id == room_id)
+    rooms = rooms.all()
+    versions = dict(versions.all())
+    dates = [start_date + datetime.timedelta(days=i) for i in range(days)]
+
+    slots = {}
+    missing = []
+    for room in rooms:
+        for day in dates:
+            key = (room.room_id, versions.get(room.room_id, 0), day)
+            slots[key] = timeline.day_cache.get(key)
+            if slots[key] is None:
+                missing.append(key)
+
+    if missing:
+        window_start = datetime.datetime.combine(min(key[2] for key in missing), availability.OPEN_TIME)
+        window_end = datetime.datetime.combine(max(key[2] for key in missing), availability.CLOSE_TIME)
+        room_ids = None if room_id is None else [room_id]
+        busy = {}
+        # 過去の日は保管済みの予約も含める
+        source = _booking_source(window_start < datetime.datetime.now())
+        rows = db.query(source.room_id, source.start_datetime, source.end_datetime).\
+            filter(source.start_datetime < window_end).\
+            filter(source.end_datetime > window_start)
+        if room_id is not None:
+            rows = rows.filter(source.room_id == room_id)
+        intervals = [tuple(row) for row in rows]
+        for series in conflicts.recurring_candidates(db, room_ids, window_start, window_end):
+            intervals.extend((series.room_id, start, end)
+                             for start, end in recurrence.occurrences(series, window_start, window_end))
+        for busy_room_id, start, end in intervals:
+            day = start.date()
+            while day <= end.date():
+                busy.setdefault((busy_room_id, day), []).append((start, end))
+                day += datetime.timedelta(days=1)
+        for key in missing:
+            slots[key] = timeline.encode(timeline.day_bitmap(key[2], busy.get((key[0], key[2]), ())))
+            timeline.day_cache.set(key, slots[key])
+
+    return schemas.Timeline(
+        start_date=start_date,
+        days=days,
+        open_time=availability.OPEN_TIME,
+        slot_minutes=timeline.SLOT_MINUTES,
+        slots_per_day=timeline.SLOTS_PER_DAY,
+        rooms=[
+            schemas.RoomTimeline(
+                room_id=room.room_id,
+                room_name=room.room_name,
+                slots=[slots[(room.room_id, versions.get(room.room_id, 0), day)] for day in dates]
+            )
+            for room in rooms
+        ]
+    )
+
+# 会議室の利用実績
+# 集計テーブルから読むので、期間内の予約の件数ではなく時間帯の数に比例する
+# 週ごとは日ごとの集計を月曜始まりの週にまとめる
+def get_utilization(db: Session, from_: datetime.datetime, to: datetime.datetime,
+                    granularity: str = 'day', room_id: int = None):
+    stored = 'hour' if granularity == 'hour' else 'day'
+    query = db.query(models.RoomUsage.room_id, models.RoomUsage.bucket_start,
+                     models.RoomUsage.booked_seconds, models.RoomUsage.seat_seconds).\
+        filter(models.RoomUsage.granularity == stored).\
+        filter(models.RoomUsage.bucket_start >= rollups.bucket_floor(from_, granularity)).\
+        filter(models.RoomUsage.bucket_start < to)
+    if room_id is not None:
+        query = query.filter(models.RoomUsage.room_id == room_id)
+
+    totals = {}
+    for usage_room_id, bucket_start, booked_seconds, seat_seconds in query:
+        key = (usage_room_id, rollups.bucket_floor(bucket_start, granularity))
+        total = totals.setdefault(key, [0, 0])
+        total[0] += booked_seconds
+        total[1] += seat_seconds
+
+    bucket_seconds = rollups.BUCKET_LENGTHS[granularity].total_seconds()
+    return [
+        schemas.RoomUtilization(
+            room_id=usage_room_id,
+            bucket_start=bucket_start,
+            booked_minutes=booked_seconds / 60,
+            seat_hours=seat_seconds / 3600,
+            utilization=booked_seconds / bucket_seconds
+        )
+        for (usage_room_id, bucket_start), (booked_seconds, seat_seconds) in sorted(totals.items())
+        if booked_seconds or seat_seconds
+    ]
 
 # ユーザー登録
 def create_user(db: Session, user: schemas.UserCreate):
-    db_user = models.User(username=user.username)
-    db.add(db_user)
+    db_user = _insert(db, models.User, username=user.username)
+    events.record(db, ('user', 'create', db_user))
     db.commit()
-    db.refresh(db_user)
     return db_user
 
 # 会議室登録
 def create_room(db: Session, room: schemas.RoomCreate):
-    db_room = models.Room(room_name=room.room_name, capacity=room.capacity)
-    db.add(db_room)
+    db_room = _insert(db, models.Room, room_name=room.room_name, capacity=room.capacity)
+    events.record(db, ('room', 'create', db_room))
     db.commit()
-    db.refresh(db_room)
     return db_room
 
+# 予約人数が会議室の定員以内か確認する (state は conflicts.read_room_state の結果)
+def _check_capacity(state, booked_num: int):
+    if state is None:
+        raise HTTPException(status_code=404, detail="Room not found")
+    if state.capacity is not None and booked_num > state.capacity:
+        raise HTTPException(status_code=400, detail="Exceeds room capacity")
+
+# 予約の書き込みを実行してコミットする
+# 会議室単位の書き込みは write の中で、重複チェックと同じクエリで読んだ会議室のバージョンを進める
+# 重複チェックから書き込みまでの間に同じ会議室へ別の予約がコミットされた場合は
+# バージョン更新が失敗するので、ロールバックしてやり直す (別の会議室への書き込みは互いに待たない)
+# 複数の会議室にまたがる書き込み (一括登録・更新・削除など) は write の中で lock_rooms を使い、
+# 会議室のバージョンをまとめて進める
+# 会議室のバージョンが競合した場合や、ロック待ちがタイムアウトした場合はロールバックしてやり直す
+# (SQL やスキーマの誤りなど、やり直しても失敗するエラーはそのまま送出する)
+def _write_rooms(db: Session, write):
+    for attempt in range(conflicts.ROOM_WRITE_RETRIES):
+        try:
+            result = write()
+            db.commit()
+        except conflicts.StaleRoomVersion:
+            db.rollback()
+            continue
+        except OperationalError as exc:
+            db.rollback()
+            if conflicts.is_retryable(exc):
+                continue
+            raise
+        except HTTPException:
+            db.rollback()
+            raise
+        return result
+    raise HTTPException(status_code=503, detail="Room is busy")
+
 # 予約登録
 def create_booking(db: Session, booking: schemas.BookingCreate):
-    db_booked = db.query(models.Booking).\
-        filter(models.Booking.room_id == booking.room_id).\
-        filter(models.Booking.end_datetime > booking.start_datetime).\
-        filter(models.Booking.start_datetime < booking.end_datetime).\
-        all()
-    # 重複するデータがなければ
-    if len(db_booked) == 0:
-        db_booking = models.Booking(
+    if booking.start_datetime >= booking.end_datetime:
+        raise HTTPException(status_code=400, detail="Invalid time range")
+    def write():
+        state = conflicts.read_room_state(db, booking.room_id, booking.start_datetime, booking.end_datetime)
+        _check_capacity(state, booking.booked_num)
+        # 重複するデータがあれば登録しない
+        if state.conflict:
+            raise HTTPException(status_code=409, detail="Already booked")
+        db_booking = _insert(
+            db, models.Booking,
             user_id = booking.user_id,
             room_id = booking.room_id,
             booked_num = booking.booked_num,
             start_datetime = booking.start_datetime,
             end_datetime = booking.end_datetime
         )
-        db.add(db_booking)
-        db.commit()
-        db.refresh(db_booking)
+        rollups.apply(db, [_usage(db_booking, 1)])
+        events.record(db, ('booking', 'create', db_booking))
+        conflicts.bump_room_version(db, booking.room_id, state.version)
         return db_booking
-    else:
-        raise HTTPException(status_code=404, detail="Already booked")
+    db_booking = _write_rooms(db, write)
+    conflicts.booking_saved(db_booking)
+    return db_booking
+
+# [start, end) に空いていて booked_num 人以上入る会議室の (room_id, version) を、定員の小さい順 (同じなら room_id 順) に返す
+# 会議室ごとに end より前に始まる最も遅い予約 1 件を複合インデックスで引く相関サブクエリにして、
+# 全会議室を 1 回のクエリで判定する。会議室のバージョンも同じクエリで読むので、選んだ会議室に
+# この後で別の予約がコミットされた場合は bump_room_version の失敗で検出できる
+# 繰り返し予約は期間と重なり得るシリーズがある会議室の分だけ読み込んで展開して除く
+def _free_rooms(db: Session, start: datetime.datetime, end: datetime.datetime, booked_num: int):
+    query = db.query(models.Room.room_id, models.RoomVersion.version,
+                     conflicts.series_exist(models.Room.room_id, start, end).label('has_series')).\
+        outerjoin(models.RoomVersion, models.RoomVersion.room_id == models.Room.room_id).\
+        filter(models.Room.capacity >= booked_num)
+    sources = [models.Booking]
+    # 保管済みの予約は終了済みなので、過去に始まる時間帯のときだけ bookings_archive も見る
+    if start < datetime.datetime.now():
+        sources.append(models.BookingArchive)
+    for source in sources:
+        # 予約がない会議室は start と比べて空きとする
+        query = query.filter(func.coalesce(conflicts.latest_end(source, models.Room.room_id, end), start) <= start)
+    rooms = query.order_by(models.Room.capacity, models.Room.room_id).all()
+    series_room_ids = [room.room_id for room in rooms if room.has_series]
+    if not series_room_ids:
+        return rooms
+    busy = {series.room_id for series in conflicts.recurring_candidates(db, series_room_ids, start, end)
+            if conflicts.series_overlaps([series], start, end)}
+    return [room for room in rooms if room.room_id not in busy]
+
+# おまかせ予約
+# 希望の時間帯を順に見て、最初に空き会議室が見つかった時間帯で最も定員の小さい会議室に予約する
+# 空き会議室と一緒に読んだバージョンを進めるので、選んだ後に別の予約が入った場合はやり直す
+def create_booking_auto(db: Session, request: schemas.BookingAutoCreate):
+    windows = [(window.start_datetime, window.end_datetime) for window in request.windows]
+    if request.start_datetime is not None or request.end_datetime is not None:
+        windows.insert(0, (request.start_datetime, request.end_datetime))
+    if not windows or any(start is None or end is None or start >= end for start, end in windows):
+        raise HTTPException(status_code=400, detail="Invalid time range")
+
+    def write():
+        for start, end in windows:
+            rooms = _free_rooms(db, start, end, request.booked_num)
+            if rooms:
+                break
+        else:
+            raise HTTPException(status_code=409, detail="No room available")
+        room_id, version = rooms[0].room_id, rooms[0].version
+        db_booking = _insert(
+            db, models.Booking,
+            user_id = request.user_id,
+            room_id = room_id,
+            booked_num = request.booked_num,
+            start_datetime = start,
+            end_datetime = end
+        )
+        rollups.apply(db, [_usage(db_booking, 1)])
+        events.record(db, ('booking', 'create', db_booking))
+        conflicts.bump_room_version(db, room_id, version)
+        return db_booking
+    db_booking = _write_rooms(db, write)
+    conflicts.booking_saved(db_booking)
+    return db_booking
+
+# 予約一括登録
+# (room_id, start_datetime) で並べ替えて一度だけ走査し、DB の既存予約とバッチ内の予約の
+# 両方との重複を判定する。受け付けた予約は 1 トランザクションでまとめて INSERT する
+def create_bookings_batch(db: Session, bookings: List[schemas.BookingCreate]):
+    results = [None] * len(bookings)
+    # 会議室の定員は 1 回のクエリでまとめて読む
+    capacities = dict(db.query(models.Room.room_id, models.Room.capacity).
+                      filter(models.Room.room_id.in_({booking.room_id for booking in bookings})))
+    order = []
+    for i, booking in enumerate(bookings):
+        if booking.start_datetime >= booking.end_datetime:
+            results[i] = schemas.BookingBatchResult(index=i, status='rejected', detail='Invalid time range')
+        elif booking.room_id not in capacities:
+            results[i] = schemas.BookingBatchResult(index=i, status='rejected', detail='Room not found')
+        elif capacities[booking.room_id] is not None and booking.booked_num > capacities[booking.room_id]:
+            results[i] = schemas.BookingBatchResult(index=i, status='rejected', detail='Exceeds room capacity')
+        else:
+            order.append(i)
+    order.sort(key=lambda i: (bookings[i].room_id, bookings[i].start_datetime))
+    if not order:
+        return results
+
+    room_ids = sorted({bookings[i].room_id for i in order})
+    window_start = min(bookings[i].start_datetime for i in order)
+    window_end = max(bookings[i].end_datetime for i in order)
+
+    def write():
+        conflicts.lock_rooms(db, room_ids)
+        # 対象の会議室・期間の既存予約を 1 回のクエリで取得する
+        # 過去の期間を含む場合は保管済みの予約とも比べる
+        source = _booking_source(window_start < datetime.datetime.now())
+        existing = db.query(source.room_id, source.start_datetime, source.end_datetime).\
+            filter(source.room_id.in_(room_ids)).\
+            filter(source.start_datetime < window_end).\
+            filter(source.end_datetime > window_start).\
+            order_by(source.room_id, source.start_datetime).\
+            all()
+        series_by_room = {}
+        for series in conflicts.recurring_candidates(db, room_ids, window_start, window_end):
+            series_by_room.setdefault(series.room_id, []).append(series)
+
+        accepted = []
+        j = 0
+        room_id = None
+        last_end = None
+        for i in order:
+            booking = bookings[i]
+            if booking.room_id != room_id:
+                room_id = booking.room_id
+                last_end = None
+            # 既存予約のうち、この予約より前に終わるものは読み飛ばす
+            while j < len(existing) and (existing[j][0], existing[j][2]) <= (room_id, booking.start_datetime):
+                j += 1
+            if last_end is not None and last_end > booking.start_datetime:
+                results[i] = schemas.BookingBatchResult(index=i, status='rejected', detail='Conflicts within batch')
+            elif j < len(existing) and existing[j][0] == room_id and existing[j][1] < booking.end_datetime:
+                results[i] = schemas.BookingBatchResult(index=i, status='rejected', detail='Already booked')
+            elif conflicts.series_overlaps(series_by_room.get(room_id, ()), booking.start_datetime, booking.end_datetime):
+                results[i] = schemas.BookingBatchResult(index=i, status='rejected', detail='Already booked')
+            else:
+                accepted.append(i)
+                last_end = booking.end_datetime
+
+        saved = []
+        if accepted:
+            # 受け付けた予約は同じ会議室内で開始時刻が重ならないので、(room_id, start_datetime) で採番結果を対応付ける
+            rows = db.execute(
+                insert(models.Booking).returning(
+                    models.Booking.booking_id, models.Booking.room_id, models.Booking.start_datetime
+                ),
+                [bookings[i].model_dump() for i in accepted]
+            )
+            inserted = {(room_id, start): booking_id for booking_id, room_id, start in rows}
+            saved = [
+                models.Booking(
+                    booking_id=inserted[(bookings[i].room_id, bookings[i].start_datetime)],
+                    **bookings[i].model_dump()
+                )
+                for i in accepted
+            ]
+            rollups.apply(db, [_usage(bookings[i], 1) for i in accepted])
+            events.record(db, *(('booking', 'create', db_booking) for db_booking in saved))
+        return accepted, saved
+    accepted, saved = _write_rooms(db, write)
+
+    for i, db_booking in zip(accepted, saved):
+        results[i] = schemas.BookingBatchResult(index=i, status='accepted', booking_id=db_booking.booking_id)
+        conflicts.booking_saved(db_booking)
+    return results
+
+# 予約と繰り返し予約をまとめて削除し、利用実績の集計と会議室のバージョンに反映する
+# 削除した分の変更イベントを返す (ユーザー・会議室の削除のイベントと 1 回の INSERT にまとめるため)
+def _cascade_bookings(db: Session, booking_criterion, series_criterion):
+    bookings = _delete_all(db, models.Booking, [booking_criterion])
+    series_list = _delete_all(db, models.RecurringBooking, [series_criterion])
+    intervals = [_usage(db_booking, -1) for db_booking in bookings]
+    for db_series in series_list:
+        intervals.extend(rollups.series_intervals(db_series, -1))
+    rollups.apply(db, intervals)
+    room_ids = {db_booking.room_id for db_booking in bookings} | {db_series.room_id for db_series in series_list}
+    if room_ids:
+        conflicts.lock_rooms(db, room_ids)
+    return bookings, [('booking', 'delete', db_booking) for db_booking in bookings] + \
+        [('recurring_booking', 'delete', db_series) for db_series in series_list]
 
 # User update
 def update_user(db: Session, user_id: int, user: schemas.UserUpdate):
-    db_user = db.query(models.User).filter(models.User.user_id == user_id).first()
+    db_user = _update(db, models.User, models.User.user_id == user_id, username=user.username)
     if db_user is None:
         return None
-    db_user.username = user.username
+    events.record(db, ('user', 'update', db_user))
     db.commit()
-    db.refresh(db_user)
     return db_user
 
 # User delete
+# そのユーザーの予約・繰り返し予約も同じトランザクションで削除する (保管済みの予約は履歴として残す)
 def delete_user(db: Session, user_id: int):
-    db_user = db.query(models.User).filter(models.User.user_id == user_id).first()
-    if db_user is None:
-        return None
-    db.delete(db_user)
-    db.commit()
+    def write():
+        bookings, changes = _cascade_bookings(db, models.Booking.user_id == user_id,
+                                              models.RecurringBooking.user_id == user_id)
+        db_user = _delete(db, models.User, models.User.user_id == user_id)
+        if db_user is None:
+            db.rollback()
+            return None, []
+        events.record(db, *changes, ('user', 'delete', db_user))
+        return db_user, bookings
+    db_user, bookings = _write_rooms(db, write)
+    for db_booking in bookings:
+        conflicts.booking_deleted(db_booking.booking_id)
     return db_user
 
 # Room update
 def update_room(db: Session, room_id: int, room: schemas.RoomUpdate):
-    db_room = db.query(models.Room).filter(models.Room.room_id == room_id).first()
+    db_room = _update(db, models.Room, models.Room.room_id == room_id,
+                      room_name=room.room_name, capacity=room.capacity)
     if db_room is None:
         return None
-    db_room.room_name = room.room_name
-    db_room.capacity = room.capacity
+    events.record(db, ('room', 'update', db_room))
     db.commit()
-    db.refresh(db_room)
     return db_room
 
 # Room delete
+# その会議室の予約・繰り返し予約も同じトランザクションで削除する (保管済みの予約は履歴として残す)
 def delete_room(db: Session, room_id: int):
-    db_room = db.query(models.Room).filter(models.Room.room_id == room_id).first()
-    if db_room is None:
-        return None
-    db.delete(db_room)
-    db.commit()
+    def write():
+        bookings, changes = _cascade_bookings(db, models.Booking.room_id == room_id,
+                                              models.RecurringBooking.room_id == room_id)
+        db_room = _delete(db, models.Room, models.Room.room_id == room_id)
+        if db_room is None:
+            db.rollback()
+            return None, []
+        events.record(db, *changes, ('room', 'delete', db_room))
+        return db_room, bookings
+    db_room, bookings = _write_rooms(db, write)
+    for db_booking in bookings:
+        conflicts.booking_deleted(db_booking.booking_id)
     return db_room
 
 # Booking update
+# 会議室の定員・バージョン、自分自身を除いた重複の有無と、利用実績の集計から引く変更前の
+# 時間帯と人数を 1 回のクエリで読んでから UPDATE ... RETURNING で書き換える
 def update_booking(db: Session, booking_id: int, booking: schemas.BookingUpdate):
-    db_booking = db.query(models.Booking).filter(models.Booking.booking_id == booking_id).first()
+    if booking.start_datetime >= booking.end_datetime:
+        raise HTTPException(status_code=400, detail="Invalid time range")
+    def write():
+        state = conflicts.read_room_state(db, booking.room_id, booking.start_datetime, booking.end_datetime,
+                                          exclude_booking_id=booking_id)
+        _check_capacity(state, booking.booked_num)
+        before = state.before
+        if before is None:
+            return None
+        if state.conflict:
+            raise HTTPException(status_code=409, detail="Already booked")
+        db_booking = _update(
+            db, models.Booking, models.Booking.booking_id == booking_id,
+            user_id = booking.user_id,
+            room_id = booking.room_id,
+            booked_num = booking.booked_num,
+            start_datetime = booking.start_datetime,
+            end_datetime = booking.end_datetime
+        )
+        if db_booking is None:
+            return None
+        rollups.apply(db, [_usage(before, -1), _usage(db_booking, 1)])
+        events.record(db, ('booking', 'update', db_booking))
+        # 別の会議室へ移した場合は移動元のバージョンも進める
+        if before.room_id != booking.room_id:
+            conflicts.touch_room(db, before.room_id)
+        conflicts.bump_room_version(db, booking.room_id, state.version)
+        return db_booking
+    db_booking = _write_rooms(db, write)
     if db_booking is None:
         return None
-    db_booking.user_id = booking.user_id
-    db_booking.room_id = booking.room_id
-    db_booking.booked_num = booking.booked_num
-    db_booking.start_datetime = booking.start_datetime
-    db_booking.end_datetime = booking.end_datetime
-    db.commit()
-    db.refresh(db_booking)
+    conflicts.booking_saved(db_booking)
     return db_booking
 
 # Booking delete
 def delete_booking(db: Session, booking_id: int):
-    db_booking = db.query(models.Booking).filter(models.Booking.booking_id == booking_id).first()
-    if db_booking is None:
-        return None
-    db.delete(db_booking)
-    db.commit()
-    return db_booking
\ No newline at end of file
+    def write():
+        db_booking = _delete(db, models.Booking, models.Booking.booking_id == booking_id)
+        if db_booking is None:
+            return None
+        rollups.apply(db, [_usage(db_booking, -1)])
+        conflicts.touch_room(db, db_booking.room_id)
+        events.record(db, ('booking', 'delete', db_booking))
+        return db_booking
+    db_booking = _write_rooms(db, write)
+    if db_booking is not None:
+        conflicts.booking_deleted(booking_id)
+    return db_booking
+
+# 予約の一括更新・削除の絞り込み (期間は [from_, to) と重なる予約)
+# 条件がなければ全件が対象になってしまうので、1 つ以上の指定を必須にする
+def _bookings_criteria(room_id: int = None, user_id: int = None,
+                       from_: datetime.datetime = None, to: datetime.datetime = None):
+    criteria = []
+    if room_id is not None:
+        criteria.append(models.Booking.room_id == room_id)
+    if user_id is not None:
+        criteria.append(models.Booking.user_id == user_id)
+    criteria.extend(_window_criteria(models.Booking, from_, to))
+    if not criteria:
+        raise HTTPException(status_code=400, detail="At least one filter is required")
+    if from_ is not None and to is not None and from_ >= to:
+        raise HTTPException(status_code=400, detail="Invalid time range")
+    return criteria
+
+# 予約一括更新 (絞り込みに合う単発の予約の予約者・人数を 1 回の UPDATE で書き換え、件数を返す)
+# 時間帯・会議室は変えないので重複チェックは不要。人数を変える場合は利用実績の集計のため変更前の人数を読む
+def update_bookings(db: Session, changes: schemas.BookingBulkUpdate, room_id: int = None, user_id: int = None,
+                    from_: datetime.datetime = None, to: datetime.datetime = None) -> int:
+    criteria = _bookings_criteria(room_id, user_id, from_, to)
+    values = changes.model_dump(exclude_none=True)
+    if not values:
+        raise HTTPException(status_code=400, detail="No fields to update")
+    def write():
+        before = {}
+        if 'booked_num' in values:
+            # 対象の予約のうち 1 件でも会議室の定員を超えるなら書き換えない
+            if db.scalar(select(exists(
+                select(models.Booking.booking_id).
+                join(models.Room, models.Room.room_id == models.Booking.room_id).
+                where(*criteria).
+                where(models.Room.capacity < values['booked_num'])
+            ))):
+                raise HTTPException(status_code=400, detail="Exceeds room capacity")
+            before = {row.booking_id: row for row in db.query(
+                models.Booking.booking_id, models.Booking.room_id, models.Booking.start_datetime,
+                models.Booking.end_datetime, models.Booking.booked_num).filter(*criteria)}
+        db_bookings = _update_all(db, models.Booking, criteria, **values)
+        if not db_bookings:
+            return 0
+        if 'booked_num' in values:
+            # 読んだ後に追加された予約があれば変更前の人数がわからないのでやり直す
+            if any(db_booking.booking_id not in before for db_booking in db_bookings):
+                raise conflicts.StaleRoomVersion(room_id)
+            rollups.apply(db, [_usage(row, -1) for row in before.values()] +
+                          [_usage(db_booking, 1) for db_booking in db_bookings])
+        conflicts.lock_rooms(db, {db_booking.room_id for db_booking in db_bookings})
+        events.record(db, *(('booking', 'update', db_booking) for db_booking in db_bookings))
+        return len(db_bookings)
+    return _write_rooms(db, write)
+
+# 予約一括削除 (絞り込みに合う単発の予約を 1 回の DELETE で削除し、件数を返す)
+def delete_bookings(db: Session, room_id: int = None, user_id: int = None,
+                    from_: datetime.datetime = None, to: datetime.datetime = None) -> int:
+    criteria = _bookings_criteria(room_id, user_id, from_, to)
+    def write():
+        db_bookings = _delete_all(db, models.Booking, criteria)
+        if not db_bookings:
+            return []
+        rollups.apply(db, [_usage(db_booking, -1) for db_booking in db_bookings])
+        conflicts.lock_rooms(db, {db_booking.room_id for db_booking in db_bookings})
+        events.record(db, *(('booking', 'delete', db_booking) for db_booking in db_bookings))
+        return db_bookings
+    db_bookings = _write_rooms(db, write)
+    for db_booking in db_bookings:
+        conflicts.booking_deleted(db_booking.booking_id)
+    return len(db_bookings)
+
+# 繰り返し予約一覧取得
+def get_recurring_bookings(db: Session, skip: int = 0, limit: int = 100):
+    return db.query(models.RecurringBooking).offset(skip).limit(limit).all()
+
+# 繰り返し予約登録
+# 回ごとの行は作らず 1 行だけ書き込む。重複チェックは各回の時間帯だけを対象にする
+def create_recurring_booking(db: Session, series: schemas.RecurringBookingCreate):
+    if series.start_datetime >= series.end_datetime or \
+            series.end_datetime - series.start_datetime > datetime.timedelta(days=series.interval_days) or \
+            series.until < series.start_datetime.date():
+        raise HTTPException(status_code=400, detail="Invalid recurrence")
+    def write():
+        state = conflicts.read_room_state(db, series.room_id)
+        _check_capacity(state, series.booked_num)
+        if conflicts.series_has_conflict(db, series):
+            raise HTTPException(status_code=409, detail="Already booked")
+        db_series = _insert(
+            db, models.RecurringBooking,
+            user_id = series.user_id,
+            room_id = series.room_id,
+            booked_num = series.booked_num,
+            start_datetime = series.start_datetime,
+            end_datetime = series.end_datetime,
+            interval_days = series.interval_days,
+            until = series.until,
+            exception_dates = [str(d) for d in series.exception_dates]
+        )
+        rollups.apply(db, rollups.series_intervals(db_series, 1))
+        events.record(db, ('recurring_booking', 'create', db_series))
+        conflicts.bump_room_version(db, series.room_id, state.version)
+        return db_series
+    return _write_rooms(db, write)
+
+# 繰り返し予約削除
+def delete_recurring_booking(db: Session, recurring_id: int):
+    def write():
+        db_series = _delete(db, models.RecurringBooking, models.RecurringBooking.recurring_id == recurring_id)
+        if db_series is None:
+            return None
+        rollups.apply(db, rollups.series_intervals(db_series, -1))
+        conflicts.touch_room(db, db_series.room_id)
+        events.record(db, ('recurring_booking', 'delete', db_series))
+        return db_series
+    return _write_rooms(db, write)
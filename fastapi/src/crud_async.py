@@ -0,0 +1,163 @@
+import asyncio
+import datetime
+import weakref
+from contextlib import AsyncExitStack
+from typing import List, Union
+
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+import cache, crud, schemas
+
+DBSession = Union[Session, AsyncSession]
+
+# 会議室ごとのロック
+# 同じ会議室への予約書き込みはプロセス内で順番に実行し、別の会議室は並行して実行する
+# (プロセスをまたぐ競合は crud 側の会議室バージョンで検出する)
+# ロックは待っている・持っているリクエストがいる間だけ残るので、存在しない room_id を送られても増え続けない
+_room_locks = weakref.WeakValueDictionary()
+
+def _room_lock(room_id: int) -> asyncio.Lock:
+    lock = _room_locks.get(room_id)
+    if lock is None:
+        lock = _room_locks[room_id] = asyncio.Lock()
+    return lock
+
+# crud の同期関数を実行する
+# AsyncSession の場合は run_sync で aiosqlite 上のコネクションに渡すため、
+# クエリやコミットの待ち時間にイベントループをブロックしない
+# 同期 Session の場合は呼び出しごとに close してコネクションをすぐプールに返す
+# (レスポンス送信まで持ったままだと、同時リクエストがイベントループ上でプールの空きを待って止まる)
+# 結果のオブジェクトは読み込み済みの属性のまま使える
+async def _run(db: DBSession, fn, *args, **kwargs):
+    if isinstance(db, AsyncSession):
+        return await db.run_sync(fn, *args, **kwargs)
+    try:
+        return fn(db, *args, **kwargs)
+    finally:
+        db.close()
+
+# ユーザー一覧取得
+async def get_users(db: DBSession, skip: int = 0, limit: int = 100, after_id: int = None, rows: bool = False):
+    return await _run(db, crud.get_users, skip=skip, limit=limit, after_id=after_id, rows=rows)
+
+# 会議室一覧取得
+async def get_rooms(db: DBSession, skip: int = 0, limit: int = 100, after_id: int = None, rows: bool = False):
+    return await _run(db, crud.get_rooms, skip=skip, limit=limit, after_id=after_id, rows=rows)
+
+# 予約一覧取得
+async def get_bookings(db: DBSession, skip: int = 0, limit: int = 100,
+                       from_: datetime.datetime = None, to: datetime.datetime = None,
+                       room_id: int = None, user_id: int = None, after=None, rows: bool = False,
+                       include_archived: bool = False):
+    return await _run(db, crud.get_bookings, skip=skip, limit=limit, from_=from_, to=to,
+                      room_id=room_id, user_id=user_id, after=after, rows=rows,
+                      include_archived=include_archived)
+
+# 予約者名・会議室名付きの予約一覧取得
+async def get_bookings_expanded(db: DBSession, skip: int = 0, limit: int = 100,
+                                from_: datetime.datetime = None, to: datetime.datetime = None,
+                                room_id: int = None, user_id: int = None, include_archived: bool = False):
+    return await _run(db, crud.get_bookings_expanded, skip=skip, limit=limit, from_=from_, to=to,
+                      room_id=room_id, user_id=user_id, include_archived=include_archived)
+
+# 空き会議室検索
+async def get_room_availability(db: DBSession, start: datetime.datetime, end: datetime.datetime,
+                                min_capacity: int = 1, slot_minutes: int = 30):
+    return await _run(db, crud.get_room_availability, start=start, end=end,
+                      min_capacity=min_capacity, slot_minutes=slot_minutes)
+
+# 会議室ごとの予約状況
+async def get_timeline(db: DBSession, start_date: datetime.date, days: int = 7, room_id: int = None):
+    return await _run(db, crud.get_timeline, start_date=start_date, days=days, room_id=room_id)
+
+# 会議室の利用実績
+async def get_utilization(db: DBSession, from_: datetime.datetime, to: datetime.datetime,
+                          granularity: str = 'day', room_id: int = None):
+    return await _run(db, crud.get_utilization, from_=from_, to=to, granularity=granularity, room_id=room_id)
+
+# ユーザー登録
+async def create_user(db: DBSession, user: schemas.UserCreate):
+    result = await _run(db, crud.create_user, user=user)
+    await cache.invalidate('users')
+    return result
+
+# 会議室登録
+async def create_room(db: DBSession, room: schemas.RoomCreate):
+    result = await _run(db, crud.create_room, room=room)
+    await cache.invalidate('rooms')
+    return result
+
+# 予約登録
+async def create_booking(db: DBSession, booking: schemas.BookingCreate):
+    async with _room_lock(booking.room_id):
+        return await _run(db, crud.create_booking, booking=booking)
+
+# おまかせ予約 (会議室は選ぶまでわからないので、会議室ごとのロックは使わずバージョンで排他する)
+async def create_booking_auto(db: DBSession, request: schemas.BookingAutoCreate):
+    return await _run(db, crud.create_booking_auto, request=request)
+
+# 予約一括登録
+async def create_bookings_batch(db: DBSession, bookings: List[schemas.BookingCreate]):
+    room_ids = sorted({booking.room_id for booking in bookings})
+    # デッドロックしないよう会議室 ID 順にロックを取る
+    async with AsyncExitStack() as stack:
+        for room_id in room_ids:
+            await stack.enter_async_context(_room_lock(room_id))
+        return await _run(db, crud.create_bookings_batch, bookings=bookings)
+
+# User update
+async def update_user(db: DBSession, user_id: int, user: schemas.UserUpdate):
+    result = await _run(db, crud.update_user, user_id=user_id, user=user)
+    await cache.invalidate('users')
+    return result
+
+# User delete
+async def delete_user(db: DBSession, user_id: int):
+    result = await _run(db, crud.delete_user, user_id=user_id)
+    await cache.invalidate('users')
+    return result
+
+# Room update
+async def update_room(db: DBSession, room_id: int, room: schemas.RoomUpdate):
+    result = await _run(db, crud.update_room, room_id=room_id, room=room)
+    await cache.invalidate('rooms')
+    return result
+
+# Room delete
+async def delete_room(db: DBSession, room_id: int):
+    result = await _run(db, crud.delete_room, room_id=room_id)
+    await cache.invalidate('rooms')
+    return result
+
+# Booking update
+async def update_booking(db: DBSession, booking_id: int, booking: schemas.BookingUpdate):
+    async with _room_lock(booking.room_id):
+        return await _run(db, crud.update_booking, booking_id=booking_id, booking=booking)
+
+# Booking delete
+async def delete_booking(db: DBSession, booking_id: int):
+    return await _run(db, crud.delete_booking, booking_id=booking_id)
+
+# 予約一括更新
+async def update_bookings(db: DBSession, changes: schemas.BookingBulkUpdate, room_id: int = None, user_id: int = None,
+                          from_: datetime.datetime = None, to: datetime.datetime = None):
+    return await _run(db, crud.update_bookings, changes=changes, room_id=room_id, user_id=user_id, from_=from_, to=to)
+
+# 予約一括削除
+async def delete_bookings(db: DBSession, room_id: int = None, user_id: int = None,
+                          from_: datetime.datetime = None, to: datetime.datetime = None):
+    return await _run(db, crud.delete_bookings, room_id=room_id, user_id=user_id, from_=from_, to=to)
+
+# 繰り返し予約一覧取得
+async def get_recurring_bookings(db: DBSession, skip: int = 0, limit: int = 100):
+    return await _run(db, crud.get_recurring_bookings, skip=skip, limit=limit)
+
+# 繰り返し予約登録
+async def create_recurring_booking(db: DBSession, series: schemas.RecurringBookingCreate):
+    async with _room_lock(series.room_id):
+        return await _run(db, crud.create_recurring_booking, series=series)
+
+# 繰り返し予約削除
+async def delete_recurring_booking(db: DBSession, recurring_id: int):
+    return await _run(db, crud.delete_recurring_booking, recurring_id=recurring_id)
@@ -1,11 +1,135 @@
-from sqlalchemy import create_engine
+import logging
+import os
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
-SQLALCHEMY_DATABASE_URL = 'sqlite:///./sql_app.db'
+# uvicorn のログ設定に乗せて出力する
+logger = logging.getLogger('uvicorn.error')
+
+SQLALCHEMY_DATABASE_URL = os.environ.get('SQLALCHEMY_DATABASE_URL', 'sqlite:///./sql_app.db')
+
+# 非同期用のドライバ (指定がなければ同期用 URL から決める)
+ASYNC_DRIVERS = {
+    'sqlite': 'sqlite+aiosqlite',
+    'postgresql': 'postgresql+asyncpg',
+}
+
+# "sync": 従来どおり同期 Session / "async": AsyncSession でイベントループをブロックしない
+DB_MODE = os.environ.get('DB_MODE', 'sync')
+if DB_MODE not in ('sync', 'async'):
+    raise ValueError(f"DB_MODE must be 'sync' or 'async', got {DB_MODE!r}")
+
+# SQLite の接続ごとに設定する PRAGMA
+# WAL にすると書き込み中も読み込みがブロックされない
+SQLITE_PRAGMAS = {
+    'journal_mode': os.environ.get('SQLITE_JOURNAL_MODE', 'WAL'),
+    'synchronous': os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL'),
+    'busy_timeout': int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', '5000')),
+    'mmap_size': int(os.environ.get('SQLITE_MMAP_SIZE', str(256 * 1024 * 1024))),
+    # 負の値は KiB 単位
+    'cache_size': int(os.environ.get('SQLITE_CACHE_SIZE', '-65536')),
+}
+
+# サーバー型 DB (PostgreSQL など) のコネクションプール設定
+POOL_SETTINGS = {
+    'pool_size': int(os.environ.get('DB_POOL_SIZE', '10')),
+    'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', '20')),
+    'pool_timeout': int(os.environ.get('DB_POOL_TIMEOUT', '30')),
+    'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', '1800')),
+    'pool_pre_ping': os.environ.get('DB_POOL_PRE_PING', '1') != '0',
+}
+
+
+def _is_sqlite(url: str) -> bool:
+    return make_url(url).get_backend_name() == 'sqlite'
+
+
+def async_url(url: str) -> str:
+    if os.environ.get('ASYNC_DATABASE_URL'):
+        return os.environ['ASYNC_DATABASE_URL']
+    parsed = make_url(url)
+    return parsed.set(drivername=ASYNC_DRIVERS.get(parsed.get_backend_name(), parsed.drivername)).\
+        render_as_string(hide_password=False)
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for name, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f'PRAGMA {name}={value}')
+    cursor.close()
+
+
+def _engine_options(url: str) -> dict:
+    if _is_sqlite(url):
+        return {}
+    return dict(POOL_SETTINGS)
+
+
+# 設定に応じたエンジンを作る (SQLite は接続時に PRAGMA を設定する)
+def make_engine(url: str = SQLALCHEMY_DATABASE_URL):
+    connect_args = {'check_same_thread': False} if _is_sqlite(url) else {}
+    new_engine = create_engine(url, connect_args=connect_args, **_engine_options(url))
+    if _is_sqlite(url):
+        event.listen(new_engine, 'connect', _set_sqlite_pragmas)
+    return new_engine
+
+
+def make_async_engine(url: str = SQLALCHEMY_DATABASE_URL):
+    new_engine = create_async_engine(async_url(url), **_engine_options(url))
+    if _is_sqlite(url):
+        event.listen(new_engine.sync_engine, 'connect', _set_sqlite_pragmas)
+    return new_engine
+
+
+# 起動時に実際に有効になっている設定をログに出す
+def log_settings():
+    settings = {'url': engine.url.render_as_string(hide_password=True), 'mode': DB_MODE}
+    if _is_sqlite(SQLALCHEMY_DATABASE_URL):
+        with engine.connect() as conn:
+            for name in SQLITE_PRAGMAS:
+                settings[name] = conn.exec_driver_sql(f'PRAGMA {name}').scalar()
+    else:
+        settings.update(POOL_SETTINGS)
+    logger.info('database settings: %s', settings)
+
+
+# エンジンはプロセスごとに init() で作る (import 時には作らない)
+# ワーカーを fork / spawn した後に、それぞれのプロセスでコネクションプールを持つ
+engine = None
+async_engine = None
+# 書き込みは RETURNING で値を受け取るので、commit 後に読み直さないよう属性を保持する
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False)
+
+# 非同期ドライバは DB_MODE=async のときだけ読み込む
+AsyncSessionLocal = None
+if DB_MODE == 'async':
+    # レスポンス生成時に遅延ロードが走らないよう commit 後も属性を保持する
+    AsyncSessionLocal = async_sessionmaker(class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
+
+# このプロセスのエンジンを作り、セッションに結び付けて返す (2 回目以降は作らない)
+# アプリは lifespan の開始時に、CLI やベンチマークは DB を使う前に呼ぶ
+def init():
+    global engine, async_engine
+    if engine is None:
+        engine = make_engine()
+        SessionLocal.configure(bind=engine)
+    if DB_MODE == 'async' and async_engine is None:
+        async_engine = make_async_engine()
+        AsyncSessionLocal.configure(bind=async_engine)
+    return engine
+
+
+# プロセスの終了時にプールのコネクションを閉じる
+async def dispose():
+    if async_engine is not None:
+        await async_engine.dispose()
+    if engine is not None:
+        engine.dispose()
+
 
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={'check_same_thread': False}
-)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
@@ -0,0 +1,261 @@
+import asyncio
+import datetime
+import logging
+import os
+from collections import deque
+
+from sqlalchemy import delete, func, insert, select
+from sqlalchemy.orm import Session
+
+import database, fastjson, models
+from database import DB_MODE, AsyncSessionLocal, SessionLocal
+
+logger = logging.getLogger('uvicorn.error')
+
+# 新しいイベントを確認する間隔 (秒)
+EVENTS_POLL_SECONDS = float(os.environ.get('EVENTS_POLL_SECONDS', '0.5'))
+# イベントがない間にコメント行を送る間隔 (秒)。途中のプロキシに接続を切られないようにする
+EVENTS_KEEPALIVE_SECONDS = float(os.environ.get('EVENTS_KEEPALIVE_SECONDS', '15'))
+# 1 回に読むイベントの件数
+EVENTS_BATCH_SIZE = int(os.environ.get('EVENTS_BATCH_SIZE', '500'))
+# プロセス内に持っておく最近のイベントの件数 (これより前から再開する接続は DB から読む)
+EVENTS_BUFFER_SIZE = int(os.environ.get('EVENTS_BUFFER_SIZE', '10000'))
+# 1 本のストリームを続ける最大秒数 (クライアントは Last-Event-ID で再接続する)
+# サーバーの停止時に接続が終わるのを待ち続けないよう、またワーカー間で接続が偏らないよう区切る
+EVENTS_MAX_STREAM_SECONDS = float(os.environ.get('EVENTS_MAX_STREAM_SECONDS', '300'))
+# 切断後にクライアントが再接続するまでの時間 (ミリ秒、SSE の retry)
+EVENTS_RETRY_MS = int(os.environ.get('EVENTS_RETRY_MS', '1000'))
+# この秒数より古いイベントを消す (0 なら消さない)
+EVENTS_RETENTION_SECONDS = int(os.environ.get('EVENTS_RETENTION_SECONDS', str(24 * 3600)))
+
+# version がコミット順に並ぶ DB (ポーリングは読んだ最大の version より後だけを読むので、
+# 小さい version が後からコミットされるとそのイベントはどのクライアントにも届かない)
+# SQLite は書き込みが 1 つずつなので、AUTOINCREMENT の順がそのままコミット順になる
+# PostgreSQL は SERIAL を並行して採番するので、イベントの INSERT からコミットまでを
+# トランザクション単位のアドバイザリーロックで 1 つずつにする
+# それ以外の DB では /events を提供しない
+SUPPORTED_DIALECTS = ('sqlite', 'postgresql')
+# PostgreSQL の pg_advisory_xact_lock のキー (bootstrap のロックとは別)
+ADVISORY_LOCK_KEY = 7243101
+
+# エンティティごとに配信する列 (一覧のレスポンスと同じ順で、最後が ID)
+COLUMNS = {
+    'user': ('username', 'user_id'),
+    'room': ('room_name', 'capacity', 'room_id'),
+    'booking': ('user_id', 'room_id', 'booked_num', 'start_datetime', 'end_datetime', 'booking_id'),
+    'recurring_booking': ('user_id', 'room_id', 'booked_num', 'start_datetime', 'end_datetime',
+                          'interval_days', 'until', 'exception_dates', 'recurring_id'),
+}
+
+
+# 変更イベントを追加する (コミットは呼び出し側の書き込みと一緒に行う)
+# changes は (エンティティ, 操作, 書き込んだ行) のタプルで、まとめて 1 回の INSERT にする
+def record(db: Session, *changes):
+    now = datetime.datetime.now()
+    rows = []
+    for entity, operation, obj in changes:
+        columns = COLUMNS[entity]
+        rows.append({
+            'entity': entity,
+            'entity_id': getattr(obj, columns[-1]),
+            'operation': operation,
+            'data': fastjson.dumps({name: getattr(obj, name) for name in columns}).decode('utf-8'),
+            'created_at': now,
+        })
+    if rows:
+        if db.get_bind().dialect.name == 'postgresql':
+            db.execute(select(func.pg_advisory_xact_lock(ADVISORY_LOCK_KEY)))
+        db.execute(insert(models.ChangeEvent), rows)
+
+
+# この DB で変更イベントを配信できるか
+def supported() -> bool:
+    return database.engine.dialect.name in SUPPORTED_DIALECTS
+
+
+# after より後のイベントを version 順に最大 limit 件返す
+def fetch(db: Session, after: int, limit: int = EVENTS_BATCH_SIZE):
+    return db.execute(
+        select(models.ChangeEvent.version, models.ChangeEvent.entity, models.ChangeEvent.entity_id,
+               models.ChangeEvent.operation, models.ChangeEvent.data).
+        where(models.ChangeEvent.version > after).
+        order_by(models.ChangeEvent.version).
+        limit(limit)
+    ).all()
+
+
+# 残っている最も古いイベントと最新のイベントの version (イベントがなければ None)
+def bounds(db: Session):
+    return tuple(db.execute(
+        select(func.min(models.ChangeEvent.version), func.max(models.ChangeEvent.version))
+    ).one())
+
+
+# before より前のイベントを消す
+# 最新のイベントは残し、消した後も version が続きから採番されて再接続時に判定できるようにする
+def prune(db: Session, before: datetime.datetime) -> int:
+    result = db.execute(
+        delete(models.ChangeEvent).
+        where(models.ChangeEvent.created_at < before).
+        where(models.ChangeEvent.version < select(func.max(models.ChangeEvent.version)).scalar_subquery())
+    )
+    db.commit()
+    return result.rowcount
+
+
+# SSE のメッセージ (data の JSON は保存してある文字列をそのまま埋め込む)
+def _message(version: int, entity: str, entity_id: int, operation: str, data: str) -> str:
+    return (f'id: {version}\nevent: change\n'
+            f'data: {{"version":{version},"entity":"{entity}","id":{entity_id},'
+            f'"operation":"{operation}","data":{data}}}\n\n')
+
+
+def _control(event: str, version: int) -> str:
+    return f'retry: {EVENTS_RETRY_MS}\nid: {version}\nevent: {event}\ndata: {{"version":{version}}}\n\n'
+
+
+# crud の同期関数を接続ごとに新しいセッションで実行する
+# (ストリームの間ずっとコネクションを持たないよう、読み込みのたびにプールへ返す)
+async def _run(fn, *args):
+    if DB_MODE == 'async':
+        async with AsyncSessionLocal() as db:
+            return await db.run_sync(fn, *args)
+
+    def run_sync():
+        db = SessionLocal()
+        try:
+            return fn(db, *args)
+        finally:
+            db.close()
+    return await asyncio.to_thread(run_sync)
+
+
+class Feed:
+    """プロセス内の接続で 1 つのポーリングを共有し、新しいイベントを配る
+
+    (floor, latest] の範囲のイベントをメモリに持つ。接続がなくなったらポーリングを止める
+    """
+
+    def __init__(self, buffer_size: int = EVENTS_BUFFER_SIZE):
+        self._messages = deque(maxlen=buffer_size)
+        self._subscribers = 0
+        self._task = None
+        self._changed = None
+        self._lock = None
+        self.floor = 0
+        self.latest = 0
+
+    async def subscribe(self):
+        self._subscribers += 1
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self._task is None:
+                # 止まっていた間のイベントは持っていないので、現在の最新から始める
+                _, latest = await _run(bounds)
+                self.floor = self.latest = latest or 0
+                self._messages.clear()
+                self._changed = asyncio.Event()
+                self._task = asyncio.get_running_loop().create_task(self._poll())
+
+    def unsubscribe(self):
+        self._subscribers -= 1
+
+    # after より後のメッセージ (after が floor より前なら None)
+    def messages_after(self, after: int):
+        if after < self.floor:
+            return None
+        return [message for version, message in self._messages if version > after]
+
+    # 新しいイベントが届くまで待つ
+    async def wait(self):
+        await self._changed.wait()
+
+    async def _poll(self):
+        try:
+            while self._subscribers > 0:
+                await asyncio.sleep(EVENTS_POLL_SECONDS)
+                try:
+                    rows = await _run(fetch, self.latest)
+                except Exception:
+                    logger.exception('change feed poll failed')
+                    continue
+                if not rows:
+                    continue
+                for row in rows:
+                    if len(self._messages) == self._messages.maxlen:
+                        self.floor = self._messages[0][0]
+                    self._messages.append((row[0], _message(*row)))
+                self.latest = rows[-1][0]
+                changed, self._changed = self._changed, asyncio.Event()
+                changed.set()
+        finally:
+            self._task = None
+
+
+feed = Feed()
+
+
+# SSE のストリーム
+# 最初に ready (その時点の version) を送り、その後は change を送る
+# since を指定すると、その version より後のイベントから再開する。
+# 古いイベントを消していて再開できない場合は reset を送るので、クライアントは一覧を取り直す
+# EVENTS_MAX_STREAM_SECONDS たったら終了する
+async def stream(since: int = None):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + EVENTS_MAX_STREAM_SECONDS
+    await feed.subscribe()
+    try:
+        oldest, latest = await _run(bounds)
+        latest = latest or 0
+        if since is None:
+            after = latest
+            yield _control('ready', after)
+        elif since > latest or (oldest is not None and since < oldest - 1):
+            after = latest
+            yield _control('reset', after)
+        else:
+            after = since
+            yield _control('ready', after)
+
+        while loop.time() < deadline:
+            messages = feed.messages_after(after)
+            if messages is None:
+                # メモリに持っている範囲より前から再開した場合は DB から読む
+                rows = await _run(fetch, after)
+                if rows:
+                    after = rows[-1][0]
+                    yield ''.join(_message(*row) for row in rows)
+                else:
+                    after = feed.floor
+                continue
+            if messages:
+                after = max(after, feed.latest)
+                yield ''.join(messages)
+                continue
+            timeout = min(EVENTS_KEEPALIVE_SECONDS, deadline - loop.time())
+            try:
+                await asyncio.wait_for(feed.wait(), max(timeout, 0))
+            except asyncio.TimeoutError:
+                yield ': keepalive\n\n'
+    finally:
+        feed.unsubscribe()
+
+
+# EVENTS_RETENTION_SECONDS より古いイベントを定期的に消す (DB の処理はスレッドで行う)
+async def prune_periodically(session_factory):
+    interval = min(EVENTS_RETENTION_SECONDS, 3600)
+
+    def run_once():
+        db = session_factory()
+        try:
+            return prune(db, datetime.datetime.now() - datetime.timedelta(seconds=EVENTS_RETENTION_SECONDS))
+        finally:
+            db.close()
+
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await asyncio.to_thread(run_once)
+        except Exception:
+            logger.exception('change event prune failed')
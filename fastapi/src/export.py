@@ -0,0 +1,85 @@
+import csv
+import datetime
+import io
+import json
+
+import conflicts, crud, fastjson
+from database import DB_MODE, AsyncSessionLocal, SessionLocal
+
+# 1 回に送る行数
+EXPORT_BATCH_SIZE = 1000
+
+MEDIA_TYPES = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv; charset=utf-8',
+}
+
+
+def _default(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    raise TypeError(value)
+
+
+# 行のまとまりを指定の形式の文字列にする
+def _encode(fmt: str, rows, header: bool = False):
+    if fmt == 'ndjson' and fastjson.FAST_RESPONSES:
+        return fastjson.ndjson_lines(crud.EXPORT_COLUMNS, rows)
+    if fmt == 'ndjson':
+        return ''.join(json.dumps(dict(zip(crud.EXPORT_COLUMNS, row)), default=_default, ensure_ascii=False) + '\n'
+                       for row in rows)
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    if header:
+        writer.writerow(crud.EXPORT_COLUMNS)
+    writer.writerows([_default(v) if isinstance(v, datetime.datetime) else v for v in row] for row in rows)
+    return buf.getvalue()
+
+
+def _chunks(rows):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= EXPORT_BATCH_SIZE:
+            yield chunk
+            chunk = []
+    yield chunk
+
+
+# 同期モード: StreamingResponse がスレッドプールで回すジェネレーター
+def _stream_sync(fmt: str, **filters):
+    db = SessionLocal()
+    try:
+        rows = crud.iter_booking_rows(db, batch_size=EXPORT_BATCH_SIZE, **filters)
+        for i, chunk in enumerate(_chunks(rows)):
+            yield _encode(fmt, chunk, header=i == 0)
+    finally:
+        db.close()
+
+
+# 非同期モード: AsyncSession.stream でサーバーサイドカーソルから読む
+async def _stream_async(fmt: str, from_=None, to=None, room_id=None, user_id=None, include_archived=False):
+    async with AsyncSessionLocal() as db:
+        stmt = crud.bookings_export_statement(from_=from_, to=to, room_id=room_id, user_id=user_id,
+                                              include_archived=include_archived)
+        result = await db.stream(stmt.execution_options(yield_per=EXPORT_BATCH_SIZE))
+        first = True
+        async for partition in result.partitions():
+            yield _encode(fmt, [tuple(row) for row in partition], header=first)
+            first = False
+        if first:
+            yield _encode(fmt, [], header=True)
+        if from_ is not None and to is not None:
+            series_list = await db.run_sync(
+                conflicts.recurring_candidates, None if room_id is None else [room_id], from_, to
+            )
+            for chunk in _chunks(crud.occurrence_rows(series_list, from_, to, user_id=user_id)):
+                yield _encode(fmt, chunk)
+
+
+# 予約をストリーミングで出力するイテレーター
+# レスポンスの送信中も使えるよう、リクエストのセッションとは別にセッションを開く
+def stream_bookings(fmt: str, **filters):
+    if DB_MODE == 'async':
+        return _stream_async(fmt, **filters)
+    return _stream_sync(fmt, **filters)
@@ -0,0 +1,37 @@
+import datetime
+import json
+import os
+
+from fastapi import Response
+
+# "1" にすると一覧・エクスポートのレスポンスを pydantic の検証を通さずに直接 JSON にする
+# (レスポンスの内容と OpenAPI のスキーマは変わらない)
+FAST_RESPONSES = os.environ.get('FAST_RESPONSES', '0') == '1'
+
+try:
+    import orjson
+except ImportError:  # orjson がなければ標準の json で同じ形式にする
+    orjson = None
+
+
+def _default(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    raise TypeError(value)
+
+
+def dumps(value) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, default=_default, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+# 列のタプル (Row / namedtuple) のリストをそのまま JSON 配列のレスポンスにする
+def rows_response(rows, headers: dict = None) -> Response:
+    return Response(content=dumps([row._asdict() for row in rows]),
+                    media_type='application/json', headers=headers)
+
+
+# 1 行 1 オブジェクトの NDJSON にする
+def ndjson_lines(columns, rows) -> bytes:
+    return b''.join(dumps(dict(zip(columns, row))) + b'\n' for row in rows)
@@ -0,0 +1,125 @@
+import asyncio
+import hashlib
+import os
+
+from fastapi import Request, Response
+from fastapi.responses import JSONResponse
+
+import cache, metrics
+
+# Idempotency-Key ヘッダー付きの登録・更新のレスポンスを保存し、同じキーの再送には保存したレスポンスを返す
+# "memory": プロセス内 (LRU + TTL) / "redis://...": 複数ワーカーで共有する
+IDEMPOTENCY_URL = os.environ.get('IDEMPOTENCY_URL', 'memory')
+IDEMPOTENCY_TTL_SECONDS = int(os.environ.get('IDEMPOTENCY_TTL_SECONDS', '86400'))
+IDEMPOTENCY_MAX_ENTRIES = int(os.environ.get('IDEMPOTENCY_MAX_ENTRIES', '10000'))
+# 実行中の目印を残す秒数 (実行中にプロセスが止まっても、この時間がたてば同じキーで実行し直せる)
+IDEMPOTENCY_LOCK_SECONDS = int(os.environ.get('IDEMPOTENCY_LOCK_SECONDS', '60'))
+# 別のプロセスで実行中の結果を確認する間隔 (秒)
+IDEMPOTENCY_POLL_SECONDS = 0.05
+
+HEADER = 'Idempotency-Key'
+REPLAYED_HEADER = 'Idempotent-Replayed'
+METHODS = ('POST', 'PUT', 'PATCH')
+MAX_KEY_LENGTH = 255
+# 保存しないレスポンスヘッダー (返すときに付け直される)
+SKIPPED_HEADERS = ('content-length', 'date', 'server')
+
+_backend = None
+
+
+# このプロセスの保存先 (lifespan の開始時に作る。それより前に使われた場合はその時に作る)
+def get_backend():
+    global _backend
+    if _backend is None:
+        _backend = cache.make_backend(IDEMPOTENCY_URL, IDEMPOTENCY_MAX_ENTRIES, IDEMPOTENCY_TTL_SECONDS)
+    return _backend
+
+
+# このプロセスで実行中のキーと、その結果 (保存したエントリー、保存しなかった場合は None) を受け取る Future
+_inflight = {}
+
+_PENDING = {'pending': True, 'body': b''}
+
+
+# 同じキーで内容の違うリクエストが送られていないかを確かめる値
+# PATCH /bookings などは対象をクエリ文字列で指定するので、本文と合わせてクエリ文字列も含める
+# (クエリ文字列には改行が入らないので区切りに使う)
+def _fingerprint(query: str, body: bytes) -> str:
+    digest = hashlib.blake2b(query.encode('utf-8'), digest_size=16)
+    digest.update(b'\n')
+    digest.update(body)
+    return digest.hexdigest()
+
+
+def _replay(entry: dict, fingerprint: str) -> Response:
+    if entry['fingerprint'] != fingerprint:
+        return JSONResponse(status_code=422, content={'detail': 'Idempotency-Key was used with a different request'})
+    metrics.IDEMPOTENT_REPLAYS.inc()
+    headers = dict(entry['headers'], **{REPLAYED_HEADER: 'true'})
+    return Response(content=entry['body'], status_code=entry['status'], headers=headers)
+
+
+# 別のプロセスが実行中の場合は結果が保存されるまで待つ
+# 目印が消えた (実行に失敗した) 場合は None
+async def _wait_shared(key: str):
+    for _ in range(int(IDEMPOTENCY_LOCK_SECONDS / IDEMPOTENCY_POLL_SECONDS)):
+        await asyncio.sleep(IDEMPOTENCY_POLL_SECONDS)
+        entry = await get_backend().get(key)
+        if entry is None or not entry.get('pending'):
+            return entry
+    return None
+
+
+# HTTP ミドルウェアの本体
+# 同じキーの同時リクエストは 1 回だけ実行し、残りはその結果を返す
+# 5xx と 429 (混雑による拒否) のレスポンスは保存しないので、同じキーで再送すると実行し直す
+async def handle(request: Request, call_next):
+    key = request.headers.get(HEADER)
+    if request.method not in METHODS or key is None:
+        return await call_next(request)
+    if not key or len(key) > MAX_KEY_LENGTH:
+        return JSONResponse(status_code=400, content={'detail': 'Invalid Idempotency-Key'})
+    fingerprint = _fingerprint(request.url.query, await request.body())
+    # クエリ文字列はキーに含めない (同じキーでクエリ文字列だけ変えた再送は、別の書き込みとして
+    # 実行せずに fingerprint の不一致で 422 にする)
+    store_key = f'idempotency:{request.method}:{request.url.path}:{key}'
+
+    inflight = _inflight.get(store_key)
+    if inflight is not None:
+        entry = await asyncio.shield(inflight)
+        if entry is None:
+            return await handle(request, call_next)
+        return _replay(entry, fingerprint)
+
+    backend = get_backend()
+    future = asyncio.get_running_loop().create_future()
+    _inflight[store_key] = future
+    entry = None
+    try:
+        while not await backend.add(store_key, _PENDING, ttl=IDEMPOTENCY_LOCK_SECONDS):
+            entry = await backend.get(store_key)
+            if entry is not None and entry.get('pending'):
+                entry = await _wait_shared(store_key)
+            if entry is not None:
+                return _replay(entry, fingerprint)
+
+        response = await call_next(request)
+        if response.status_code >= 500 or response.status_code == 429:
+            await backend.delete(store_key)
+            return response
+        body = b''.join([chunk async for chunk in response.body_iterator])
+        entry = {
+            'status': response.status_code,
+            'headers': {name: value for name, value in response.headers.items() if name.lower() not in SKIPPED_HEADERS},
+            'body': body,
+            'fingerprint': fingerprint,
+        }
+        await backend.set(store_key, entry)
+        return Response(content=body, status_code=response.status_code, headers=entry['headers'])
+    except BaseException:
+        await backend.delete(store_key)
+        entry = None
+        raise
+    finally:
+        del _inflight[store_key]
+        future.set_result(entry)
@@ -1,105 +1,360 @@
-from typing import List
-from fastapi import FastAPI, Depends, HTTPException
-from sqlalchemy.orm import Session
+import asyncio
+import contextlib
+import datetime
+import logging
+import os
+from typing import List, Literal, Optional
+from fastapi import FastAPI, Depends, Header, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
 
-import crud, models, schemas
-from database import SessionLocal, engine
+import admission, archive, bootstrap, cache, conflicts, crud_async, events, export, fastjson, idempotency, metrics, pagination, schemas
+import database
+from database import DB_MODE, AsyncSessionLocal, SessionLocal
 
-models.Base.metadata.create_all(bind=engine)
+logger = logging.getLogger('uvicorn.error')
 
-app = FastAPI()
+# uvicorn の --workers の既定値にもなる
+WEB_CONCURRENCY = int(os.environ.get('WEB_CONCURRENCY', '1'))
 
-# データベースセッションの依存関係
-def get_db():
-    db = SessionLocal()
+
+# 複数ワーカーでプロセス内にしか持たない状態を使う設定になっていれば警告する
+def _warn_per_process_state():
+    if WEB_CONCURRENCY <= 1:
+        return
+    if cache.CACHE_URL == 'memory':
+        logger.warning('CACHE_URL=memory with %d workers: other workers serve stale /users, /rooms '
+                       'until CACHE_TTL_SECONDS expires', WEB_CONCURRENCY)
+    if idempotency.IDEMPOTENCY_URL == 'memory':
+        logger.warning('IDEMPOTENCY_URL=memory with %d workers: retries on another worker are executed again',
+                       WEB_CONCURRENCY)
+    if conflicts.CONFLICT_INDEX == 'memory':
+        logger.warning('BOOKING_CONFLICT_INDEX=memory with %d workers: the index misses other workers\' writes',
+                       WEB_CONCURRENCY)
+
+
+# ワーカープロセスごとの起動・終了処理
+# エンジンやキャッシュは import 時ではなくここで作るので、ワーカーを起動した後にプロセスごとに持つ
+# テーブル作成と初期データの登録はプロセス間で排他して実行する (python bootstrap.py で事前に済ませてもよい)
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    engine = database.init()
+    # SQL の実行時間・件数を /metrics に集計する
+    metrics.instrument_engine(engine)
+    if database.async_engine is not None:
+        metrics.instrument_engine(database.async_engine.sync_engine)
+    cache.get_backend()
+    idempotency.get_backend()
+    if bootstrap.BOOTSTRAP_ON_STARTUP:
+        await asyncio.to_thread(bootstrap.run)
+    database.log_settings()
+    _warn_per_process_state()
+
+    tasks = []
+    # ARCHIVE_INTERVAL_SECONDS を指定した場合は、古い予約の保管を定期的に実行する
+    if archive.ARCHIVE_INTERVAL_SECONDS > 0:
+        tasks.append(asyncio.create_task(archive.run_periodically(SessionLocal)))
+    # 古い変更イベントを定期的に消す
+    if events.EVENTS_RETENTION_SECONDS > 0:
+        tasks.append(asyncio.create_task(events.prune_periodically(SessionLocal)))
     try:
-        yield db
+        yield
     finally:
-        db.close()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await database.dispose()
 
-# Initialize data on startup
-@app.on_event("startup")
-def startup_event():
+
+app = FastAPI(lifespan=lifespan)
+
+# /users, /rooms の GET をキャッシュから返す
+# レスポンスには本文のハッシュを ETag として付け、If-None-Match が一致すれば DB を使わずに 304 を返す
+# キャッシュは書き込み時に crud_async が名前空間ごとに無効にする
+@app.middleware("http")
+async def cache_middleware(request: Request, call_next):
+    namespace = cache.CACHED_PATHS.get(request.url.path)
+    if request.method != 'GET' or namespace is None:
+        return await call_next(request)
+    # 取得前の世代で保存するので、取得中に書き込みがあっても古い内容は使われない
+    generation = await cache.get_backend().generation(namespace)
+    key = f'{namespace}:{generation}:{request.url.query}'
+    entry = await cache.get_backend().get(key)
+    if entry is None:
+        response = await call_next(request)
+        if response.status_code != 200:
+            return response
+        body = b''.join([chunk async for chunk in response.body_iterator])
+        entry = {
+            'body': body,
+            'etag': cache.make_etag(body),
+            'headers': {name: value for name, value in response.headers.items()
+                        if name.lower() == pagination.NEXT_CURSOR_HEADER.lower()},
+        }
+        await cache.get_backend().set(key, entry)
+    headers = dict(entry['headers'], **{'ETag': entry['etag'], 'Cache-Control': 'no-cache'})
+    if cache.etag_matches(request.headers.get('if-none-match'), entry['etag']):
+        return Response(status_code=304, headers=headers)
+    return Response(content=entry['body'], media_type='application/json', headers=headers)
+
+# POST / PUT に Idempotency-Key ヘッダーがあれば、同じキーの再送に保存したレスポンスを返す
+# (再送では DB を使わず、同じキーの同時リクエストは 1 回だけ実行する)
+@app.middleware("http")
+async def idempotency_middleware(request: Request, call_next):
+    return await idempotency.handle(request, call_next)
+
+# 受付制御: 書き込みの同時実行数を抑え、待ちが一杯なら 503、クライアントごとの上限を超えたら 429 を返す
+# (Retry-After 付き)。断るときは DB もキャッシュも使わない
+@app.middleware("http")
+async def admission_middleware(request: Request, call_next):
+    return await admission.handle(request, call_next)
+
+# ルートごとのリクエスト数・レイテンシ・SQL の件数と時間を記録する
+# キャッシュから返したレスポンスも含めるため、後から登録して外側で実行する
+@app.middleware("http")
+async def metrics_middleware(request: Request, call_next):
+    if not metrics.METRICS_ENABLED:
+        return await call_next(request)
+    return await metrics.observe_request(app, request, call_next)
+
+# データベースセッションの依存関係
+# DB_MODE=async の場合は AsyncSession を渡す
+async def get_db():
+    if DB_MODE == 'async':
+        async with AsyncSessionLocal() as db:
+            yield db
+        return
     db = SessionLocal()
     try:
-        crud.initialize_data(db)
+        yield db
     finally:
         db.close()
 
+# 登録・更新・削除の変更イベント (Server-Sent Events)
+# since または Last-Event-ID ヘッダーの version より後から再開する (どちらもなければ接続後の変更だけ)
+# クライアントは一覧を 1 回取得した後は、イベントの data を手元の一覧に反映すればよい
+# version をコミット順に採番できる DB (SQLite / PostgreSQL) でだけ提供する
+@app.get("/events")
+async def read_events(since: Optional[int] = None, last_event_id: Optional[int] = Header(None)):
+    if not events.supported():
+        raise HTTPException(status_code=501, detail="Change feed is not supported on this database")
+    if since is None:
+        since = last_event_id
+    return StreamingResponse(events.stream(since), media_type='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+
+# Prometheus 形式のメトリクス
+@app.get("/metrics", include_in_schema=False)
+def read_metrics():
+    return Response(content=metrics.render(), media_type=metrics.CONTENT_TYPE)
+
 # Read 操作
+# 一覧は cursor を指定するとキーセットで次のページを返す
+# 続きがある場合は X-Next-Cursor ヘッダーに次のページのカーソルを返す
 @app.get("/users", response_model=List[schemas.User])
-async def read_users(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    users = crud.get_users(db, skip=skip, limit=limit)
+async def read_users(response: Response, skip: int = 0, limit: int = 100, cursor: Optional[str] = None,
+                     db: crud_async.DBSession = Depends(get_db)):
+    after_id = None if cursor is None else pagination.decode_id_cursor(cursor)
+    users = await crud_async.get_users(db, skip=skip, limit=limit, after_id=after_id,
+                                       rows=fastjson.FAST_RESPONSES)
+    if users and len(users) == limit:
+        response.headers[pagination.NEXT_CURSOR_HEADER] = pagination.id_cursor(users[-1].user_id)
+    if fastjson.FAST_RESPONSES:
+        return fastjson.rows_response(users, headers=response.headers)
     return users
 
 @app.get("/rooms", response_model=List[schemas.Room])
-async def read_rooms(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    rooms = crud.get_rooms(db, skip=skip, limit=limit)
+async def read_rooms(response: Response, skip: int = 0, limit: int = 100, cursor: Optional[str] = None,
+                     db: crud_async.DBSession = Depends(get_db)):
+    after_id = None if cursor is None else pagination.decode_id_cursor(cursor)
+    rooms = await crud_async.get_rooms(db, skip=skip, limit=limit, after_id=after_id,
+                                       rows=fastjson.FAST_RESPONSES)
+    if rooms and len(rooms) == limit:
+        response.headers[pagination.NEXT_CURSOR_HEADER] = pagination.id_cursor(rooms[-1].room_id)
+    if fastjson.FAST_RESPONSES:
+        return fastjson.rows_response(rooms, headers=response.headers)
     return rooms
 
+# 空き会議室検索 (9:00〜20:00 のうち slot_minutes 分以上空いている時間帯を会議室ごとに返す)
+@app.get("/rooms/availability", response_model=List[schemas.RoomAvailability])
+async def read_room_availability(start: schemas.LocalDateTime, end: schemas.LocalDateTime,
+                                 min_capacity: int = Query(1, ge=1), slot_minutes: int = Query(30, ge=1),
+                                 db: crud_async.DBSession = Depends(get_db)):
+    if start >= end:
+        raise HTTPException(status_code=400, detail="Invalid time range")
+    return await crud_async.get_room_availability(db, start=start, end=end,
+                                                  min_capacity=min_capacity, slot_minutes=slot_minutes)
+
+# 会議室ごとの予約状況 (9:00〜20:00 の 15 分枠ごとの予約有無を日ごとのビット列で返す)
+# 1 週間・全会議室分を 1 回のリクエストで取得できる
+@app.get("/rooms/timeline", response_model=schemas.Timeline)
+async def read_timeline(start_date: datetime.date, days: int = Query(7, ge=1, le=31), room_id: Optional[int] = None,
+                        db: crud_async.DBSession = Depends(get_db)):
+    return await crud_async.get_timeline(db, start_date=start_date, days=days, room_id=room_id)
+
+# 会議室の利用実績 (時間・日・週ごとの予約時間、人数 × 時間、利用率)
+@app.get("/analytics/utilization", response_model=List[schemas.RoomUtilization])
+async def read_utilization(from_: schemas.LocalDateTime = Query(..., alias="from"),
+                           to: schemas.LocalDateTime = Query(...),
+                           granularity: Literal['hour', 'day', 'week'] = 'day', room_id: Optional[int] = None,
+                           db: crud_async.DBSession = Depends(get_db)):
+    if from_ >= to:
+        raise HTTPException(status_code=400, detail="Invalid time range")
+    return await crud_async.get_utilization(db, from_=from_, to=to, granularity=granularity, room_id=room_id)
+
+# room_id, user_id で絞り込める
+# from, to を両方指定すると、その期間と重なる予約を繰り返し予約の回も含めて開始時刻順で返す
+# 片方だけ指定した場合はその側だけで絞り込み、booking_id 順で返す
+# include_archived=true の場合は bookings_archive に移した過去の予約も含める
 @app.get("/bookings", response_model=List[schemas.Booking])
-async def read_bookings(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    bookings = crud.get_bookings(db, skip=skip, limit=limit)
+async def read_bookings(response: Response, skip: int = 0, limit: int = 100, cursor: Optional[str] = None,
+                        room_id: Optional[int] = None, user_id: Optional[int] = None,
+                        from_: Optional[schemas.LocalDateTime] = Query(None, alias="from"),
+                        to: Optional[schemas.LocalDateTime] = None, include_archived: bool = False,
+                        db: crud_async.DBSession = Depends(get_db)):
+    windowed = from_ is not None and to is not None
+    after = None
+    if cursor is not None:
+        after = pagination.decode_start_cursor(cursor) if windowed else pagination.decode_id_cursor(cursor)
+    bookings = await crud_async.get_bookings(db, skip=skip, limit=limit, from_=from_, to=to,
+                                             room_id=room_id, user_id=user_id, after=after,
+                                             rows=fastjson.FAST_RESPONSES, include_archived=include_archived)
+    if bookings and len(bookings) == limit:
+        last = bookings[-1]
+        response.headers[pagination.NEXT_CURSOR_HEADER] = \
+            pagination.start_cursor(last.start_datetime, last.room_id) if windowed else pagination.id_cursor(last.booking_id)
+    # Response を直接返す場合は注入された response のヘッダーが使われないので渡す
+    if fastjson.FAST_RESPONSES:
+        return fastjson.rows_response(bookings, headers=response.headers)
     return bookings
 
+# 予約者名・会議室名と表示用の時刻を含めた予約一覧 (絞り込みは /bookings と同じ)
+@app.get("/bookings/expanded", response_model=List[schemas.BookingExpanded])
+async def read_bookings_expanded(skip: int = 0, limit: int = 100,
+                                 room_id: Optional[int] = None, user_id: Optional[int] = None,
+                                 from_: Optional[schemas.LocalDateTime] = Query(None, alias="from"),
+                                 to: Optional[schemas.LocalDateTime] = None, include_archived: bool = False,
+                                 db: crud_async.DBSession = Depends(get_db)):
+    return await crud_async.get_bookings_expanded(db, skip=skip, limit=limit, from_=from_, to=to,
+                                                  room_id=room_id, user_id=user_id,
+                                                  include_archived=include_archived)
+
+# 予約エクスポート (一覧取得と同じ絞り込みで NDJSON / CSV をストリーミングで返す)
+@app.get("/bookings/export")
+async def export_bookings(format: Literal['ndjson', 'csv'] = 'ndjson',
+                          room_id: Optional[int] = None, user_id: Optional[int] = None,
+                          from_: Optional[schemas.LocalDateTime] = Query(None, alias="from"),
+                          to: Optional[schemas.LocalDateTime] = None, include_archived: bool = False):
+    body = export.stream_bookings(format, from_=from_, to=to, room_id=room_id, user_id=user_id,
+                                  include_archived=include_archived)
+    return StreamingResponse(body, media_type=export.MEDIA_TYPES[format], headers={
+        'Content-Disposition': f'attachment; filename="bookings.{format}"'
+    })
+
+@app.get("/recurring_bookings", response_model=List[schemas.RecurringBooking])
+async def read_recurring_bookings(skip: int = 0, limit: int = 100, db: crud_async.DBSession = Depends(get_db)):
+    return await crud_async.get_recurring_bookings(db, skip=skip, limit=limit)
+
 # Create 操作
 @app.post("/users", response_model=schemas.User)
-async def create_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
-    return crud.create_user(db=db, user=user)
+async def create_user(user: schemas.UserCreate, db: crud_async.DBSession = Depends(get_db)):
+    return await crud_async.create_user(db=db, user=user)
 
 @app.post("/rooms", response_model=schemas.Room)
-async def create_room(room: schemas.RoomCreate, db: Session = Depends(get_db)):
-    return crud.create_room(db=db, room=room)
+async def create_room(room: schemas.RoomCreate, db: crud_async.DBSession = Depends(get_db)):
+    return await crud_async.create_room(db=db, room=room)
 
 @app.post("/bookings", response_model=schemas.Booking)
-async def create_booking(booking: schemas.BookingCreate, db: Session = Depends(get_db)):
-    return crud.create_booking(db=db, booking=booking)
+async def create_booking(booking: schemas.BookingCreate, db: crud_async.DBSession = Depends(get_db)):
+    return await crud_async.create_booking(db=db, booking=booking)
+
+# おまかせ予約 (希望の時間帯に空いている、人数が入る最も小さい会議室を選んで予約する)
+# どの時間帯にも空きがなければ 409
+@app.post("/bookings/auto", response_model=schemas.Booking)
+async def create_booking_auto(request: schemas.BookingAutoCreate, db: crud_async.DBSession = Depends(get_db)):
+    return await crud_async.create_booking_auto(db=db, request=request)
 
+@app.post("/recurring_bookings", response_model=schemas.RecurringBooking)
+async def create_recurring_booking(series: schemas.RecurringBookingCreate, db: crud_async.DBSession = Depends(get_db)):
+    return await crud_async.create_recurring_booking(db=db, series=series)
+
+# 予約一括登録 (各要素の受付・拒否を返す)
+@app.post("/bookings/batch", response_model=List[schemas.BookingBatchResult])
+async def create_bookings_batch(bookings: List[schemas.BookingCreate], db: crud_async.DBSession = Depends(get_db)):
+    return await crud_async.create_bookings_batch(db=db, bookings=bookings)
 
 # Update user
 @app.put("/users/{user_id}", response_model=schemas.User)
-async def update_user(user_id: int, user: schemas.UserUpdate, db: Session = Depends(get_db)):
-    db_user = crud.update_user(db, user_id=user_id, user=user)
+async def update_user(user_id: int, user: schemas.UserUpdate, db: crud_async.DBSession = Depends(get_db)):
+    db_user = await crud_async.update_user(db, user_id=user_id, user=user)
     if db_user is None:
         raise HTTPException(status_code=404, detail="User not found")
     return db_user
 
 # Delete user
 @app.delete("/users/{user_id}", response_model=schemas.User)
-async def delete_user(user_id: int, db: Session = Depends(get_db)):
-    db_user = crud.delete_user(db, user_id=user_id)
+async def delete_user(user_id: int, db: crud_async.DBSession = Depends(get_db)):
+    db_user = await crud_async.delete_user(db, user_id=user_id)
     if db_user is None:
         raise HTTPException(status_code=404, detail="User not found")
     return db_user
 
 # Update room
 @app.put("/rooms/{room_id}", response_model=schemas.Room)
-async def update_room(room_id: int, room: schemas.RoomUpdate, db: Session = Depends(get_db)):
-    db_room = crud.update_room(db, room_id=room_id, room=room)
+async def update_room(room_id: int, room: schemas.RoomUpdate, db: crud_async.DBSession = Depends(get_db)):
+    db_room = await crud_async.update_room(db, room_id=room_id, room=room)
     if db_room is None:
         raise HTTPException(status_code=404, detail="Room not found")
     return db_room
 
 # Delete room
 @app.delete("/rooms/{room_id}", response_model=schemas.Room)
-async def delete_room(room_id: int, db: Session = Depends(get_db)):
-    db_room = crud.delete_room(db, room_id=room_id)
+async def delete_room(room_id: int, db: crud_async.DBSession = Depends(get_db)):
+    db_room = await crud_async.delete_room(db, room_id=room_id)
     if db_room is None:
         raise HTTPException(status_code=404, detail="Room not found")
     return db_room
 
 # Update booking
 @app.put("/bookings/{booking_id}", response_model=schemas.Booking)
-async def update_booking(booking_id: int, booking: schemas.BookingUpdate, db: Session = Depends(get_db)):
-    db_booking = crud.update_booking(db, booking_id=booking_id, booking=booking)
+async def update_booking(booking_id: int, booking: schemas.BookingUpdate, db: crud_async.DBSession = Depends(get_db)):
+    db_booking = await crud_async.update_booking(db, booking_id=booking_id, booking=booking)
     if db_booking is None:
         raise HTTPException(status_code=404, detail="Booking not found")
     return db_booking
 
 # Delete booking
 @app.delete("/bookings/{booking_id}", response_model=schemas.Booking)
-async def delete_booking(booking_id: int, db: Session = Depends(get_db)):
-    db_booking = crud.delete_booking(db, booking_id=booking_id)
+async def delete_booking(booking_id: int, db: crud_async.DBSession = Depends(get_db)):
+    db_booking = await crud_async.delete_booking(db, booking_id=booking_id)
     if db_booking is None:
         raise HTTPException(status_code=404, detail="Booking not found")
-    return db_booking
\ No newline at end of file
+    return db_booking
+
+# 予約一括更新・削除 (room_id, user_id, from, to の絞り込みに合う単発の予約が対象で、1 つ以上の指定が必要)
+# 期間は [from, to) と重なる予約。繰り返し予約の回と保管済みの予約は対象外
+# 1 回の UPDATE / DELETE で書き込み、対象になった件数を返す
+@app.patch("/bookings", response_model=schemas.BookingBulkResult)
+async def update_bookings(changes: schemas.BookingBulkUpdate,
+                          room_id: Optional[int] = None, user_id: Optional[int] = None,
+                          from_: Optional[schemas.LocalDateTime] = Query(None, alias="from"),
+                          to: Optional[schemas.LocalDateTime] = None, db: crud_async.DBSession = Depends(get_db)):
+    affected = await crud_async.update_bookings(db, changes=changes, room_id=room_id, user_id=user_id,
+                                                from_=from_, to=to)
+    return schemas.BookingBulkResult(affected=affected)
+
+@app.delete("/bookings", response_model=schemas.BookingBulkResult)
+async def delete_bookings(room_id: Optional[int] = None, user_id: Optional[int] = None,
+                          from_: Optional[schemas.LocalDateTime] = Query(None, alias="from"),
+                          to: Optional[schemas.LocalDateTime] = None, db: crud_async.DBSession = Depends(get_db)):
+    affected = await crud_async.delete_bookings(db, room_id=room_id, user_id=user_id, from_=from_, to=to)
+    return schemas.BookingBulkResult(affected=affected)
+
+# Delete recurring booking
+@app.delete("/recurring_bookings/{recurring_id}", response_model=schemas.RecurringBooking)
+async def delete_recurring_booking(recurring_id: int, db: crud_async.DBSession = Depends(get_db)):
+    db_series = await crud_async.delete_recurring_booking(db, recurring_id=recurring_id)
+    if db_series is None:
+        raise HTTPException(status_code=404, detail="Recurring booking not found")
+    return db_series
\ No newline at end of file
@@ -0,0 +1,218 @@
+import bisect
+import contextvars
+import logging
+import os
+import threading
+import time
+
+from sqlalchemy import event
+from starlette.routing import Match
+
+logger = logging.getLogger('uvicorn.error')
+
+# "0" にすると計測しない (/metrics は空になる)
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '1') != '0'
+# この時間 (ミリ秒) 以上かかった SQL をログに出す (0 なら出さない)
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', '0'))
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64, 128)
+
+
+def _labels(names, values) -> str:
+    if not names:
+        return ''
+    pairs = ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                     for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} counter'
+        with self._lock:
+            values = list(self._values.items())
+        for labels, value in values:
+            yield f'{self.name}{_labels(self.labelnames, labels)} {value}'
+
+
+class Gauge:
+    def __init__(self, name: str, help: str, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def set(self, value: float, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+    def render(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} gauge'
+        with self._lock:
+            values = list(self._values.items())
+        for labels, value in values:
+            yield f'{self.name}{_labels(self.labelnames, labels)} {value}'
+
+
+class Histogram:
+    """累積ではなくバケットごとの件数を持ち、出力時に累積にする"""
+
+    def __init__(self, name: str, help: str, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                # バケットごとの件数 (最後は +Inf)、合計、件数
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} histogram'
+        with self._lock:
+            snapshot = [(labels, list(counts), total, count) for labels, (counts, total, count) in self._series.items()]
+        names = self.labelnames + ('le',)
+        for labels, counts, total, count in snapshot:
+            cumulative = 0
+            for bound, n in zip(self.buckets + ('+Inf',), counts):
+                cumulative += n
+                yield f'{self.name}_bucket{_labels(names, labels + (bound,))} {cumulative}'
+            yield f'{self.name}_sum{_labels(self.labelnames, labels)} {total}'
+            yield f'{self.name}_count{_labels(self.labelnames, labels)} {count}'
+
+
+REQUESTS = Counter('http_requests_total', 'HTTP requests', ('method', 'route', 'status'))
+REQUEST_DURATION = Histogram('http_request_duration_seconds', 'HTTP request latency until response headers',
+                             ('method', 'route'))
+REQUEST_QUERIES = Histogram('http_request_db_queries', 'SQL statements executed per request',
+                            ('method', 'route'), buckets=QUERY_COUNT_BUCKETS)
+REQUEST_DB_DURATION = Histogram('http_request_db_seconds', 'Time spent in SQL statements and commits per request',
+                                ('method', 'route'))
+QUERY_DURATION = Histogram('db_query_duration_seconds', 'SQL statement execution time', ('operation',))
+COMMIT_DURATION = Histogram('db_commit_duration_seconds', 'Commit time including lock waits')
+SLOW_QUERIES = Counter('db_slow_queries_total', 'SQL statements slower than SLOW_QUERY_MS', ('operation',))
+IDEMPOTENT_REPLAYS = Counter('http_idempotent_replays_total', 'Responses replayed for a repeated Idempotency-Key')
+# 受付制御 (admission.py)。kind は "write" (書き込みの枠) / "all" (全体の枠)
+ADMISSION_IN_FLIGHT = Gauge('http_admission_in_flight', 'Requests holding an admission slot', ('kind',))
+ADMISSION_QUEUE_DEPTH = Gauge('http_admission_queue_depth', 'Requests waiting for an admission slot', ('kind',))
+ADMISSION_WAIT = Histogram('http_admission_wait_seconds', 'Time spent waiting for an admission slot', ('kind',))
+ADMISSION_REJECTIONS = Counter('http_admission_rejections_total',
+                               'Requests rejected by admission control (queue_full / queue_timeout -> 503, '
+                               'rate_limited -> 429)', ('kind', 'reason'))
+
+REGISTRY = (REQUESTS, REQUEST_DURATION, REQUEST_QUERIES, REQUEST_DB_DURATION,
+            QUERY_DURATION, COMMIT_DURATION, SLOW_QUERIES, IDEMPOTENT_REPLAYS,
+            ADMISSION_IN_FLIGHT, ADMISSION_QUEUE_DEPTH, ADMISSION_WAIT, ADMISSION_REJECTIONS)
+
+# リクエスト中に実行した SQL の [件数, 時間]
+# リストを書き換えるので、call_next の別タスクやスレッドプールにコピーされたコンテキストからも集計できる
+_request_db = contextvars.ContextVar('request_db', default=None)
+
+
+def _record_db(seconds: float):
+    stats = _request_db.get()
+    if stats is not None:
+        stats[0] += 1
+        stats[1] += seconds
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._metrics_start = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - context._metrics_start
+    operation = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else 'UNKNOWN'
+    QUERY_DURATION.observe(elapsed, operation)
+    _record_db(elapsed)
+    if SLOW_QUERY_MS and elapsed * 1000 >= SLOW_QUERY_MS:
+        SLOW_QUERIES.inc(operation)
+        logger.warning('slow query (%.1f ms): %s', elapsed * 1000, ' '.join(statement.split())[:500])
+
+
+# SQLAlchemy にはコミット後のコネクションイベントがないので、dialect の do_commit を包んで計測する
+# (SQLite のロック待ちや WAL への書き込みはここに含まれる)
+def _timed_commit(do_commit):
+    def do_commit_timed(dbapi_connection):
+        t0 = time.perf_counter()
+        try:
+            do_commit(dbapi_connection)
+        finally:
+            elapsed = time.perf_counter() - t0
+            COMMIT_DURATION.observe(elapsed)
+            _record_db(elapsed)
+    return do_commit_timed
+
+
+# エンジンの SQL 実行とコミットを計測する (非同期エンジンは sync_engine を渡す)
+# lifespan が繰り返し実行されても (テストなど) 同じエンジンには 1 回だけ登録する
+def instrument_engine(engine):
+    if not METRICS_ENABLED or event.contains(engine, 'before_cursor_execute', _before_cursor_execute):
+        return
+    event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+    engine.dialect.do_commit = _timed_commit(engine.dialect.do_commit)
+
+
+# ルートのパステンプレート (/users/{user_id} など) をラベルにして、ID ごとに系列が増えないようにする
+# ルーティング前に返したレスポンス (キャッシュのヒットなど) はルートを照合し直す
+def route_label(app, scope) -> str:
+    route = scope.get('route')
+    if route is None:
+        for candidate in app.router.routes:
+            if candidate.matches(scope)[0] == Match.FULL:
+                route = candidate
+                break
+    return getattr(route, 'path', 'unmatched')
+
+
+# HTTP ミドルウェアの本体
+async def observe_request(app, request, call_next):
+    stats = [0, 0.0]
+    token = _request_db.set(stats)
+    t0 = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        elapsed = time.perf_counter() - t0
+        _request_db.reset(token)
+        route = route_label(app, request.scope)
+        method = request.method
+        REQUESTS.inc(method, route, status)
+        REQUEST_DURATION.observe(elapsed, method, route)
+        REQUEST_QUERIES.observe(stats[0], method, route)
+        REQUEST_DB_DURATION.observe(stats[1], method, route)
+
+
+def render() -> str:
+    return '\n'.join(line for metric in REGISTRY for line in metric.render()) + '\n'
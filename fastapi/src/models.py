@@ -1,4 +1,4 @@
-from sqlalchemy import Column, ForeignKey, Integer, String, DateTime
+from sqlalchemy import BigInteger, Column, Date, ForeignKey, Index, Integer, JSON, String, Text, DateTime
 from sqlalchemy.orm import relationship
 from database import Base
 
@@ -8,6 +8,9 @@ class User(Base):
     user_id = Column(Integer, primary_key=True, index=True)
     username = Column(String, unique=True, index=True)
 
+    # 削除時に予約を読み込んで書き換えないよう passive_deletes にする
+    bookings = relationship('Booking', back_populates='user', passive_deletes=True)
+
 class Room(Base):
     __tablename__ = 'rooms'
 
@@ -15,6 +18,15 @@ class Room(Base):
     room_name = Column(String, unique=True, index=True)
     capacity = Column(Integer)
 
+    bookings = relationship('Booking', back_populates='room', passive_deletes=True)
+
+# 会議室ごとの予約書き込みのバージョン (楽観的排他制御用)
+class RoomVersion(Base):
+    __tablename__ = 'room_versions'
+
+    room_id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
 class Booking(Base):
     __tablename__ = 'bookings'
 
@@ -24,3 +36,96 @@ class Booking(Base):
     booked_num = Column(Integer)
     start_datetime = Column(DateTime, nullable=False)
     end_datetime = Column(DateTime, nullable=False)
+
+    user = relationship('User', back_populates='bookings')
+    room = relationship('Room', back_populates='bookings')
+
+    __table_args__ = (
+        # 予約の重複チェック用 (会議室で絞り込み、開始時刻で範囲検索する)
+        Index('ix_bookings_room_start_end', 'room_id', 'start_datetime', 'end_datetime'),
+        # 期間指定の一覧取得用 ((start_datetime, room_id) 順のキーセット)
+        Index('ix_bookings_start_room', 'start_datetime', 'room_id'),
+        # 予約者で絞り込む一覧取得用
+        Index('ix_bookings_user_start', 'user_id', 'start_datetime'),
+        # SQLite でも削除・保管した予約の booking_id を再利用しない (bookings_archive の ID と重ならないように)
+        {'sqlite_autoincrement': True},
+    )
+
+# 終了から一定期間たった予約の保管先 (archive.py が bookings から移す)
+# 列は bookings と同じで、booking_id も移す前の値のまま
+class BookingArchive(Base):
+    __tablename__ = 'bookings_archive'
+
+    booking_id = Column(Integer, primary_key=True, autoincrement=False)
+    user_id = Column(Integer, nullable=False)
+    room_id = Column(Integer, nullable=False)
+    booked_num = Column(Integer)
+    start_datetime = Column(DateTime, nullable=False)
+    end_datetime = Column(DateTime, nullable=False)
+
+    __table_args__ = (
+        Index('ix_bookings_archive_room_start_end', 'room_id', 'start_datetime', 'end_datetime'),
+        Index('ix_bookings_archive_start_room', 'start_datetime', 'room_id'),
+        Index('ix_bookings_archive_user_start', 'user_id', 'start_datetime'),
+    )
+
+# 繰り返し予約 (回ごとの行は作らず、参照時に必要な期間だけ展開する)
+class RecurringBooking(Base):
+    __tablename__ = 'recurring_bookings'
+
+    recurring_id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey('users.user_id', ondelete='SET NULL'), nullable=False)
+    room_id = Column(Integer, ForeignKey('rooms.room_id', ondelete='SET NULL'), nullable=False)
+    booked_num = Column(Integer)
+    # 初回の開始・終了時刻
+    start_datetime = Column(DateTime, nullable=False)
+    end_datetime = Column(DateTime, nullable=False)
+    # 繰り返し間隔 (日数、毎週なら 7)
+    interval_days = Column(Integer, nullable=False, default=7)
+    # この日付までに始まる回まで繰り返す
+    until = Column(Date, nullable=False)
+    # 予約しない日付 (ISO 形式の文字列のリスト)
+    exception_dates = Column(JSON, nullable=False, default=list)
+
+    user = relationship('User')
+    room = relationship('Room')
+
+    __table_args__ = (
+        Index('ix_recurring_bookings_room_start', 'room_id', 'start_datetime'),
+    )
+
+# 会議室ごと・時間帯ごとの利用実績の集計 (予約の書き込みと同じトランザクションで増減する)
+# granularity は "hour" / "day"、bucket_start はその時間帯の開始時刻
+class RoomUsage(Base):
+    __tablename__ = 'room_usage'
+
+    room_id = Column(Integer, primary_key=True)
+    granularity = Column(String(8), primary_key=True)
+    bucket_start = Column(DateTime, primary_key=True)
+    # 予約されている秒数と、人数 × 秒数
+    booked_seconds = Column(BigInteger, nullable=False, default=0)
+    seat_seconds = Column(BigInteger, nullable=False, default=0)
+
+    __table_args__ = (
+        # 全会議室の期間指定の集計用
+        Index('ix_room_usage_granularity_bucket', 'granularity', 'bucket_start'),
+    )
+
+# 登録・更新・削除の変更イベント (書き込みと同じトランザクションで追加し、/events で配信する)
+# version は単調増加で、古いイベントを消しても再利用しない
+class ChangeEvent(Base):
+    __tablename__ = 'change_events'
+
+    version = Column(Integer, primary_key=True)
+    # "user" / "room" / "booking" / "recurring_booking"
+    entity = Column(String(32), nullable=False)
+    entity_id = Column(Integer, nullable=False)
+    # "create" / "update" / "delete" / "archive"
+    operation = Column(String(16), nullable=False)
+    # 書き込み後の値 (削除の場合は削除した値) の JSON
+    data = Column(Text, nullable=False)
+    created_at = Column(DateTime, nullable=False)
+
+    __table_args__ = (
+        {'sqlite_autoincrement': True},
+    )
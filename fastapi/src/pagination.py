@@ -0,0 +1,56 @@
+import base64
+import datetime
+import json
+
+from fastapi import HTTPException
+
+# カーソルは最後に返した行のソートキーを JSON にして base64url で包んだもの
+# クライアントは中身を解釈せず、X-Next-Cursor ヘッダーの値を次のリクエストの cursor にそのまま渡す
+NEXT_CURSOR_HEADER = 'X-Next-Cursor'
+
+
+def encode_cursor(kind: str, *values) -> str:
+    payload = [kind] + [v.isoformat() if isinstance(v, datetime.datetime) else v for v in values]
+    return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode().rstrip('=')
+
+
+def decode_cursor(token: str, kind: str):
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+        if payload[0] != kind:
+            raise ValueError(payload[0])
+        return payload[1:]
+    except (ValueError, TypeError, IndexError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+# 主キー順のカーソル
+def id_cursor(value: int) -> str:
+    return encode_cursor('id', value)
+
+
+def decode_id_cursor(token: str) -> int:
+    (value,) = _values(decode_cursor(token, 'id'), 1)
+    if not isinstance(value, int):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return value
+
+
+# (start_datetime, room_id) 順のカーソル
+# 同じ会議室の予約は開始時刻が重ならないので、繰り返し予約の回を含めて一意になる
+def start_cursor(start: datetime.datetime, room_id: int) -> str:
+    return encode_cursor('start', start, room_id)
+
+
+def decode_start_cursor(token: str):
+    start, room_id = _values(decode_cursor(token, 'start'), 2)
+    try:
+        return datetime.datetime.fromisoformat(start), int(room_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def _values(values, n):
+    if len(values) != n:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return values
@@ -0,0 +1,30 @@
+import datetime
+
+
+# 繰り返し予約の発生を、指定した期間 [window_start, window_end) と重なるものだけ順に返す
+# series は models.RecurringBooking / schemas.RecurringBookingCreate のどちらでもよい
+# (start_datetime, end_datetime は初回の開始・終了、interval_days ごとに until の日付まで繰り返す)
+def occurrences(series, window_start, window_end):
+    step = datetime.timedelta(days=series.interval_days)
+    exceptions = {str(d) for d in series.exception_dates or ()}
+    first_start = series.start_datetime
+    first_end = series.end_datetime
+
+    # window_start より後に終わる最初の回から始める (それより前の回は展開しない)
+    k = 0
+    if window_start >= first_end:
+        k = (window_start - first_end) // step + 1
+    start = first_start + step * k
+    while start < window_end and start.date() <= series.until:
+        if str(start.date()) not in exceptions:
+            yield start, first_end + step * k
+        k += 1
+        start = first_start + step * k
+
+
+# 最後の回の終了時刻
+def last_end(series):
+    step = datetime.timedelta(days=series.interval_days)
+    last_day = datetime.datetime.combine(series.until, datetime.time.max)
+    k = max(0, (last_day - series.start_datetime) // step)
+    return series.end_datetime + step * k
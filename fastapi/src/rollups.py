@@ -0,0 +1,142 @@
+import argparse
+import datetime
+from collections import defaultdict
+
+from sqlalchemy import delete, insert, select, union_all, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+
+import models, recurrence
+
+# 集計を持つ単位 (週はその週の日の集計を足して求める)
+STORED_GRANULARITIES = ('hour', 'day')
+GRANULARITIES = ('hour', 'day', 'week')
+BUCKET_LENGTHS = {
+    'hour': datetime.timedelta(hours=1),
+    'day': datetime.timedelta(days=1),
+    'week': datetime.timedelta(weeks=1),
+}
+
+
+# その時刻を含む時間帯の開始時刻 (週は月曜始まり)
+def bucket_floor(value: datetime.datetime, granularity: str) -> datetime.datetime:
+    if granularity == 'hour':
+        return value.replace(minute=0, second=0, microsecond=0)
+    day = value.replace(hour=0, minute=0, second=0, microsecond=0)
+    if granularity == 'week':
+        return day - datetime.timedelta(days=day.weekday())
+    return day
+
+
+# [start, end) を時間帯ごとに分け、(時間帯の開始時刻, 重なる秒数) を順に返す
+def split(start: datetime.datetime, end: datetime.datetime, granularity: str):
+    step = BUCKET_LENGTHS[granularity]
+    bucket = bucket_floor(start, granularity)
+    while bucket < end:
+        following = bucket + step
+        yield bucket, round((min(end, following) - max(start, bucket)).total_seconds())
+        bucket = following
+
+
+# (room_id, start, end, booked_num, sign) の並びを時間帯ごとの増減にまとめる
+# sign は追加なら 1、取り消しなら -1。打ち消し合って 0 になった時間帯は含めない
+def deltas(intervals) -> dict:
+    totals = defaultdict(lambda: [0, 0])
+    for room_id, start, end, booked_num, sign in intervals:
+        for granularity in STORED_GRANULARITIES:
+            for bucket, seconds in split(start, end, granularity):
+                total = totals[(room_id, granularity, bucket)]
+                total[0] += sign * seconds
+                total[1] += sign * seconds * (booked_num or 0)
+    return {key: total for key, total in totals.items() if total != [0, 0]}
+
+
+# 同じ時間帯の行があれば加算し、なければ作る
+# SQLite / PostgreSQL は ON CONFLICT DO UPDATE の 1 文でまとめて書き込む
+def _upsert(db: Session, rows):
+    table = models.RoomUsage.__table__
+    dialect = db.get_bind().dialect.name
+    if dialect in ('sqlite', 'postgresql'):
+        stmt = (sqlite.insert if dialect == 'sqlite' else postgresql.insert)(table)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[table.c.room_id, table.c.granularity, table.c.bucket_start],
+            set_={
+                'booked_seconds': table.c.booked_seconds + stmt.excluded.booked_seconds,
+                'seat_seconds': table.c.seat_seconds + stmt.excluded.seat_seconds,
+            }
+        )
+        db.execute(stmt, rows)
+        return
+    for row in rows:
+        updated = db.execute(
+            update(table).
+            where(table.c.room_id == row['room_id']).
+            where(table.c.granularity == row['granularity']).
+            where(table.c.bucket_start == row['bucket_start']).
+            values(booked_seconds=table.c.booked_seconds + row['booked_seconds'],
+                   seat_seconds=table.c.seat_seconds + row['seat_seconds'])
+        )
+        if updated.rowcount == 0:
+            db.execute(insert(table), row)
+
+
+# 予約の追加・取り消しを集計に反映する (コミットは呼び出し側のトランザクションで行う)
+def apply(db: Session, intervals):
+    rows = [
+        {'room_id': room_id, 'granularity': granularity, 'bucket_start': bucket,
+         'booked_seconds': booked, 'seat_seconds': seats}
+        for (room_id, granularity, bucket), (booked, seats) in deltas(intervals).items()
+    ]
+    if rows:
+        _upsert(db, rows)
+
+
+# 繰り返し予約の全ての回を apply に渡す形で返す
+def series_intervals(series, sign: int):
+    for start, end in recurrence.occurrences(series, series.start_datetime, recurrence.last_end(series)):
+        yield series.room_id, start, end, series.booked_num, sign
+
+
+# 既存の予約から集計を作り直す (1 トランザクション)
+# 予約は会議室順に読み、会議室ごとに書き込むので、メモリには 1 会議室分の集計しか持たない
+def backfill(db: Session, batch_size: int = 10000) -> int:
+    db.execute(delete(models.RoomUsage))
+    # bookings_archive に移した予約も含める
+    columns = ('room_id', 'start_datetime', 'end_datetime', 'booked_num')
+    bookings = union_all(
+        select(*(getattr(models.Booking, name) for name in columns)),
+        select(*(getattr(models.BookingArchive, name) for name in columns))
+    ).subquery()
+    rows = db.execute(
+        select(bookings).order_by(bookings.c.room_id).execution_options(yield_per=batch_size)
+    )
+    count = 0
+    pending = []
+    for room_id, start, end, booked_num in rows:
+        if pending and pending[-1][0] != room_id:
+            apply(db, pending)
+            pending = []
+        pending.append((room_id, start, end, booked_num, 1))
+        count += 1
+    apply(db, pending)
+    for series in db.query(models.RecurringBooking).all():
+        apply(db, series_intervals(series, 1))
+    db.commit()
+    return count
+
+
+if __name__ == '__main__':
+    # 使い方 (src ディレクトリで実行): python rollups.py backfill
+    parser = argparse.ArgumentParser(description='会議室の利用実績の集計を既存の予約から作り直す')
+    parser.add_argument('command', choices=['backfill'])
+    parser.add_argument('--batch-size', type=int, default=10000)
+    args = parser.parse_args()
+
+    import bootstrap
+    from database import SessionLocal
+    bootstrap.run(seed=False)
+    session = SessionLocal()
+    try:
+        print(f'backfilled room usage from {backfill(session, args.batch_size)} bookings')
+    finally:
+        session.close()
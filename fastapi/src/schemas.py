@@ -1,19 +1,49 @@
 import datetime
-from pydantic import BaseModel, Field
+from typing import Annotated, List, Literal, Optional
+from pydantic import AfterValidator, BaseModel, Field
+
+
+# 時差付きの日時はサーバーのローカル時刻に直して時差を外す
+# DB には時差なしで保存し、datetime.now() とも比べるので、受け取った日時はすべてこの形にそろえる
+def _to_local_naive(value: datetime.datetime) -> datetime.datetime:
+    if value.tzinfo is None:
+        return value
+    return value.astimezone().replace(tzinfo=None)
+
+# リクエストの本文・クエリパラメーターで受け取る日時
+LocalDateTime = Annotated[datetime.datetime, AfterValidator(_to_local_naive)]
 
 class BookingCreate(BaseModel):
     user_id: int
     room_id: int
     booked_num: int
-    start_datetime: datetime.datetime
-    end_datetime: datetime.datetime
+    start_datetime: LocalDateTime
+    end_datetime: LocalDateTime
     
+# 予約一括登録の各要素の結果
+class BookingBatchResult(BaseModel):
+    index: int
+    status: Literal['accepted', 'rejected']
+    booking_id: Optional[int] = None
+    detail: Optional[str] = None
+
 class Booking(BookingCreate):
-    booking_id: int
+    # 繰り返し予約の回は booking_id を持たず、recurring_id でシリーズを示す
+    booking_id: Optional[int]
+    recurring_id: Optional[int] = None
 
     class Config:
         orm_mode = True
     
+# 予約者名・会議室名と表示用の時刻を含めた予約
+class BookingExpanded(Booking):
+    username: Optional[str] = None
+    room_name: Optional[str] = None
+    capacity: Optional[int] = None
+    # '%Y/%m/%d %H:%M' 形式
+    start_text: str
+    end_text: str
+
 class UserCreate(BaseModel):
     username: str = Field(max_length=12)
 
@@ -33,6 +63,52 @@ class Room(RoomCreate):
     class Config:
         orm_mode = True
 
+class TimeSlot(BaseModel):
+    start_datetime: LocalDateTime
+    end_datetime: LocalDateTime
+
+# おまかせ予約
+# 希望の時間帯 (start_datetime / end_datetime と windows の順) ごとに、booked_num 人以上入る空き会議室の
+# うち定員が最も小さいものを探し、最初に見つかった時間帯・会議室で予約する
+class BookingAutoCreate(BaseModel):
+    user_id: int
+    booked_num: int = Field(ge=1)
+    start_datetime: Optional[LocalDateTime] = None
+    end_datetime: Optional[LocalDateTime] = None
+    windows: List[TimeSlot] = []
+
+# 空き会議室検索の結果
+class RoomAvailability(BaseModel):
+    room_id: int
+    room_name: str
+    capacity: int
+    free_slots: List[TimeSlot]
+
+# 会議室の利用実績 (bucket_start から 1 時間・1 日・1 週間ごと)
+# utilization は予約されている時間の割合 (時間帯の長さに対する)
+class RoomUtilization(BaseModel):
+    room_id: int
+    bucket_start: datetime.datetime
+    booked_minutes: float
+    seat_hours: float
+    utilization: float
+
+# 会議室ごとの予約状況
+# slots は日ごとの枠のビット列 (base64)。open_time から slot_minutes 分ごとの枠が
+# 先頭バイトの最上位ビットから順に並び、予約のある枠が 1
+class RoomTimeline(BaseModel):
+    room_id: int
+    room_name: str
+    slots: List[str]
+
+class Timeline(BaseModel):
+    start_date: datetime.date
+    days: int
+    open_time: datetime.time
+    slot_minutes: int
+    slots_per_day: int
+    rooms: List[RoomTimeline]
+
 class UserUpdate(BaseModel):
     username: str = Field(max_length=12)
 
@@ -40,9 +116,35 @@ class RoomUpdate(BaseModel):
     room_name: str = Field(max_length=12)
     capacity: int
 
+# 予約一括更新で書き換える値 (指定した項目だけ書き換える)
+class BookingBulkUpdate(BaseModel):
+    user_id: Optional[int] = None
+    booked_num: Optional[int] = None
+
+# 予約一括更新・削除の結果 (対象になった予約の件数)
+class BookingBulkResult(BaseModel):
+    affected: int
+
 class BookingUpdate(BaseModel):
     user_id: int
     room_id: int
     booked_num: int
-    start_datetime: datetime.datetime
-    end_datetime: datetime.datetime
\ No newline at end of file
+    start_datetime: LocalDateTime
+    end_datetime: LocalDateTime
+
+class RecurringBookingCreate(BaseModel):
+    user_id: int
+    room_id: int
+    booked_num: int
+    # 初回の開始・終了時刻
+    start_datetime: LocalDateTime
+    end_datetime: LocalDateTime
+    interval_days: int = Field(7, ge=1)
+    until: datetime.date
+    exception_dates: List[datetime.date] = []
+
+class RecurringBooking(RecurringBookingCreate):
+    recurring_id: int
+
+    class Config:
+        orm_mode = True
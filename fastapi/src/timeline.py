@@ -0,0 +1,60 @@
+import base64
+import datetime
+import os
+import threading
+from collections import OrderedDict
+
+from availability import CLOSE_TIME, OPEN_TIME
+
+# 9:00〜20:00 を 15 分ごとの枠に分け、予約のある枠のビットを立てる (1 日 44 ビット = 6 バイト)
+SLOT_MINUTES = 15
+SLOT = datetime.timedelta(minutes=SLOT_MINUTES)
+SLOTS_PER_DAY = (datetime.datetime.combine(datetime.date.min, CLOSE_TIME) -
+                 datetime.datetime.combine(datetime.date.min, OPEN_TIME)) // SLOT
+TIMELINE_CACHE_MAX_ENTRIES = int(os.environ.get('TIMELINE_CACHE_MAX_ENTRIES', '100000'))
+
+
+# その日の予約済み区間 intervals から枠のビット列を作る (先頭の枠が最上位ビット)
+def day_bitmap(day: datetime.date, intervals) -> bytes:
+    bits = bytearray((SLOTS_PER_DAY + 7) // 8)
+    day_open = datetime.datetime.combine(day, OPEN_TIME)
+    for start, end in intervals:
+        first = max(0, (start - day_open) // SLOT)
+        last = min(SLOTS_PER_DAY, -((day_open - end) // SLOT))
+        for i in range(first, last):
+            bits[i // 8] |= 0x80 >> (i % 8)
+    return bytes(bits)
+
+
+def encode(bitmap: bytes) -> str:
+    return base64.b64encode(bitmap).decode('ascii')
+
+
+class DayCache:
+    """会議室・日ごとのビット列のキャッシュ (件数上限を超えたら最も使われていないものから捨てる)
+
+    キーは (room_id, 会議室のバージョン, 日付)。予約を書き込むと会議室のバージョンが進むので、
+    古いエントリーは参照されなくなり、いずれ追い出される。
+    """
+
+    def __init__(self, max_entries: int):
+        self._entries = OrderedDict()
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+
+day_cache = DayCache(TIMELINE_CACHE_MAX_ENTRIES)
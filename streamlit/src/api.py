@@ -0,0 +1,125 @@
+import base64
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+import streamlit as st
+from requests.adapters import HTTPAdapter
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+import replica
+
+# FastAPI のベース URL (docker-compose の FASTAPI_URL)
+BASE_URL = os.environ.get('FASTAPI_URL', 'http://fastapi:8000').rstrip('/')
+# (接続, 読み込み) のタイムアウト秒数
+TIMEOUT = (3.05, 30)
+# 一覧のキャッシュ秒数 (自分の登録・更新・削除の後はすぐに破棄する)
+CACHE_TTL = int(os.environ.get('API_CACHE_TTL', '30'))
+# "1" の場合はユーザー・会議室・予約の一覧を /events で手元に複製し、画面の更新のたびに取得しない
+LIVE_UPDATES = os.environ.get('API_LIVE_UPDATES', '1') == '1'
+# 書き込みが混雑で断られた (429 / 503) ときに Retry-After 秒待って送り直す回数と、待つ秒数の上限
+BUSY_RETRIES = int(os.environ.get('API_BUSY_RETRIES', '2'))
+MAX_RETRY_AFTER = 5
+
+
+# 接続を使い回すセッション (アプリ全体で 1 つ)
+@st.cache_resource
+def get_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+# 一覧を並行して取得するためのスレッドプール
+@st.cache_resource
+def get_executor():
+    return ThreadPoolExecutor(max_workers=4)
+
+
+# 変更イベントを反映し続ける一覧の複製 (アプリ全体で 1 つ)
+@st.cache_resource
+def get_replica():
+    return replica.Replica(BASE_URL)
+
+
+@st.cache_data(ttl=CACHE_TTL, show_spinner=False)
+def get_json(path: str, params: dict = None):
+    res = get_session().get(f'{BASE_URL}{path}', params=params, timeout=TIMEOUT)
+    res.raise_for_status()
+    return res.json()
+
+
+# 複製から返せる一覧のパスとエンティティ名
+ENTITIES = {'/users': 'user', '/rooms': 'room', '/bookings': 'booking'}
+
+
+# 複数の一覧を指定した順に返す
+# 複製が使える (/events につながっていて最初の取得が終わっている) 一覧はそこから返し、
+# 残りは API から並行して取得する (複製の準備を待って画面の表示を止めない)
+def get_many(*paths):
+    replica_ = get_replica() if LIVE_UPDATES else None
+    results = {path: replica_.list(ENTITIES[path]) if replica_ and path in ENTITIES else None for path in paths}
+    missing = [path for path, items in results.items() if items is None]
+    ctx = get_script_run_ctx()
+
+    def fetch(path):
+        add_script_run_ctx(ctx=ctx)
+        return get_json(path)
+
+    results.update(zip(missing, get_executor().map(fetch, missing)))
+    return [results[path] for path in paths]
+
+
+def get_users():
+    return get_many('/users')[0]
+
+
+def get_rooms():
+    return get_many('/rooms')[0]
+
+
+def get_bookings():
+    return get_many('/bookings')[0]
+
+
+# /rooms/timeline の日ごとの枠のビット列 (base64) を枠ごとの予約有無のリストにする
+def decode_slots(encoded: str, slots_per_day: int):
+    bits = base64.b64decode(encoded)
+    return [bool(bits[i // 8] & (0x80 >> (i % 8))) for i in range(slots_per_day)]
+
+
+# 書き込み系のリクエスト (成功・失敗にかかわらずキャッシュした一覧を破棄する)
+# 混雑で断られた場合は Retry-After に従って送り直す。POST / PUT は Idempotency-Key を付けるので、
+# 送り直しても 2 回書き込まれることはない
+# 成功した場合は、再描画で自分の書き込みが見えるよう複製にイベントが届くまで少し待つ
+def _send(method: str, path: str, data: dict = None):
+    version = get_replica().version if LIVE_UPDATES else None
+    headers = {'Idempotency-Key': str(uuid.uuid4())} if method in ('POST', 'PUT') else {}
+    try:
+        for attempt in range(BUSY_RETRIES + 1):
+            res = get_session().request(method, f'{BASE_URL}{path}', json=data, headers=headers, timeout=TIMEOUT)
+            if res.status_code not in (429, 503) or attempt == BUSY_RETRIES:
+                break
+            retry_after = res.headers.get('Retry-After', '')
+            time.sleep(min(float(retry_after) if retry_after.isdigit() else 1, MAX_RETRY_AFTER))
+    finally:
+        get_json.clear()
+    if LIVE_UPDATES and res.ok:
+        get_replica().wait_newer(version)
+    return res
+
+
+def post(path: str, data: dict):
+    return _send('POST', path, data)
+
+
+def put(path: str, data: dict):
+    return _send('PUT', path, data)
+
+
+def delete(path: str):
+    return _send('DELETE', path)
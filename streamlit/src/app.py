@@ -1,12 +1,15 @@
 import streamlit as st
-import requests
-import json
 import pandas as pd
 import datetime
 import streamlit_authenticator as stauth
 import yaml
+
+import api
 from yaml.loader import SafeLoader
 
+# 予約画面の会議室の選択肢で、サーバーに会議室を選ばせる項目
+AUTO_ROOM = 'おまかせ'
+
 # 設定ファイルの読み込み
 with open('./config.yaml') as file:
     config = yaml.load(file, Loader=SafeLoader)
@@ -46,8 +49,7 @@ if st.session_state["authentication_status"]:
             submit_button = st.form_submit_button(label='ユーザー登録')
 
         if submit_button:
-            url = 'http://fastapi:8000/users'
-            res = requests.post(url, data=json.dumps(data))
+            res = api.post('/users', data)
             if res.status_code == 200:
                 st.success('ユーザー登録完了')
 
@@ -65,22 +67,16 @@ if st.session_state["authentication_status"]:
             submit_button = st.form_submit_button(label='会議室登録')
 
         if submit_button:
-            url = 'http://fastapi:8000/rooms'
-            res = requests.post(url, data=json.dumps(data))
+            res = api.post('/rooms', data)
             if res.status_code == 200:
                 st.success('会議室登録完了')
             
 
     elif page == '予約登録':
         st.title('会議室予約画面')
-        url_users = 'http://fastapi:8000/users'
-        res = requests.get(url_users)
-        users = res.json()
+        # 一覧は並行して取得する
+        users, rooms = api.get_many('/users', '/rooms')
         users_name = {user['username']: user['user_id'] for user in users}
-
-        url_rooms = 'http://fastapi:8000/rooms'
-        res = requests.get(url_rooms)
-        rooms = res.json()
         rooms_name = {room['room_name']: {'room_id': room['room_id'], 'capacity': room['capacity']} for room in rooms}
 
         st.write('### 会議室一覧')
@@ -88,47 +84,85 @@ if st.session_state["authentication_status"]:
         df_rooms.columns = ['会議室名', '定員', '会議室ID']
         st.table(df_rooms)
 
-        url_bookings = 'http://fastapi:8000/bookings'
-        res = requests.get(url_bookings)
-        bookings = res.json()
-        df_bookings = pd.DataFrame(bookings)
-
-        users_id = {user['user_id']: user['username'] for user in users}
-        rooms_id = {room['room_id']: {'room_name': room['room_name'], 'capacity': room['capacity']} for room in rooms}
-
-        to_username = lambda x: users_id[x]
-        to_room_name = lambda x: rooms_id[x]['room_name']
-        to_datetime = lambda x: datetime.datetime.fromisoformat(x).strftime('%Y/%m/%d %H:%M')
-
-        df_bookings['user_id'] = df_bookings['user_id'].map(to_username)
-        df_bookings['room_id'] = df_bookings['room_id'].map(to_room_name)
-        df_bookings['start_datetime'] = df_bookings['start_datetime'].map(to_datetime)
-        df_bookings['end_datetime'] = df_bookings['end_datetime'].map(to_datetime)
-
-        df_bookings = df_bookings.rename(columns={
-            'user_id': '予約者名',
-            'room_id': '会議室名',
+        # 予約状況は 1 週間・全会議室分の枠のビット列を 1 回で取得し、会議室 × 15 分枠の表にする
+        st.write('### 予約状況')
+        timeline_start = st.date_input('表示開始日: ', value=datetime.date.today(), key='timeline_start')
+        timeline = api.get_json('/rooms/timeline', params={'start_date': timeline_start.isoformat(), 'days': 7})
+        timeline_days = [timeline_start + datetime.timedelta(days=i) for i in range(timeline['days'])]
+        timeline_day = st.radio('表示日', timeline_days, format_func=lambda d: d.strftime('%m/%d'), horizontal=True)
+        day_index = timeline_days.index(timeline_day)
+        open_time = datetime.datetime.combine(timeline_day, datetime.time.fromisoformat(timeline['open_time']))
+        slot_labels = [
+            (open_time + datetime.timedelta(minutes=timeline['slot_minutes'] * i)).strftime('%H:%M')
+            for i in range(timeline['slots_per_day'])
+        ]
+        df_timeline = pd.DataFrame(
+            [['■' if booked else '' for booked in api.decode_slots(room['slots'][day_index], timeline['slots_per_day'])]
+             for room in timeline['rooms']],
+            index=[room['room_name'] for room in timeline['rooms']],
+            columns=slot_labels
+        )
+        st.dataframe(df_timeline)
+
+        # 表示日の予約は予約者名・会議室名・表示用の時刻を含めてサーバーで組み立てたものを使う
+        # (全件ではなく表示日と重なる予約だけを取得する)
+        day_bookings = api.get_json('/bookings/expanded', params={
+            'from': datetime.datetime.combine(timeline_day, datetime.time(hour=0)).isoformat(),
+            'to': datetime.datetime.combine(timeline_day + datetime.timedelta(days=1), datetime.time(hour=0)).isoformat(),
+            'limit': 1000,
+        })
+        booking_columns = {
+            'username': '予約者名',
+            'room_name': '会議室名',
             'booked_num': '予約人数',
-            'start_datetime': '開始時刻',
-            'end_datetime': '終了時刻',
+            'start_text': '開始時刻',
+            'end_text': '終了時刻',
             'booking_id': '予約番号'
-        })
-        st.write('### 予約一覧')
+        }
+        df_bookings = pd.DataFrame(day_bookings, columns=list(booking_columns)).rename(columns=booking_columns)
+        st.write(f"### {timeline_day.strftime('%m/%d')} の予約一覧")
         st.table(df_bookings)
 
+        st.write('### 空き状況')
+        search_date = st.date_input('検索日: ', min_value=datetime.date.today(), key='search_date')
+        search_num = st.number_input('利用人数', step=1, min_value=1, key='search_num')
+        available_rooms = api.get_json('/rooms/availability', params={
+            'start': datetime.datetime.combine(search_date, datetime.time(hour=0)).isoformat(),
+            'end': datetime.datetime.combine(search_date + datetime.timedelta(days=1), datetime.time(hour=0)).isoformat(),
+            'min_capacity': search_num,
+        })
+        free_rooms = [
+            {
+                '会議室名': room['room_name'],
+                '定員': room['capacity'],
+                '空き時間': ', '.join(
+                    f"{slot['start_datetime'][11:16]}~{slot['end_datetime'][11:16]}" for slot in room['free_slots']
+                )
+            }
+            for room in available_rooms
+        ]
+        if free_rooms:
+            st.table(pd.DataFrame(free_rooms))
+        else:
+            st.info('空いている会議室はありません')
+
         with st.form(key='booking'):
             username = st.selectbox('予約者名', users_name.keys())
-            room_name = st.selectbox('会議室名', rooms_name.keys())
+            # おまかせ: 空いている会議室のうち、人数が入る最も小さい会議室をサーバーが選ぶ
+            room_name = st.selectbox('会議室名', [AUTO_ROOM] + list(rooms_name.keys()))
             booked_num = st.number_input('予約人数', step=1, min_value=1)
             date = st.date_input('日付: ', min_value=datetime.date.today())
             start_time = st.time_input('開始時刻: ', value=datetime.time(hour=9, minute=0))
             end_time = st.time_input('終了時刻: ', value=datetime.time(hour=20, minute=0))
+            repeat = st.selectbox('繰り返し', ['なし', '毎日', '毎週'])
+            until = st.date_input('繰り返し終了日: ', min_value=datetime.date.today())
             submit_button = st.form_submit_button(label='予約登録')
 
         if submit_button:
             user_id = users_name[username]
-            room_id = rooms_name[room_name]['room_id']
-            capacity = rooms_name[room_name]['capacity']
+            auto = room_name == AUTO_ROOM
+            room_id = None if auto else rooms_name[room_name]['room_id']
+            capacity = None if auto else rooms_name[room_name]['capacity']
 
             data = {
                 'user_id': user_id,
@@ -143,25 +177,44 @@ if st.session_state["authentication_status"]:
                     hour=end_time.hour, minute=end_time.minute
                 ).isoformat()
             }
-            if booked_num > capacity:
+            if not auto and booked_num > capacity:
                 st.error(f'{room_name}の定員は、{capacity}名です。{capacity}名以下の予約人数のみ受け付けております。')
             elif start_time >= end_time:
                 st.error('開始時刻が終了時刻を越えています')
             elif start_time < datetime.time(hour=9, minute=0, second=0) or end_time > datetime.time(hour=20, minute=0, second=0):
                 st.error('利用時間は9:00~20:00になります。')
+            elif repeat != 'なし' and until < date:
+                st.error('繰り返し終了日が日付より前になっています')
+            elif auto and repeat != 'なし':
+                st.error('おまかせは繰り返し予約には使えません。会議室を選んでください。')
+            elif auto:
+                del data['room_id']
+                res = api.post('/bookings/auto', data)
+                if res.status_code == 200:
+                    booked_room = next((name for name, room in rooms_name.items()
+                                        if room['room_id'] == res.json()['room_id']), '')
+                    st.success(f'{booked_room}を予約しました')
+                elif res.status_code == 409:
+                    st.error(f'指定の時間に{booked_num}名が入る空き会議室はありません。')
             else:
-                url = 'http://fastapi:8000/bookings'
-                res = requests.post(url, data=json.dumps(data))
+                if repeat == 'なし':
+                    path = '/bookings'
+                else:
+                    # 繰り返し予約は 1 件のシリーズとして登録する
+                    path = '/recurring_bookings'
+                    data['interval_days'] = 1 if repeat == '毎日' else 7
+                    data['until'] = until.isoformat()
+                res = api.post(path, data)
                 if res.status_code == 200:
                     st.success('予約完了しました')
-                elif res.status_code == 404 and res.json()['detail'] == 'Already booked':
+                elif res.status_code == 409:
                     st.error('指定の時間にはすでに予約が入っています。')
+                elif res.status_code == 400:
+                    st.error(f'{room_name}の定員は、{capacity}名です。{capacity}名以下の予約人数のみ受け付けております。')
 
     elif page == 'ユーザー更新・削除':
         st.title('ユーザー更新・削除画面')
-        url_users = 'http://fastapi:8000/users'
-        res = requests.get(url_users)
-        users = res.json()
+        users = api.get_users()
         users_name = {user['username']: user['user_id'] for user in users}
 
         selected_user = st.selectbox('ユーザーを選択', users_name.keys())
@@ -172,8 +225,7 @@ if st.session_state["authentication_status"]:
             update_button = st.form_submit_button(label='ユーザー更新')
 
         if update_button:
-            url = f'http://fastapi:8000/users/{user_id}'
-            res = requests.put(url, data=json.dumps({'username': new_username}))
+            res = api.put(f'/users/{user_id}', {'username': new_username})
             if res.status_code == 200:
                 st.success('ユーザー情報が更新されました')
             
@@ -182,17 +234,14 @@ if st.session_state["authentication_status"]:
             delete_button = st.form_submit_button(label='ユーザー削除')
 
         if delete_button:
-            url = f'http://fastapi:8000/users/{user_id}'
-            res = requests.delete(url)
+            res = api.delete(f'/users/{user_id}')
             if res.status_code == 200:
                 st.success('ユーザーが削除されました')
             
 
     elif page == '会議室更新・削除':
         st.title('会議室更新・削除画面')
-        url_rooms = 'http://fastapi:8000/rooms'
-        res = requests.get(url_rooms)
-        rooms = res.json()
+        rooms = api.get_rooms()
         rooms_name = {room['room_name']: room['room_id'] for room in rooms}
 
         selected_room = st.selectbox('会議室を選択', rooms_name.keys())
@@ -204,8 +253,7 @@ if st.session_state["authentication_status"]:
             update_button = st.form_submit_button(label='会議室更新')
 
         if update_button:
-            url = f'http://fastapi:8000/rooms/{room_id}'
-            res = requests.put(url, data=json.dumps({'room_name': new_room_name, 'capacity': new_capacity}))
+            res = api.put(f'/rooms/{room_id}', {'room_name': new_room_name, 'capacity': new_capacity})
             if res.status_code == 200:
                 st.success('会議室情報が更新されました')
             
@@ -214,30 +262,21 @@ if st.session_state["authentication_status"]:
             delete_button = st.form_submit_button(label='会議室削除')
 
         if delete_button:
-            url = f'http://fastapi:8000/rooms/{room_id}'
-            res = requests.delete(url)
+            res = api.delete(f'/rooms/{room_id}')
             if res.status_code == 200:
                 st.success('会議室が削除されました')
             
 
     elif page == '予約更新・削除':
         st.title('予約更新・削除画面')
-        url_bookings = 'http://fastapi:8000/bookings'
-        res = requests.get(url_bookings)
-        bookings = res.json()
+        # 一覧は並行して取得する
+        bookings, users, rooms = api.get_many('/bookings', '/users', '/rooms')
         bookings_id = {f"{booking['booking_id']} - {booking['start_datetime']} to {booking['end_datetime']}": booking['booking_id'] for booking in bookings}
 
         selected_booking = st.selectbox('予約を選択', bookings_id.keys())
         booking_id = bookings_id[selected_booking]
 
-        url_users = 'http://fastapi:8000/users'
-        res = requests.get(url_users)
-        users = res.json()
         users_name = {user['username']: user['user_id'] for user in users}
-
-        url_rooms = 'http://fastapi:8000/rooms'
-        res = requests.get(url_rooms)
-        rooms = res.json()
         rooms_name = {room['room_name']: {'room_id': room['room_id'], 'capacity': room['capacity']} for room in rooms}
 
         with st.form(key='update_booking'):
@@ -274,8 +313,7 @@ if st.session_state["authentication_status"]:
             elif start_time < datetime.time(hour=9, minute=0, second=0) or end_time > datetime.time(hour=20, minute=0, second=0):
                 st.error('利用時間は9:00~20:00になります。')
             else:
-                url = f'http://fastapi:8000/bookings/{booking_id}'
-                res = requests.put(url, data=json.dumps(data))
+                res = api.put(f'/bookings/{booking_id}', data)
                 if res.status_code == 200:
                     st.success('予約が更新されました')
                 
@@ -284,8 +322,7 @@ if st.session_state["authentication_status"]:
             delete_button = st.form_submit_button(label='予約削除')
 
         if delete_button:
-            url = f'http://fastapi:8000/bookings/{booking_id}'
-            res = requests.delete(url)
+            res = api.delete(f'/bookings/{booking_id}')
             if res.status_code == 200:
                 st.success('予約が削除されました')
 
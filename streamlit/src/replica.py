@@ -0,0 +1,136 @@
+import json
+import threading
+import time
+
+import requests
+
+# 一覧を取得するときの 1 ページの件数
+PAGE_SIZE = 1000
+# /events の読み込みのタイムアウト秒数 (サーバーのキープアライブより長くする)
+READ_TIMEOUT = 60
+# 接続できなかった場合に再接続するまでの秒数 (サーバーがストリームを区切った場合はすぐに再接続する)
+RETRY_SECONDS = 3
+
+# 手元に持つ一覧とイベントのエンティティ名
+PATHS = {
+    'user': ('/users', 'user_id'),
+    'room': ('/rooms', 'room_id'),
+    'booking': ('/bookings', 'booking_id'),
+}
+
+
+# SSE の行を (event, id, data) にまとめる
+def _parse(lines):
+    event, version, data = 'message', None, []
+    for line in lines:
+        if line is None:
+            continue
+        if line == '':
+            if data:
+                yield event, version, json.loads('\n'.join(data))
+            event, version, data = 'message', None, []
+        elif line.startswith(':'):
+            continue
+        else:
+            name, _, value = line.partition(':')
+            value = value[1:] if value.startswith(' ') else value
+            if name == 'event':
+                event = value
+            elif name == 'id':
+                version = int(value)
+            elif name == 'data':
+                data.append(value)
+
+
+class Replica:
+    """/events を購読して、ユーザー・会議室・予約の一覧を手元に持つ
+
+    最初 (とサーバーから reset が来たとき) だけ一覧を全件取得し、以降はイベントを反映する
+    """
+
+    def __init__(self, base_url: str):
+        self._base_url = base_url
+        self._session = requests.Session()
+        self._changed = threading.Condition()
+        self._items = {entity: {} for entity in PATHS}
+        self.version = None
+        # /events につながっていて、一覧がイベントに追いついている間だけ True
+        self.ready = False
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _get_all(self, path: str):
+        items = []
+        params = {'limit': PAGE_SIZE}
+        while True:
+            res = self._session.get(f'{self._base_url}{path}', params=params, timeout=(3.05, 30))
+            res.raise_for_status()
+            page = res.json()
+            items.extend(page)
+            cursor = res.headers.get('X-Next-Cursor')
+            if cursor is None or not page:
+                return items
+            params = {'limit': PAGE_SIZE, 'cursor': cursor}
+
+    # 一覧を取り直す (ready / reset を受け取った後なので、取得中の変更もこの後のイベントで反映される)
+    def _load(self, version: int):
+        items = {
+            entity: {item[id_column]: item for item in self._get_all(path)}
+            for entity, (path, id_column) in PATHS.items()
+        }
+        with self._changed:
+            self._items = items
+            self.version = version
+            self.ready = True
+            self._changed.notify_all()
+
+    def _apply(self, version: int, change: dict):
+        with self._changed:
+            items = self._items.get(change['entity'])
+            if items is not None:
+                if change['operation'] in ('create', 'update'):
+                    items[change['id']] = change['data']
+                else:
+                    items.pop(change['id'], None)
+            self.version = version
+            self._changed.notify_all()
+
+    def _run(self):
+        while True:
+            headers = {} if self.version is None else {'Last-Event-ID': str(self.version)}
+            try:
+                with self._session.get(f'{self._base_url}/events', headers=headers, stream=True,
+                                       timeout=(3.05, READ_TIMEOUT)) as res:
+                    res.raise_for_status()
+                    # chunk_size=None にして、届いた分からすぐに読む
+                    lines = res.iter_lines(chunk_size=None, decode_unicode=True)
+                    for event, version, data in _parse(lines):
+                        if event == 'change':
+                            self._apply(version, data)
+                        elif event == 'reset' or (event == 'ready' and self.version is None):
+                            self._load(version)
+                        elif event == 'ready':
+                            self._set_ready(True)
+            except (requests.RequestException, ValueError):
+                self._set_ready(False)
+                time.sleep(RETRY_SECONDS)
+            else:
+                # サーバーがストリームを区切った場合も、再接続するまでは最新とは限らない
+                self._set_ready(False)
+
+    def _set_ready(self, ready: bool):
+        with self._changed:
+            self.ready = ready
+            self._changed.notify_all()
+
+    # 一覧 (ID 順)。/events につながっていない・最初の取得が終わっていない場合は待たずに None
+    def list(self, entity: str):
+        with self._changed:
+            if not self.ready:
+                return None
+            return sorted(self._items[entity].values(), key=lambda item: item[PATHS[entity][1]])
+
+    # version が since より進むまで最大 timeout 秒待つ (自分の書き込みを一覧に反映させるため)
+    # つながっていない間はイベントが届かないので待たない
+    def wait_newer(self, since, timeout: float = 2):
+        with self._changed:
+            self._changed.wait_for(lambda: not self.ready or since is None or (self.version or 0) > since, timeout)